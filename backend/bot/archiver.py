@@ -0,0 +1,220 @@
+"""Cold archive for old messages.
+
+Messages older than ARCHIVE_AFTER_DAYS move out of the hot `messages`
+collection into per-chat compressed JSONL segments on disk; the last
+HISTORY_LIMIT messages of every chat always stay hot. The conversation
+keeps a pointer list (`archive_segments`) used to read them back.
+
+    python -m bot.archiver          # one archiving pass
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # gzip — запасной вариант без внешней зависимости
+    zstandard = None
+
+ARCHIVE_INTERVAL_SEC = 6 * 3600
+SEGMENT_MAX_MESSAGES = 5000
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _encode(messages):
+    raw = "".join(
+        json.dumps(m, default=_json_default, ensure_ascii=False) + "\n" for m in messages
+    ).encode("utf-8")
+    if zstandard is not None:
+        return "zst", zstandard.ZstdCompressor(level=10).compress(raw)
+    return "gz", gzip.compress(raw, compresslevel=9)
+
+
+def _decode(codec, data):
+    if codec == "zst":
+        if zstandard is None:
+            raise RuntimeError("Сегмент сжат zstd, а модуль zstandard не установлен")
+        raw = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    else:
+        raw = gzip.decompress(data)
+    messages = []
+    for line in raw.decode("utf-8").splitlines():
+        if line:
+            msg = json.loads(line)
+            msg["timestamp"] = datetime.fromisoformat(msg["timestamp"])
+            messages.append(msg)
+    return messages
+
+
+def _write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class MessageArchiver:
+    """Moves old messages into compressed segments and reads them back."""
+
+    def __init__(self, database, archive_dir, after_days, keep):
+        self.database = database
+        self.archive_dir = Path(archive_dir)
+        self.after_days = after_days
+        self.keep = keep
+        self._lock = asyncio.Lock()
+        self.runs = 0
+        self.archived_messages = 0
+        self.segments_written = 0
+        self.bytes_written = 0
+
+    async def run_once(self, max_chats=1000):
+        """One archiving pass; returns the number of archived messages."""
+        if self.after_days <= 0:
+            return 0
+        async with self._lock:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+            # Сообщения из буфера записи должны попасть в коллекцию до выборки
+            await self.database.flush()
+            for chat_id in await self.database.get_pending_archive_chats():
+                try:
+                    await self._finish_pending(chat_id)
+                except Exception as e:
+                    logger.warning(f"Не удалось дозавершить сегмент чата {chat_id}: {e}")
+            total = 0
+            chat_ids = await self.database.get_archive_candidates(cutoff, self.keep, max_chats)
+            for chat_id in chat_ids:
+                try:
+                    total += await self.archive_chat(chat_id, cutoff)
+                except Exception as e:
+                    logger.warning(f"Архивация чата {chat_id} не удалась: {e}")
+            self.runs += 1
+            if total:
+                logger.info(f"Архив: {total} сообщений из {len(chat_ids)} чатов")
+            return total
+
+    async def _finish_pending(self, chat_id):
+        """Drop the hot copies of messages of a segment whose commit was cut short."""
+        for segment in await self.database.get_archive_segments(chat_id):
+            if not segment.get("pending"):
+                continue
+            data = await asyncio.to_thread((self.archive_dir / segment["file"]).read_bytes)
+            messages = await asyncio.to_thread(_decode, segment["codec"], data)
+            segment = {k: v for k, v in segment.items() if k != "pending"}
+            await self.database.commit_archive_segment(
+                chat_id, segment, [m["id"] for m in messages]
+            )
+            logger.info(f"Архив: дозавершён сегмент {segment['file']}")
+
+    async def archive_chat(self, chat_id, cutoff):
+        archived = 0
+        while True:
+            messages = await self.database.get_archivable_messages(
+                chat_id, cutoff, self.keep, SEGMENT_MAX_MESSAGES
+            )
+            if not messages:
+                return archived
+            codec, data = await asyncio.to_thread(_encode, messages)
+            # Имя по первому и последнему id: повтор после сбоя перезапишет тот же файл
+            name = f"{messages[0]['id']}-{messages[-1]['id']}.jsonl.{codec}"
+            path = self.archive_dir / str(chat_id) / name
+            await asyncio.to_thread(_write_atomic, path, data)
+            segment = {
+                "file": f"{chat_id}/{name}",
+                "codec": codec,
+                "count": len(messages),
+                "images": sum(1 for m in messages if m.get("has_image")),
+                "first_at": messages[0]["timestamp"],
+                "last_at": messages[-1]["timestamp"],
+                "bytes": len(data),
+            }
+            await self.database.commit_archive_segment(
+                chat_id, segment, [m["id"] for m in messages]
+            )
+            archived += len(messages)
+            self.archived_messages += len(messages)
+            self.segments_written += 1
+            self.bytes_written += len(data)
+            if len(messages) < SEGMENT_MAX_MESSAGES:
+                return archived
+
+    async def iter_archived(self, chat_id):
+        """Archived messages of a chat, oldest first, one segment in memory at a time."""
+        seen = set()
+        for segment in await self.database.get_archive_segments(chat_id):
+            path = self.archive_dir / segment["file"]
+            try:
+                data = await asyncio.to_thread(path.read_bytes)
+            except FileNotFoundError:
+                logger.warning(f"Сегмент архива не найден: {path}")
+                continue
+            for msg in await asyncio.to_thread(_decode, segment["codec"], data):
+                # Сегменты могут пересекаться после сбоя между записью и удалением
+                if msg["id"] in seen:
+                    continue
+                seen.add(msg["id"])
+                yield msg
+
+    async def read_archived(self, chat_id):
+        return [msg async for msg in self.iter_archived(chat_id)]
+
+    @property
+    def stats(self):
+        return {
+            "runs": self.runs,
+            "archived_messages": self.archived_messages,
+            "segments_written": self.segments_written,
+            "bytes_written": self.bytes_written,
+            "codec": "zst" if zstandard is not None else "gz",
+        }
+
+
+# Global instance
+_archiver = None
+
+
+def get_archiver(database) -> MessageArchiver:
+    global _archiver
+    if _archiver is None:
+        _archiver = MessageArchiver(
+            database,
+            archive_dir=BotConfig.ARCHIVE_DIR,
+            after_days=BotConfig.ARCHIVE_AFTER_DAYS,
+            keep=BotConfig.HISTORY_LIMIT,
+        )
+    return _archiver
+
+
+async def _main():
+    from .storage import create_storage
+
+    database = create_storage()
+    try:
+        await database.migrate()
+        archived = await get_archiver(database).run_once()
+        print(f"Перенесено в архив: {archived} сообщений")
+    finally:
+        await database.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_main())
@@ -12,9 +12,37 @@ class BotConfig:
     ADMIN_USER_ID = int(os.environ.get('ADMIN_USER_ID') or '0')
     SILENCE_DURATION_MIN = int(os.environ.get('SILENCE_DURATION_MIN') or '30')
     HISTORY_LIMIT = int(os.environ.get('HISTORY_LIMIT') or '20')
+    ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS') or '30')
+    # Сообщения старше N дней уходят в сжатый архив (0 — не архивировать);
+    # последние HISTORY_LIMIT сообщений чата всегда остаются в БД
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or '90')
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or str(Path(__file__).parent.parent / 'archive')
+    # Лимит памяти под кэш последних сообщений чатов (LRU по чатам)
+    HISTORY_CACHE_MB = int(os.environ.get('HISTORY_CACHE_MB') or '32')
+    # Сканирование диалогов: сколько чатов качать параллельно и общий
+    # лимит запросов к Telegram в секунду (FloodWait останавливает всех)
+    SCAN_CONCURRENCY = int(os.environ.get('SCAN_CONCURRENCY') or '4')
+    TELEGRAM_RPS = float(os.environ.get('TELEGRAM_RPS') or '3')
+    # FloodWait длиннее этого — чат пропускается, а не ждём
+    SCAN_MAX_FLOOD_WAIT_SEC = int(os.environ.get('SCAN_MAX_FLOOD_WAIT_SEC') or '300')
     GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.0-flash')
     GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
     MEDIA_DIR = Path(__file__).parent.parent / 'media'
+    # Пороги расстояния Хэмминга для повторных скриншотов:
+    # EXACT — по точному хешу (1024 бита), NEAR — по грубому (256 бит)
+    SCREENSHOT_HASH_EXACT = int(os.environ.get('SCREENSHOT_HASH_EXACT') or '8')
+    SCREENSHOT_HASH_NEAR = int(os.environ.get('SCREENSHOT_HASH_NEAR') or '20')
+    # Размер дискового кэша готовых голосовых ответов
+    TTS_CACHE_MAX_MB = int(os.environ.get('TTS_CACHE_MAX_MB') or '200')
+    # Отложенная запись activity_log (и сообщений) пачками через insert_many
+    DB_FLUSH_INTERVAL_MS = int(os.environ.get('DB_FLUSH_INTERVAL_MS') or '500')
+    DB_FLUSH_BATCH = int(os.environ.get('DB_FLUSH_BATCH') or '100')
+    DB_BUFFER_MESSAGES = os.environ.get('DB_BUFFER_MESSAGES', 'true').lower() in ('1', 'true', 'yes')
+    # Как часто пересчитывать счётчики дашборда по коллекциям
+    COUNTERS_RECONCILE_MIN = int(os.environ.get('COUNTERS_RECONCILE_MIN') or '60')
+    # Хранилище: mongo (MONGO_URL/DB_NAME) или sqlite (один файл, без mongod)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+    SQLITE_PATH = os.environ.get('SQLITE_PATH') or str(Path(__file__).parent.parent / 'support_ai_bot.db')
 
     @classmethod
     def has_telegram_creds(cls):
@@ -1,16 +1,329 @@
-import uuid
+import asyncio
+import logging
 from datetime import datetime, timezone, timedelta
 
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .config import BotConfig
+from .events import get_event_hub
+from .history_cache import get_history_cache
+from .search import parse_query, query_words, matches
+
+logger = logging.getLogger(__name__)
+
+
+COUNTERS_ID = "main"
+SNIPPET_CHARS = 120
+SEARCH_BATCH = 200
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class WriteBehindBuffer:
+    """Async write-behind queue for non-critical inserts.
+
+    Documents are queued per collection and written with `insert_many` once
+    `max_batch` documents are pending or every `flush_interval` seconds.
+    Flushes are serialized and batches are ordered, so documents of one
+    chat reach MongoDB in the order they were queued. `_id` is assigned
+    on enqueue, which makes a retried batch idempotent.
+
+    A batch being written stays visible through `pending()` until the
+    write returns, so readers never wait for the network: they merge
+    `pending()` with a query and drop documents seen twice by `_id`.
+
+    Besides inserts the buffer coalesces upserts by `_id` and `$inc`
+    deltas for the `counters` document; both are written after the
+    inserts of the same flush.
+    """
+
+    def __init__(self, db, max_batch=100, flush_interval=0.5, max_pending=10000):
+        self.db = db
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}  # collection name → [doc, ...]
+        self._inflight = {}  # пачка, которая сейчас пишется
+        self._count = 0
+        self._upserts = {}  # (collection, _id) → [update, counter]
+        self._counters = {}  # поле counters → дельта
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+
+    def add(self, collection_name, doc):
+        doc.setdefault("_id", ObjectId())
+        self._pending.setdefault(collection_name, []).append(doc)
+        self._count += 1
+        self._ensure_flusher()
+        if self._count >= self.max_batch:
+            self._wakeup.set()
+
+    def incr(self, field, amount=1):
+        """Queue an `$inc` of a field in the counters document."""
+        self._counters[field] = self._counters.get(field, 0) + amount
+        self._ensure_flusher()
+        # Дашборд применяет дельты к своим счётчикам без перечитывания
+        get_event_hub().publish("counters", {field: amount})
+
+    def upsert(self, collection_name, doc_id, update, count_new_as=None):
+        """Queue an upsert by `_id`; repeated updates of one doc are merged.
+
+        If `count_new_as` is given, that counter is incremented by the number
+        of documents this upsert actually created.
+        """
+        key = (collection_name, doc_id)
+        entry = self._upserts.get(key)
+        if entry is None:
+            self._upserts[key] = [update, count_new_as]
+        else:
+            _merge_update(entry[0], update)
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        if self._task is None or self._task.done():
+            # После close() фонового цикла нет — опоздавшие записи
+            # (бот ещё дописывает ответ) сбрасываем разовой задачей
+            self._task = asyncio.create_task(self._flush_late() if self._closed else self._run())
+
+    def pending_counters(self):
+        return dict(self._counters)
+
+    def pending(self, collection_name):
+        """Documents of a collection not yet confirmed written, oldest first.
+
+        Includes the batch in flight, so a document may also already be in
+        MongoDB — callers deduplicate by `_id`.
+        """
+        queued = self._pending.get(collection_name, [])
+        # Неудачный остаток пачки возвращается в очередь, пока она ещё в полёте
+        requeued = {d["_id"] for d in queued}
+        return [
+            d for d in self._inflight.get(collection_name, ()) if d["_id"] not in requeued
+        ] + queued
+
+    @property
+    def lock(self):
+        """Held while a flush runs; hold it to keep counter deltas from
+        being written (see `reconcile_counters`)."""
+        return self._lock
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed: {e}", exc_info=True)
+
+    async def _flush_late(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Write-behind: {self._count} docs queued after close not written: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            if not (self._count or self._upserts or self._counters):
+                return
+            batches, self._pending, self._count = self._pending, {}, 0
+            upserts, self._upserts = self._upserts, {}
+            self._inflight = batches
+            try:
+                for name, docs in batches.items():
+                    await self._write(name, docs)
+            finally:
+                self._inflight = {}
+            await self._write_upserts(upserts)
+            await self._write_counters()
+            self.flushes += 1
+
+    async def _write_upserts(self, upserts):
+        by_collection = {}
+        for key, (update, counter) in upserts.items():
+            by_collection.setdefault((key[0], counter), []).append(key)
+        for (name, counter), keys in by_collection.items():
+            ops = [UpdateOne({"_id": doc_id}, upserts[(name, doc_id)][0], upsert=True)
+                   for _, doc_id in keys]
+            try:
+                result = await self.db[name].bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # Остальные операции пачки применены — повторяем только ошибочные
+                failed = [keys[err["index"]] for err in e.details.get("writeErrors", [])]
+                self._requeue_upserts(upserts, failed)
+                created = e.details.get("nUpserted", 0)
+                if counter and created:
+                    self.incr(counter, created)
+                logger.warning(f"Write-behind upserts {name}: {len(failed)} requeued")
+                continue
+            except Exception as e:
+                # Сеть / primary недоступен: пачка, скорее всего, не применена.
+                # Если всё же применена, повтор задвоит $inc message_count: он лишь
+                # отбирает кандидатов в архив, total_messages сверка считает по коллекциям
+                self._requeue_upserts(upserts, keys)
+                logger.warning(f"Write-behind upserts {name}: {len(keys)} requeued: {e}")
+                continue
+            if counter and result.upserted_count:
+                self.incr(counter, result.upserted_count)
+
+    def _requeue_upserts(self, upserts, keys):
+        for key in keys:
+            update, counter = upserts[key]
+            newer = self._upserts.get(key)
+            # Более поздние обновления того же документа накладываем поверх
+            if newer is not None:
+                _merge_update(update, newer[0])
+            self._upserts[key] = [update, counter]
+
+    async def _write_counters(self):
+        deltas, self._counters = self._counters, {}
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas:
+            return
+        try:
+            await self.db.counters.update_one(
+                {"_id": COUNTERS_ID}, {"$inc": deltas}, upsert=True
+            )
+        except Exception as e:
+            for field, amount in deltas.items():
+                self._counters[field] = self._counters.get(field, 0) + amount
+            logger.warning(f"Write-behind counters requeued: {e}")
+
+    async def _write(self, name, docs):
+        for start in range(0, len(docs), self.max_batch):
+            chunk = docs[start:start + self.max_batch]
+            try:
+                await self.db[name].insert_many(chunk, ordered=True)
+                self.written += len(chunk)
+            except BulkWriteError as e:
+                # Всё до ошибочного документа записано, сам он отбрасывается,
+                # остаток ставим обратно. Дубль _id — документ уже записан
+                # прошлой попыткой, это не потеря
+                inserted = e.details.get("nInserted", 0)
+                errors = e.details.get("writeErrors", [])
+                self.written += inserted
+                if not (errors and errors[0].get("code") == 11000):
+                    self.dropped += 1
+                    logger.warning(f"Write-behind {name}: {errors[:1]}")
+                self._requeue(name, chunk[inserted + 1:] + docs[start + self.max_batch:])
+                return
+            except Exception as e:
+                # Сеть / primary недоступен — повторим при следующем сбросе
+                self._requeue(name, docs[start:])
+                logger.warning(f"Write-behind {name}: {len(docs) - start} docs requeued: {e}")
+                return
+
+    def _requeue(self, name, docs):
+        if not docs:
+            return
+        queue = docs + self._pending.get(name, [])
+        self._count += len(docs)
+        overflow = min(self._count - self.max_pending, len(queue))
+        if overflow > 0:
+            # Не даём очереди расти бесконечно при долгой недоступности БД
+            queue = queue[overflow:]
+            self._count -= overflow
+            self.dropped += overflow
+            logger.error(f"Write-behind {name}: dropped {overflow} oldest docs")
+        self._pending[name] = queue
+
+    async def close(self):
+        """Stop the background flusher and write everything still queued.
+
+        Documents queued after this are written by a one-off flush.
+        """
+        self._closed = True
+        self._wakeup.set()
+        if self._task and not self._task.done():
+            try:
+                await self._task
+            except Exception:
+                pass
+        # После ошибки часть пачки возвращается в очередь — даём ей пару попыток
+        for _ in range(3):
+            await self.flush()
+            if not (self._count or self._upserts or self._counters):
+                break
+        if self._count:
+            logger.error(f"Write-behind: {self._count} docs not written on shutdown")
+
+    @property
+    def stats(self):
+        return {
+            "pending": self._count + len(self._upserts),
+            "flushes": self.flushes,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+def _merge_update(target, update):
+    """Merge a MongoDB update document into another (same target doc)."""
+    for op, fields in update.items():
+        current = target.setdefault(op, {})
+        for field, value in fields.items():
+            if op == "$inc":
+                current[field] = current.get(field, 0) + value
+            elif op == "$setOnInsert":
+                current.setdefault(field, value)
+            elif op == "$max" and field in current:
+                current[field] = max(current[field], value)
+            elif op == "$min" and field in current:
+                current[field] = min(current[field], value)
+            else:
+                current[field] = value
+
+
+def _bson_time(dt):
+    """Datetime as MongoDB stores it: UTC, millisecond precision."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).replace(microsecond=dt.microsecond // 1000 * 1000)
+
+
+# Global instance — общий для BotDatabase сервера и бота
+_write_buffer = None
+
+
+def get_write_buffer(db) -> WriteBehindBuffer:
+    global _write_buffer
+    if _write_buffer is None:
+        _write_buffer = WriteBehindBuffer(
+            db,
+            max_batch=BotConfig.DB_FLUSH_BATCH,
+            flush_interval=BotConfig.DB_FLUSH_INTERVAL_MS / 1000,
+        )
+    return _write_buffer
+
 
 class BotDatabase:
+    """MongoDB storage. SQLiteDatabase (sqlite_database.py) implements the
+    same public methods; server.py and the bot only talk to this interface.
+    """
+
     def __init__(self, db):
         self.db = db
+        self.buffer = get_write_buffer(db)
+        self.buffer_messages = BotConfig.DB_BUFFER_MESSAGES
+        self.history_cache = get_history_cache()
         self.messages = db.messages
         self.silence_timers = db.silence_timers
         self.activity_log = db.activity_log
         self.bot_status = db.bot_status
         self.bot_config = db.bot_config
         self.media_templates = db.media_templates
+        self.screenshot_cache = db.screenshot_cache
+        self.voice_transcripts = db.voice_transcripts
 
     async def save_message(self, chat_id, role, text, username=None, has_image=False):
         doc = {
@@ -19,19 +332,92 @@ class BotDatabase:
             "text": text or "",
             "username": username,
             "has_image": has_image,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            # Сразу с точностью BSON: в кеше и в очереди то же время, что в базе
+            "timestamp": _bson_time(datetime.now(timezone.utc))
+        }
+        self.history_cache.append(doc["chat_id"], dict(doc))
+        if self.buffer_messages:
+            self.buffer.add("messages", doc)
+        else:
+            await self.messages.insert_one(doc)
+        self.buffer.incr("total_messages")
+        if has_image:
+            self.buffer.incr("total_images_analyzed")
+        # Сводка по чату; новый чат увеличит total_chats, когда upsert создаст документ
+        summary = {
+            "last_message_at": doc["timestamp"],
+            "last_snippet": doc["text"][:SNIPPET_CHARS],
+            "last_role": role,
         }
-        await self.messages.insert_one(doc)
+        if username:
+            summary["username"] = username
+        self.buffer.upsert(
+            "conversations", doc["chat_id"],
+            {
+                "$setOnInsert": {"first_message_at": doc["timestamp"]},
+                "$set": summary,
+                "$inc": {"message_count": 1},
+            },
+            count_new_as="total_chats",
+        )
+        get_event_hub().publish("conversation", {"chat_id": doc["chat_id"], **summary})
 
     async def get_history(self, chat_id, limit=20):
-        messages = await self.messages.find(
-            {"chat_id": str(chat_id)},
-            {"_id": 0}
-        ).sort("timestamp", -1).limit(limit).to_list(limit)
-        return list(reversed(messages))
+        chat_id = str(chat_id)
+        cached = self.history_cache.get(chat_id, limit)
+        if cached is not None:
+            return cached
+        self.history_cache.begin_fill(chat_id)
+        # Ещё не подтверждённые сообщения чата — самые новые, дописываем их в конец.
+        # Снимок берём до запроса: записанное после него найдёт сам запрос,
+        # а попавшее и туда, и туда отсеем по _id
+        queued = [m for m in self.buffer.pending("messages") if m["chat_id"] == chat_id][-limit:]
+        queued_ids = {m["_id"] for m in queued}
+        messages = []
+        if len(queued) < limit:
+            messages = await self.messages.find(
+                {"chat_id": chat_id}
+            ).sort([("timestamp", -1), ("_id", -1)]).limit(limit).to_list(limit)
+        history = [
+            m for m in reversed(messages) if m["_id"] not in queued_ids
+        ] + queued
+        history = [{k: v for k, v in m.items() if k != "_id"} for m in history[-limit:]]
+        self.history_cache.fill(chat_id, history, limit)
+        return list(history)
+
+    async def get_conversations(self, limit=50, before=None):
+        """Conversations ordered by last activity, newest first.
+
+        `before` is a (last_message_at, chat_id) keyset cursor from the
+        previous page. Silence state is joined with a single `$in` query.
+        """
+        query = {}
+        if before:
+            last_at, chat_id = before
+            query = {"$or": [
+                {"last_message_at": {"$lt": last_at}},
+                {"last_message_at": last_at, "_id": {"$lt": chat_id}},
+            ]}
+        convos = await self.db.conversations.find(query, {"archive_segments": 0}).sort(
+            [("last_message_at", -1), ("_id", -1)]
+        ).limit(limit).to_list(limit)
+        if not convos:
+            return []
+
+        now = datetime.now(timezone.utc)
+        silenced = {
+            t["chat_id"] async for t in self.silence_timers.find(
+                {"chat_id": {"$in": [c["_id"] for c in convos]}, "expires_at": {"$gt": now}},
+                {"_id": 0, "chat_id": 1}
+            )
+        }
+        for c in convos:
+            c["chat_id"] = c.pop("_id")
+            c["is_silenced"] = c["chat_id"] in silenced
+        return convos
 
     async def is_silenced(self, chat_id):
-        now = datetime.now(timezone.utc).isoformat()
+        now = datetime.now(timezone.utc)
         timer = await self.silence_timers.find_one(
             {"chat_id": str(chat_id), "expires_at": {"$gt": now}},
             {"_id": 0}
@@ -42,19 +428,136 @@ class BotDatabase:
         expires = datetime.now(timezone.utc) + timedelta(minutes=duration_min)
         await self.silence_timers.update_one(
             {"chat_id": str(chat_id)},
-            {"$set": {"expires_at": expires.isoformat()}},
+            {"$set": {"expires_at": expires}},
             upsert=True
         )
+        get_event_hub().publish("silence", {"chat_id": str(chat_id), "expires_at": expires})
 
     async def log_activity(self, event_type, chat_id=None, details="", username=None):
-        await self.activity_log.insert_one({
-            "id": str(uuid.uuid4()),
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+        if event_type == "media_sent":
+            self.buffer.incr("total_media_sent")
+        # ObjectId в hex растёт со временем — тай-брейк для keyset-курсора
+        # среди записей одной миллисекунды
+        oid = ObjectId()
+        entry = {
+            "id": str(oid),
+            # Точность BSON: курсор (timestamp, id), взятый с ещё не сброшенной
+            # записи, иначе вернул бы её же со следующей страницей
+            "timestamp": _bson_time(datetime.now(timezone.utc)),
             "event_type": event_type,
             "chat_id": chat_id,
             "username": username,
             "details": details
-        })
+        }
+        get_event_hub().publish("activity", entry)
+        self.buffer.add("activity_log", dict(entry, _id=oid))
+        # Почасовые агрегаты переживают TTL сырых записей
+        hour = entry["timestamp"].replace(minute=0, second=0, microsecond=0)
+        self.buffer.upsert(
+            "activity_rollups", f"{hour:%Y-%m-%dT%H}|{event_type}",
+            {
+                "$setOnInsert": {"hour": hour, "event_type": event_type},
+                "$inc": {"count": 1},
+            },
+        )
+
+    async def get_activity(self, limit=100, before=None, event_type=None,
+                           chat_id=None, since=None, until=None):
+        """Activity entries, newest first, with keyset pagination.
+
+        `before` is the (timestamp, id) of the last entry of the previous
+        page. Entries still queued in the write-behind buffer are merged in.
+        """
+        query = {}
+        if event_type:
+            query["event_type"] = {"$in": event_type} if isinstance(event_type, list) else event_type
+        if chat_id:
+            query["chat_id"] = str(chat_id)
+        if since or until:
+            query["timestamp"] = {}
+            if since:
+                query["timestamp"]["$gte"] = since
+            if until:
+                query["timestamp"]["$lt"] = until
+        if before:
+            ts, entry_id = before
+            query["$or"] = [
+                {"timestamp": {"$lt": ts}},
+                {"timestamp": ts, "id": {"$lt": entry_id}},
+            ]
+
+        def matches(entry):
+            if event_type and entry["event_type"] not in (
+                event_type if isinstance(event_type, list) else [event_type]
+            ):
+                return False
+            if chat_id and entry["chat_id"] != str(chat_id):
+                return False
+            if since and entry["timestamp"] < since:
+                return False
+            if before and (entry["timestamp"], entry["id"]) >= tuple(before):
+                return False
+            return not (until and entry["timestamp"] >= until)
+
+        # Очередь нужна и на следующих страницах: курсор мог прийти с записи,
+        # которую ещё не сбросили, и за ней в очереди есть более старые
+        queued = [
+            {k: v for k, v in e.items() if k != "_id"}
+            for e in reversed(self.buffer.pending("activity_log")) if matches(e)
+        ][:limit]
+        # Пачка в полёте может быть уже записана — повторы отсеиваем по id
+        queued_ids = {e["id"] for e in queued}
+        entries = []
+        if len(queued) < limit:
+            entries = await self.activity_log.find(query, {"_id": 0}).sort(
+                [("timestamp", -1), ("id", -1)]
+            ).limit(limit).to_list(limit)
+        merged = queued + [e for e in entries if e["id"] not in queued_ids]
+        merged.sort(key=lambda e: (e["timestamp"], e["id"]), reverse=True)
+        return merged[:limit]
+
+    async def get_activity_rollups(self, since, until=None, event_type=None):
+        query = {"hour": {"$gte": since}}
+        if until:
+            query["hour"]["$lt"] = until
+        if event_type:
+            query["event_type"] = event_type
+        return await self.db.activity_rollups.find(query, {"_id": 0}).sort(
+            "hour", 1
+        ).to_list(None)
+
+    async def load_screenshot_hashes(self, limit):
+        return await self.screenshot_cache.find(
+            {}, {"_id": 0, "hash": 1, "fine": 1, "analysis": 1}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+
+    async def save_screenshot_analysis(self, image_hash, fine_hash, analysis):
+        await self.screenshot_cache.update_one(
+            # Один грубый хеш может быть у разных скриншотов — ключ по обоим
+            {"hash": image_hash, "fine": fine_hash},
+            {"$set": {
+                "analysis": analysis,
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
+
+    async def get_cached_transcript(self, file_unique_id):
+        doc = await self.voice_transcripts.find_one(
+            {"file_unique_id": file_unique_id}, {"_id": 0, "text": 1}
+        )
+        return doc["text"] if doc else None
+
+    async def cache_transcript(self, file_unique_id, text, model_id):
+        await self.voice_transcripts.update_one(
+            {"file_unique_id": file_unique_id},
+            {"$set": {
+                "text": text,
+                "model_id": model_id,
+                "created_at": datetime.now(timezone.utc)
+            }},
+            upsert=True
+        )
 
     async def update_bot_status(self, is_running, started_at=None):
         update = {"is_running": is_running}
@@ -65,6 +568,7 @@ class BotDatabase:
             {"$set": update},
             upsert=True
         )
+        get_event_hub().publish("status", update)
 
     async def set_auth_state(self, state):
         """Track auth flow state: none, code_sent, authorized"""
@@ -73,6 +577,7 @@ class BotDatabase:
             {"$set": {"auth_state": state}},
             upsert=True
         )
+        get_event_hub().publish("status", {"auth_state": state})
 
     async def get_auth_state(self):
         doc = await self.bot_status.find_one({"_id": "main"}, {"_id": 0})
@@ -83,16 +588,408 @@ class BotDatabase:
         return doc or {"is_running": False}
 
     async def get_stats(self):
-        total_messages = await self.messages.count_documents({})
-        total_chats = len(await self.messages.distinct("chat_id"))
-        total_images = await self.messages.count_documents({"has_image": True})
-        total_media_sent = await self.activity_log.count_documents({"event_type": "media_sent"})
-        now = datetime.now(timezone.utc).isoformat()
+        """Dashboard counters: one document read plus an indexed count of
+        active silences (TTL keeps that collection small)."""
+        counters = await self.db.counters.find_one({"_id": COUNTERS_ID}) or {}
+        pending = self.buffer.pending_counters()
+        now = datetime.now(timezone.utc)
         silenced_count = await self.silence_timers.count_documents({"expires_at": {"$gt": now}})
+
+        def total(field):
+            return counters.get(field, 0) + pending.get(field, 0)
+
         return {
-            "total_messages": total_messages,
-            "total_chats": total_chats,
-            "total_images_analyzed": total_images,
-            "total_media_sent": total_media_sent,
+            "total_messages": total("total_messages"),
+            "total_chats": total("total_chats"),
+            "total_images_analyzed": total("total_images_analyzed"),
+            "total_media_sent": total("total_media_sent"),
             "silenced_chats": silenced_count
         }
+
+    async def reconcile_counters(self):
+        """Recount the counters document from the collections.
+
+        Runs periodically to repair drift (lost flushes, manual edits).
+        activity_log is pruned by TTL, so media_sent is only ever raised.
+        """
+        await self.buffer.flush()
+        async with self.buffer.lock:
+            # Под блокировкой сброс не идёт: дельты, накопленные в памяти,
+            # ещё не учтены ни в коллекциях, ни в счётчиках
+            # Архивные сообщения тоже входят в total_messages
+            total_messages = await self.messages.estimated_document_count()
+            archived = await self.db.conversations.aggregate([
+                {"$match": {"archived_count": {"$gt": 0}}},
+                {"$group": {"_id": None, "n": {"$sum": "$archived_count"}}},
+            ]).to_list(1)
+            total_messages += archived[0]["n"] if archived else 0
+            total_chats = await self.db.conversations.estimated_document_count()
+            total_images = await self.messages.count_documents({"has_image": True})
+            archived_images = await self.db.conversations.aggregate([
+                {"$match": {"archived_images": {"$gt": 0}}},
+                {"$group": {"_id": None, "n": {"$sum": "$archived_images"}}},
+            ]).to_list(1)
+            total_images += archived_images[0]["n"] if archived_images else 0
+            media_sent = await self.activity_log.count_documents({"event_type": "media_sent"})
+            before = await self.db.counters.find_one_and_update(
+                {"_id": COUNTERS_ID},
+                {
+                    "$set": {
+                        "total_messages": total_messages,
+                        "total_chats": total_chats,
+                        "total_images_analyzed": total_images,
+                        "reconciled_at": datetime.now(timezone.utc),
+                    },
+                    "$max": {"total_media_sent": media_sent},
+                },
+                upsert=True,
+            ) or {}
+        drift = {
+            k: v - before.get(k, 0) for k, v in
+            (("total_messages", total_messages), ("total_chats", total_chats))
+            if before.get(k, 0) != v
+        }
+        if drift and before:
+            logger.info(f"Сверка счётчиков: расхождение {drift}")
+            get_event_hub().publish("status", {})
+
+    async def search_messages(self, query, limit=20, before=None, chat_id=None, max_scan=2000):
+        """Messages containing every word of `query`, newest first.
+
+        The text index yields candidates (any word, whole words only — see
+        bot.search for how this differs from SQLite); bot.search keeps those
+        that contain all words. One query per call reads at most `max_scan`
+        newest candidates (a bounded top-k sort) through a single cursor.
+        When that budget runs out first the page comes back short but still
+        carries next_before: older matches may exist, nothing is dropped.
+        Returns (messages, next_before); next_before is None at the end.
+        """
+        stems = parse_query(query)
+        if not stems:
+            return [], None
+        base = {"$text": {"$search": query_words(query)}}
+        if chat_id:
+            base["chat_id"] = str(chat_id)
+        if before:
+            try:
+                before = (before[0], ObjectId(before[1]))
+            except InvalidId:
+                raise ValueError("Невалидный курсор")
+            ts, oid = before
+            base["$or"] = [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lt": oid}}]
+        # Сортировка по времени при $text идёт в памяти; с limit это top-k
+        # на max_scan документов, и выполняется она один раз за вызов
+        cursor = self.messages.find(base).sort(
+            [("timestamp", -1), ("_id", -1)]
+        ).limit(max_scan).batch_size(SEARCH_BATCH)
+        hits, scanned = [], 0
+        try:
+            async for doc in cursor:
+                scanned += 1
+                before = (doc["timestamp"], doc["_id"])
+                if matches(doc.get("text"), stems):
+                    doc["id"] = str(doc.pop("_id"))
+                    hits.append(doc)
+                    if len(hits) == limit:
+                        return hits, (before[0], str(before[1]))
+        finally:
+            await cursor.close()
+        if scanned < max_scan:
+            return hits, None
+        return hits, (before[0], str(before[1]))
+
+    # ── Архив старых сообщений ────────────────────────────
+
+    async def get_archive_candidates(self, cutoff, keep, limit=100):
+        """Chats with more than `keep` hot messages, some possibly older than cutoff."""
+        docs = await self.db.conversations.find(
+            {
+                "first_message_at": {"$lt": cutoff},
+                "$or": [{"archived_until": {"$exists": False}}, {"archived_until": {"$lt": cutoff}}],
+                "$expr": {"$gt": [
+                    {"$subtract": ["$message_count", {"$ifNull": ["$archived_count", 0]}]}, keep
+                ]},
+            },
+            {"_id": 1},
+        ).limit(limit).to_list(limit)
+        return [d["_id"] for d in docs]
+
+    async def get_archivable_messages(self, chat_id, cutoff, keep, limit=5000):
+        """Oldest hot messages older than cutoff, never touching the last `keep`."""
+        chat_id = str(chat_id)
+        boundary = await self.messages.find(
+            {"chat_id": chat_id}, {"timestamp": 1}
+        ).sort([("timestamp", -1), ("_id", -1)]).skip(keep).limit(1).to_list(1)
+        if not boundary:
+            return []
+        ts, oid = boundary[0]["timestamp"], boundary[0]["_id"]
+        docs = await self.messages.find({
+            "chat_id": chat_id,
+            "timestamp": {"$lt": cutoff},
+            "$or": [{"timestamp": {"$lt": ts}}, {"timestamp": ts, "_id": {"$lte": oid}}],
+        }).sort([("timestamp", 1), ("_id", 1)]).limit(limit).to_list(limit)
+        for d in docs:
+            d["id"] = str(d.pop("_id"))
+        return docs
+
+    async def commit_archive_segment(self, chat_id, segment, ids):
+        """Record a written segment in the conversation, then drop its messages.
+
+        Without a transaction the two steps can be split by a crash: the
+        segment is pushed marked `pending` and unmarked once its messages
+        are gone, and the push is skipped if the file is already listed,
+        so the archiver can safely repeat the call (see
+        `get_pending_archive_chats`).
+        """
+        chat_id = str(chat_id)
+        await self.db.conversations.update_one(
+            {"_id": chat_id, "archive_segments.file": {"$ne": segment["file"]}},
+            {
+                "$push": {"archive_segments": dict(segment, pending=True)},
+                "$inc": {
+                    "archived_count": segment["count"],
+                    "archived_images": segment.get("images", 0),
+                },
+                "$max": {"archived_until": segment["last_at"]},
+            },
+        )
+        await self.messages.delete_many({"_id": {"$in": [ObjectId(i) for i in ids]}})
+        await self.db.conversations.update_one(
+            {"_id": chat_id, "archive_segments.file": segment["file"]},
+            {"$unset": {"archive_segments.$.pending": ""}},
+        )
+        self.history_cache.invalidate(chat_id)
+
+    async def get_pending_archive_chats(self):
+        """Chats with a segment whose messages may still be hot."""
+        docs = await self.db.conversations.find(
+            {"archive_segments.pending": True}, {"_id": 1}
+        ).to_list(None)
+        return [d["_id"] for d in docs]
+
+    async def get_archive_segments(self, chat_id):
+        doc = await self.db.conversations.find_one(
+            {"_id": str(chat_id)}, {"_id": 0, "archive_segments": 1}
+        )
+        return (doc or {}).get("archive_segments", [])
+
+    # ── Документы настроек ────────────────────────────────
+    # bot_config, custom_prompt, ai_settings, voice_settings, telegram_creds,
+    # style_profile, bot_status, auth_config — по одному документу на _id
+
+    async def get_doc(self, collection, doc_id="main"):
+        return await self.db[collection].find_one({"_id": doc_id}, {"_id": 0})
+
+    async def update_doc(self, collection, fields=None, doc_id="main",
+                         unset=None, set_on_insert=None, upsert=True):
+        update = {}
+        if fields:
+            update["$set"] = fields
+        if unset:
+            update["$unset"] = {k: "" for k in unset}
+        if set_on_insert:
+            update["$setOnInsert"] = set_on_insert
+        if update:
+            await self.db[collection].update_one({"_id": doc_id}, update, upsert=upsert)
+
+    async def delete_doc(self, collection, doc_id="main"):
+        await self.db[collection].delete_one({"_id": doc_id})
+
+    async def clear_docs(self, collection):
+        await self.db[collection].delete_many({})
+
+    # ── Правила медиа ─────────────────────────────────────
+
+    async def get_media_rules(self, tags=None):
+        query = {"tag": {"$in": list(tags)}} if tags is not None else {}
+        return await self.db.media_rules.find(query, {"_id": 0}).to_list(None)
+
+    async def save_media_rule(self, tag, description):
+        await self.db.media_rules.update_one(
+            {"tag": tag},
+            {"$set": {"tag": tag, "description": description}},
+            upsert=True
+        )
+
+    async def delete_media_rule(self, tag):
+        await self.db.media_rules.delete_one({"tag": tag})
+
+    # ── Обучающие пары ────────────────────────────────────
+
+    async def count_training_pairs(self):
+        return await self.db.training_data.count_documents({})
+
+    async def upsert_training_pairs(self, pairs):
+        """Store pairs whose content `hash` is new; returns the stored ones."""
+        if not pairs:
+            return []
+        result = await self.db.training_data.bulk_write(
+            [UpdateOne({"hash": p["hash"]}, {"$setOnInsert": p}, upsert=True) for p in pairs],
+            ordered=False,
+        )
+        return [pairs[i] for i in sorted(result.upserted_ids)]
+
+    async def clear_training_pairs(self):
+        await self.db.training_data.delete_many({})
+
+    # ── Чекпоинты сканирования ────────────────────────────
+    # По документу на чат: до какого сообщения история уже разобрана
+
+    async def get_scan_checkpoints(self):
+        return {d.pop("_id"): d async for d in self.db.scan_checkpoints.find({})}
+
+    async def save_scan_checkpoints(self, checkpoints):
+        if checkpoints:
+            await self.db.scan_checkpoints.bulk_write([
+                UpdateOne({"_id": chat_id}, {"$set": cp}, upsert=True)
+                for chat_id, cp in checkpoints.items()
+            ], ordered=False)
+
+    async def clear_scan_checkpoints(self):
+        await self.db.scan_checkpoints.delete_many({})
+
+    # ── Экспорт и импорт ──────────────────────────────────
+
+    async def iter_conversation_ids(self, batch_size=1000):
+        cursor = self.db.conversations.find({}, {"_id": 1}).sort("_id", 1).batch_size(batch_size)
+        async for doc in cursor:
+            yield doc["_id"]
+
+    async def iter_chat_messages(self, chat_id, batch_size=1000):
+        """Hot messages of a chat, oldest first, streamed from the cursor."""
+        cursor = self.messages.find({"chat_id": str(chat_id)}).sort(
+            [("timestamp", 1), ("_id", 1)]
+        ).batch_size(batch_size)
+        async for doc in cursor:
+            doc["id"] = str(doc.pop("_id"))
+            yield doc
+
+    async def iter_training_pairs(self, batch_size=1000):
+        async for doc in self.db.training_data.find({}, {"_id": 0}).batch_size(batch_size):
+            yield doc
+
+    async def import_messages(self, messages):
+        """Bulk insert of exported messages; returns the number inserted.
+
+        Messages already present (same _id, or same chat/time/role/text)
+        are skipped, and so is anything at or before the chat's
+        archived_until: those live in archive segments, which the export
+        includes. Importing one file twice changes nothing.
+        Conversation summaries and counters are folded in per chat.
+        """
+        if not messages:
+            return 0
+        archived = {
+            d["_id"]: d["archived_until"]
+            async for d in self.db.conversations.find(
+                {
+                    "_id": {"$in": list({m["chat_id"] for m in messages})},
+                    "archived_until": {"$ne": None},
+                },
+                {"archived_until": 1},
+            )
+        }
+        existing = set()
+        async for d in self.messages.find(
+            {
+                "chat_id": {"$in": list({m["chat_id"] for m in messages})},
+                "timestamp": {"$in": list({m["timestamp"] for m in messages})},
+            },
+            {"chat_id": 1, "timestamp": 1, "role": 1, "text": 1},
+        ):
+            existing.add((d["chat_id"], _bson_time(d["timestamp"]), d.get("role"), d.get("text")))
+
+        docs = []
+        for m in messages:
+            key = (m["chat_id"], _bson_time(m["timestamp"]), m["role"], m["text"])
+            if key in existing:
+                continue
+            if m["chat_id"] in archived and key[1] <= archived[m["chat_id"]]:
+                continue
+            existing.add(key)
+            doc = {k: m[k] for k in ("chat_id", "role", "text", "username", "has_image", "timestamp")}
+            if ObjectId.is_valid(m.get("id") or ""):
+                doc["_id"] = ObjectId(m["id"])
+            docs.append(doc)
+        if not docs:
+            return 0
+
+        failed = set()
+        try:
+            await self.messages.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Дубликаты _id (сообщение уже импортировано) — пропускаем, остальное записано
+            errors = e.details.get("writeErrors", [])
+            other = [err for err in errors if err.get("code") != 11000]
+            if other:
+                raise
+            failed = {err["index"] for err in errors}
+        inserted = [d for i, d in enumerate(docs) if i not in failed]
+        if not inserted:
+            return 0
+
+        by_chat = {}
+        for d in inserted:
+            by_chat.setdefault(d["chat_id"], []).append(d)
+        ops = []
+        for chat_id, msgs in by_chat.items():
+            first = min(m["timestamp"] for m in msgs)
+            last = sorted(msgs, key=lambda m: m["timestamp"])[-1]
+            newer = {"$gt": [last["timestamp"], {"$ifNull": ["$last_message_at", EPOCH]}]}
+            username = next((m["username"] for m in reversed(msgs) if m.get("username")), None)
+            ops.append(UpdateOne({"_id": chat_id}, [{"$set": {
+                "first_message_at": {"$min": ["$first_message_at", first]},
+                "last_message_at": {"$max": ["$last_message_at", last["timestamp"]]},
+                "last_snippet": {"$cond": [newer, last["text"][:SNIPPET_CHARS], "$last_snippet"]},
+                "last_role": {"$cond": [newer, last["role"], "$last_role"]},
+                "username": {"$ifNull": ["$username", username]},
+                "message_count": {"$add": [{"$ifNull": ["$message_count", 0]}, len(msgs)]},
+            }}], upsert=True))
+        result = await self.db.conversations.bulk_write(ops, ordered=False)
+
+        self.buffer.incr("total_messages", len(inserted))
+        self.buffer.incr("total_chats", result.upserted_count)
+        images = sum(1 for d in inserted if d["has_image"])
+        if images:
+            self.buffer.incr("total_images_analyzed", images)
+        for chat_id in by_chat:
+            self.history_cache.invalidate(chat_id)
+        return len(inserted)
+
+    async def import_training_pairs(self, pairs):
+        if not pairs:
+            return 0
+        from .dedup import pair_hash
+        # Копии: insert_many дописывает _id в переданные словари. Паре без
+        # хеша (старый экспорт) считаем его, иначе повторный импорт её задвоит
+        docs = [
+            p if p.get("hash") else dict(p, hash=pair_hash(
+                p.get("chat_id", ""), p["user_message"], p["admin_response"]
+            ))
+            for p in pairs
+        ]
+        try:
+            result = await self.db.training_data.insert_many([dict(d) for d in docs], ordered=False)
+            return len(result.inserted_ids)
+        except BulkWriteError as e:
+            # Пара с тем же хешем уже есть
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+            return e.details.get("nInserted", 0)
+
+    # ── Жизненный цикл ────────────────────────────────────
+
+    async def migrate(self):
+        """Apply schema migrations; returns the schema version."""
+        from .migrations import run_migrations, sync_ttl_settings
+        version = await run_migrations(self.db)
+        await sync_ttl_settings(self.db)
+        return version
+
+    async def flush(self):
+        await self.buffer.flush()
+
+    async def close(self):
+        # Дописываем отложенные записи до закрытия соединения
+        await self.buffer.close()
+        self.db.client.close()
@@ -0,0 +1,84 @@
+import json
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def format_sse(event_type, data):
+    """Encode one Server-Sent Events frame."""
+    payload = json.dumps(data, default=_json_default, ensure_ascii=False)
+    return f"event: {event_type}\ndata: {payload}\n\n"
+
+
+class EventHub:
+    """In-process pub/sub feeding the dashboard event stream.
+
+    Every subscriber gets a bounded queue. A subscriber that falls behind
+    is not allowed to block publishers: its backlog is dropped and replaced
+    with a single `resync` event, after which the client refetches.
+    """
+
+    def __init__(self, queue_size=200):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self.versions = {}  # ресурс → номер версии (для ETag)
+        self.published = 0
+        self.resyncs = 0
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event_type, data=None):
+        if not self._subscribers:
+            return
+        self.published += 1
+        event = (event_type, data if data is not None else {})
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Медленный клиент: выбрасываем очередь, пусть перечитает всё
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(("resync", {}))
+                self.resyncs += 1
+
+    def bump(self, resource):
+        """Mark a resource as changed: new ETag version plus an `invalidate` event."""
+        self.versions[resource] = self.versions.get(resource, 0) + 1
+        self.publish("invalidate", {"resource": resource})
+
+    def version(self, resource):
+        return self.versions.get(resource, 0)
+
+    @property
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "resyncs": self.resyncs,
+        }
+
+
+# Global instance
+_event_hub = None
+
+
+def get_event_hub() -> EventHub:
+    global _event_hub
+    if _event_hub is None:
+        _event_hub = EventHub()
+    return _event_hub
@@ -72,6 +72,18 @@ def get_model_ids(provider):
     return models
 
 
+def _prior_history(messages_history, user_text):
+    """History without the current user turn.
+
+    The caller saves the incoming message before reading history, so it is
+    already the last entry — and it is also sent separately as user_text.
+    """
+    history = list(messages_history or [])
+    if history and history[-1].get("role") == "user" and history[-1].get("text") == user_text:
+        history.pop()
+    return history
+
+
 class AIClient:
     def __init__(self, provider="gemini", model=None, api_key=None, temperature=0.7):
         self.provider = provider
@@ -125,9 +137,10 @@ class AIClient:
             raise ValueError(f"Ошибка инициализации Gemini: {str(e)[:100]}")
 
         # Собираем контекст переписки
-        if messages_history and len(messages_history) > 1:
+        prior = _prior_history(messages_history, user_text)
+        if prior:
             context_parts = []
-            for msg in messages_history[:-1]:
+            for msg in prior:
                 role = "Пользователь" if msg["role"] == "user" else "Ты"
                 context_parts.append(f"{role}: {msg['text']}")
             context_str = "\n".join(context_parts)
@@ -296,7 +309,7 @@ class AIClient:
         enhanced_system = system_prompt + "\n\nВАЖНО: Если в истории диалога уже были приветствия — НЕ здоровайся повторно. Продолжай разговор естественно."
 
         messages = [{"role": "system", "content": enhanced_system}]
-        for msg in messages_history:
+        for msg in _prior_history(messages_history, user_text):
             messages.append({
                 "role": "user" if msg["role"] == "user" else "assistant",
                 "content": msg["text"]
@@ -369,7 +382,7 @@ class AIClient:
         enhanced_system = system_prompt + "\n\nВАЖНО: Если в истории диалога уже были приветствия — НЕ здоровайся повторно. Продолжай разговор естественно."
 
         messages = [{"role": "system", "content": enhanced_system}]
-        for msg in messages_history:
+        for msg in _prior_history(messages_history, user_text):
             messages.append({
                 "role": "user" if msg["role"] == "user" else "assistant",
                 "content": msg["text"]
@@ -0,0 +1,137 @@
+from collections import OrderedDict, deque
+
+# Примерная цена одного сообщения в памяти сверх текста (dict, datetime, строки)
+MESSAGE_OVERHEAD = 400
+
+
+def _message_size(msg):
+    return MESSAGE_OVERHEAD + len(msg.get("text") or "")
+
+
+class _ChatHistory:
+    __slots__ = ("messages", "complete", "size")
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)
+        # True — в кольце вся история чата (в БД сообщений не больше)
+        self.complete = False
+        self.size = 0
+
+
+class HistoryCache:
+    """Per-chat ring buffers of recent turns with LRU eviction across chats.
+
+    A chat is filled from the database on first `get_history` and then kept
+    current write-through by `save_message`, so the reply path reads memory.
+    Chats that are not cached are not filled by writes. A fill that raced
+    with a write for the same chat is discarded rather than cached stale.
+    """
+
+    def __init__(self, capacity=20, max_bytes=32 * 1024 * 1024):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()  # chat_id → _ChatHistory, от старых к свежим
+        self._loading = {}  # chat_id → была ли запись во время загрузки
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, chat_id, limit):
+        """Last `limit` messages, oldest first, or None when a DB read is needed."""
+        chat = self._chats.get(chat_id)
+        if chat is None or (len(chat.messages) < limit and not chat.complete):
+            self.misses += 1
+            return None
+        self._chats.move_to_end(chat_id)
+        self.hits += 1
+        if limit >= len(chat.messages):
+            return list(chat.messages)
+        return list(chat.messages)[-limit:]
+
+    def begin_fill(self, chat_id):
+        self._loading[chat_id] = False
+
+    def fill(self, chat_id, messages, limit):
+        """Store messages read from the database (oldest first, at most `limit`)."""
+        stale = self._loading.pop(chat_id, True)
+        if stale:
+            return
+        chat = _ChatHistory(max(self.capacity, limit))
+        chat.complete = len(messages) < limit
+        self._drop(chat_id)
+        self._chats[chat_id] = chat
+        for msg in messages:
+            self._push(chat, msg)
+        self._evict()
+
+    def append(self, chat_id, msg):
+        """Write-through from save_message."""
+        if chat_id in self._loading:
+            self._loading[chat_id] = True
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        self._push(chat, msg)
+        self._chats.move_to_end(chat_id)
+        self._evict()
+
+    def invalidate(self, chat_id=None):
+        if chat_id is None:
+            self._chats.clear()
+            self.bytes = 0
+            for key in self._loading:
+                self._loading[key] = True
+            return
+        self._drop(chat_id)
+        if chat_id in self._loading:
+            self._loading[chat_id] = True
+
+    def _push(self, chat, msg):
+        if len(chat.messages) == chat.messages.maxlen:
+            dropped = chat.messages[0]
+            chat.size -= _message_size(dropped)
+            self.bytes -= _message_size(dropped)
+            chat.complete = False
+        chat.messages.append(msg)
+        chat.size += _message_size(msg)
+        self.bytes += _message_size(msg)
+
+    def _drop(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self.bytes -= chat.size
+
+    def _evict(self):
+        # Самый свежий чат не вытесняем, даже если он один больше лимита
+        while self.bytes > self.max_bytes and len(self._chats) > 1:
+            chat_id = next(iter(self._chats))
+            self._drop(chat_id)
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "chats": len(self._chats),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+# Global instance
+_history_cache = None
+
+
+def get_history_cache() -> HistoryCache:
+    global _history_cache
+    if _history_cache is None:
+        from .config import BotConfig
+        _history_cache = HistoryCache(
+            capacity=BotConfig.HISTORY_LIMIT,
+            max_bytes=BotConfig.HISTORY_CACHE_MB * 1024 * 1024,
+        )
+    return _history_cache
@@ -0,0 +1,203 @@
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 16  # 16x16 dHash → 256 бит, для поиска кандидатов
+FINE_HASH_SIZE = 32  # 32x32 → 1024 бита, подтверждение «тот же скриншот»
+
+
+def _dhash_bits(img, hash_size):
+    import numpy as np
+    from PIL import Image
+
+    small = img.resize((hash_size + 1, hash_size), Image.Resampling.LANCZOS)
+    pixels = np.asarray(small, dtype=np.int16)
+    diff = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(diff.flatten()).tobytes(), "big")
+
+
+def dhash(source, hash_size=HASH_SIZE):
+    """Perceptual difference hash of an image (path, bytes or file object).
+
+    Image is downscaled to (hash_size + 1) x hash_size grayscale, every bit
+    says whether a pixel is brighter than its right neighbour.
+    """
+    return image_fingerprint(source, sizes=(hash_size,))[0]
+
+
+def image_fingerprint(source, sizes=(HASH_SIZE, FINE_HASH_SIZE)):
+    """dHashes of several sizes computed from a single decode."""
+    from PIL import Image
+
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        gray = img.convert("L")
+    return tuple(_dhash_bits(gray, size) for size in sizes)
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes with Hamming distance.
+
+    A node holds every value added under its hash, keyed by `key` (adding
+    the same hash and key again replaces the value).
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, h, key, value):
+        if self._root is None:
+            self._root = (h, {key: value}, {})
+            self._size = 1
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                if key not in node[1]:
+                    self._size += 1
+                node[1][key] = value
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (h, {key: value}, {})
+                self._size += 1
+                return
+            node = child
+
+    def within(self, h, max_distance):
+        """Return [(key, value, distance)] of every entry within max_distance."""
+        found = []
+        if self._root is None:
+            return found
+        stack = [self._root]
+        while stack:
+            node_hash, values, children = stack.pop()
+            d = hamming(h, node_hash)
+            if d <= max_distance:
+                found.extend((key, value, d) for key, value in values.items())
+            # Неравенство треугольника: нужны только дети в [d - r, d + r]
+            for child_d, child in children.items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        return found
+
+
+class ScreenshotCache:
+    """Near-duplicate screenshot cache: dHash → description of the screenshot.
+
+    The cached value is a neutral, chat-independent description of what
+    the screenshot shows (the error text, the screen), never a reply to a
+    customer: every chat builds its own reply from it.
+
+    Candidates are found by the coarse hash in a BK-tree (≤ near_distance).
+    A match is «exact» only when the fine hash also agrees within
+    exact_distance — then the description is reused without a vision call;
+    otherwise it is passed to the vision call as a hint. Entries are
+    persisted through BotDatabase and reloaded on first use.
+    """
+
+    def __init__(self, exact_distance=8, near_distance=20, max_entries=5000):
+        self.exact_distance = exact_distance
+        self.near_distance = near_distance
+        self.max_entries = max_entries
+        self._tree = BKTree()
+        self._entries = []
+        self._loaded = False
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.vision_calls_saved = 0
+
+    async def ensure_loaded(self, database):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            docs = await database.load_screenshot_hashes(self.max_entries)
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить кэш скриншотов: {e}")
+            return
+        # Документы приходят от новых к старым — добавляем старые первыми
+        for doc in reversed(docs):
+            if not doc.get("fine"):
+                continue
+            self._insert(int(doc["hash"], 16), int(doc["fine"], 16), doc.get("analysis", ""))
+        logger.info(f"Кэш скриншотов загружен: {len(self._tree)} хешей")
+
+    def lookup(self, fingerprint):
+        """Return (analysis, distance, is_exact) or (None, None, False).
+
+        Every candidate within near_distance is checked: screenshots with
+        the same coarse hash can still differ in the fine one.
+        """
+        coarse, fine = fingerprint
+        self.lookups += 1
+        candidates = self._tree.within(coarse, self.near_distance)
+        if not candidates:
+            return None, None, False
+        cached_fine, analysis, distance = min(candidates, key=lambda c: hamming(fine, c[0]))
+        if hamming(fine, cached_fine) <= self.exact_distance:
+            self.exact_hits += 1
+            return analysis, distance, True
+        self.near_hits += 1
+        _, analysis, distance = min(candidates, key=lambda c: c[2])
+        return analysis, distance, False
+
+    async def add(self, database, fingerprint, analysis):
+        if not analysis:
+            return
+        coarse, fine = fingerprint
+        self._insert(coarse, fine, analysis)
+        try:
+            await database.save_screenshot_analysis(f"{coarse:x}", f"{fine:x}", analysis)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить анализ скриншота: {e}")
+
+    def _insert(self, coarse, fine, analysis):
+        self._entries.append((coarse, fine, analysis))
+        if len(self._entries) > self.max_entries:
+            # BK-дерево не умеет удалять — пересобираем из свежей половины
+            self._entries = self._entries[-(self.max_entries // 2):]
+            self._tree = BKTree()
+            for entry in self._entries:
+                self._tree.add(*entry)
+        else:
+            self._tree.add(coarse, fine, analysis)
+
+    @property
+    def stats(self):
+        hits = self.exact_hits + self.near_hits
+        return {
+            "entries": len(self._tree),
+            "lookups": self.lookups,
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "hit_rate": round(hits / self.lookups, 3) if self.lookups else 0.0,
+            "vision_calls_saved": self.vision_calls_saved,
+        }
+
+
+# Global instance
+_screenshot_cache = None
+
+
+def get_screenshot_cache() -> ScreenshotCache:
+    global _screenshot_cache
+    if _screenshot_cache is None:
+        from .config import BotConfig
+        _screenshot_cache = ScreenshotCache(
+            exact_distance=BotConfig.SCREENSHOT_HASH_EXACT,
+            near_distance=BotConfig.SCREENSHOT_HASH_NEAR,
+        )
+    return _screenshot_cache
@@ -0,0 +1,189 @@
+"""Background jobs for long operations (training scans).
+
+A job runs in its own asyncio task, so the HTTP request that submits it
+returns at once with the job id. Only one job runs at a time. State and
+progress live in the `jobs` document collection: the dashboard gets
+`job` events over SSE and can reload the last job after a page refresh.
+A job left `running` by a restart is marked `interrupted`. A cancelled
+or interrupted job can be resumed with the same parameters.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone
+
+from .events import get_event_hub
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = "jobs"
+PERSIST_INTERVAL_SEC = 1.0
+ACTIVE_STATUSES = ("queued", "running")
+RESUMABLE_STATUSES = ("cancelled", "interrupted", "failed")
+
+
+class JobConflict(Exception):
+    """Another job is already running."""
+
+    def __init__(self, job):
+        super().__init__(f"Уже выполняется задача {job['id']}")
+        self.job = job
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobRunner:
+    def __init__(self, database):
+        self.database = database
+        self._handlers = {}  # kind → async fn(params, progress)
+        self._job = None
+        self._task = None
+        self._starting = False  # submit() между проверкой и созданием задачи
+        self._cancel_requested = False
+        self._dirty = False
+
+    def register(self, kind, handler):
+        """`handler(params, progress)` does the work and returns the result;
+        `progress(phase=None, **counters)` reports progress."""
+        self._handlers[kind] = handler
+
+    @property
+    def current(self):
+        if self._task is not None and not self._task.done():
+            return self._job
+        return None
+
+    async def submit(self, kind, params, resumed_from=None):
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестный тип задачи: {kind}")
+        if self.current is not None or self._starting:
+            raise JobConflict(self._job)
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "status": "queued",
+            "phase": None,
+            "params": params,
+            "progress": {},
+            "result": None,
+            "error": None,
+            "resumed_from": resumed_from,
+            "created_at": _now(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        # Слот занят до первого await: второй submit, пришедший, пока
+        # задача записывается в БД, получит JobConflict
+        self._starting = True
+        self._job = job
+        self._cancel_requested = False
+        try:
+            await self._persist()
+            await self.database.update_doc(JOBS_COLLECTION, {"job_id": job["id"]}, doc_id=f"latest:{kind}")
+            self._task = asyncio.create_task(self._run(job))
+        finally:
+            self._starting = False
+        return dict(job)
+
+    async def _run(self, job):
+        job["status"] = "running"
+        job["started_at"] = _now()
+        await self._persist()
+        saver = asyncio.create_task(self._persist_loop())
+        try:
+            job["result"] = await self._handlers[job["kind"]](job["params"], self._progress)
+            job["status"] = "completed"
+            job["phase"] = "done"
+        except asyncio.CancelledError:
+            # Отмена из панели — cancelled; остановка сервера — interrupted
+            job["status"] = "cancelled" if self._cancel_requested else "interrupted"
+            raise
+        except Exception as e:
+            logger.error(f"Задача {job['kind']} {job['id']} завершилась с ошибкой: {e}", exc_info=True)
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            saver.cancel()
+            job["finished_at"] = _now()
+            await self._persist()
+            logger.info(f"Задача {job['kind']} {job['id']}: {job['status']}")
+
+    def _progress(self, phase=None, **counters):
+        job = self._job
+        if phase is not None:
+            job["phase"] = phase
+        job["progress"].update(counters)
+        self._dirty = True
+
+    async def _persist_loop(self):
+        # Прогресс меняется часто — пишем и рассылаем не чаще раза в секунду
+        while True:
+            await asyncio.sleep(PERSIST_INTERVAL_SEC)
+            if self._dirty:
+                await self._persist()
+
+    async def _persist(self):
+        self._dirty = False
+        job = {**self._job, "progress": dict(self._job["progress"])}
+        await self.database.update_doc(JOBS_COLLECTION, job, doc_id=job["id"])
+        get_event_hub().publish("job", job)
+
+    async def get(self, job_id):
+        if self._job is not None and self._job["id"] == job_id:
+            return dict(self._job)
+        return await self.database.get_doc(JOBS_COLLECTION, job_id)
+
+    async def latest(self, kind):
+        pointer = await self.database.get_doc(JOBS_COLLECTION, f"latest:{kind}")
+        return await self.get(pointer["job_id"]) if pointer else None
+
+    async def cancel(self, job_id):
+        if self.current is None or self._job["id"] != job_id:
+            return False
+        self._cancel_requested = True
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        return True
+
+    async def resume(self, job_id):
+        job = await self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        if job["status"] not in RESUMABLE_STATUSES:
+            raise ValueError(f"Задачу в статусе {job['status']} нельзя продолжить")
+        # resume=True: обработчик продолжает с сохранённого места, а не с нуля
+        return await self.submit(job["kind"], {**job["params"], "resume": True}, resumed_from=job_id)
+
+    async def recover(self):
+        """After a restart: jobs that were running are marked interrupted."""
+        for kind in self._handlers:
+            job = await self.latest(kind)
+            if job and job["status"] in ACTIVE_STATUSES:
+                await self.database.update_doc(
+                    JOBS_COLLECTION, {"status": "interrupted", "finished_at": _now()}, doc_id=job["id"]
+                )
+                logger.info(f"Задача {kind} {job['id']} прервана перезапуском — её можно продолжить")
+
+    async def shutdown(self):
+        if self.current is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+# Global instance
+_job_runner = None
+
+
+def get_job_runner(database) -> JobRunner:
+    global _job_runner
+    if _job_runner is None:
+        _job_runner = JobRunner(database)
+    return _job_runner
@@ -0,0 +1,300 @@
+"""Versioned schema migrations for the Mongo collections.
+
+Applied automatically in server startup. For large databases they can be
+run offline before deploying:
+
+    python -m bot.migrations            # apply pending migrations
+    python -m bot.migrations --status   # show current schema version
+"""
+import asyncio
+import argparse
+import logging
+import os
+from datetime import datetime, timezone
+
+from pymongo import ASCENDING, DESCENDING, TEXT
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration. Versions must be unique and increasing."""
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+async def _drop_index(collection, name):
+    """Drop an index if it exists: a migration that failed halfway is re-run
+    from the start, and its drops must not fail with IndexNotFound."""
+    if name in await collection.index_information():
+        await collection.drop_index(name)
+
+
+# ── Миграции ─────────────────────────────────────────────
+
+@migration(1, "Индексы для горячих запросов")
+async def _initial_indexes(db):
+    # get_history: фильтр по chat_id + сортировка по timestamp
+    await db.messages.create_index(
+        [("chat_id", ASCENDING), ("timestamp", DESCENDING)], name="chat_timestamp"
+    )
+    # get_stats: count по has_image=True
+    await db.messages.create_index(
+        "has_image", name="has_image",
+        partialFilterExpression={"has_image": True},
+    )
+    # is_silenced / активные тишины
+    await db.silence_timers.create_index("chat_id", name="chat_id", unique=True)
+    await db.silence_timers.create_index("expires_at", name="expires_at")
+    # /bot/activity: последние записи; get_stats: count по event_type
+    await db.activity_log.create_index([("timestamp", DESCENDING)], name="timestamp")
+    await db.activity_log.create_index("event_type", name="event_type")
+    await db.media_rules.create_index("tag", name="tag")
+    # Один грубый хеш может быть у нескольких скриншотов — уникальна пара
+    await db.screenshot_cache.create_index(
+        [("hash", ASCENDING), ("fine", ASCENDING)], name="hash_fine", unique=True
+    )
+    await db.screenshot_cache.create_index([("created_at", DESCENDING)], name="created_at")
+    await db.voice_transcripts.create_index(
+        "file_unique_id", name="file_unique_id", unique=True
+    )
+
+
+# Поля, которые раньше хранились ISO-строками
+DATETIME_FIELDS = [
+    ("messages", "timestamp"),
+    ("activity_log", "timestamp"),
+    ("silence_timers", "expires_at"),
+    ("screenshot_cache", "created_at"),
+    ("voice_transcripts", "created_at"),
+]
+
+
+async def _backfill_datetimes(collection, field, batch_size=1000):
+    """Convert ISO-string dates to BSON datetimes in small batches (online)."""
+    converted = 0
+    while True:
+        ids = [
+            doc["_id"] async for doc in
+            collection.find({field: {"$type": "string"}}, {"_id": 1}).limit(batch_size)
+        ]
+        if not ids:
+            break
+        result = await collection.update_many(
+            {"_id": {"$in": ids}, field: {"$type": "string"}},
+            [{"$set": {field: {"$dateFromString": {
+                "dateString": f"${field}",
+                "onError": None,  # битая дата → null, чтобы не зациклиться
+            }}}}],
+        )
+        converted += result.modified_count
+    if converted:
+        logger.info(f"{collection.name}.{field}: {converted} дат переведено в datetime")
+
+
+@migration(2, "BSON datetime вместо ISO-строк, TTL-индексы")
+async def _native_datetimes(db):
+    for collection_name, field in DATETIME_FIELDS:
+        await _backfill_datetimes(db[collection_name], field)
+
+    # Истёкшие таймеры тишины удаляет сам MongoDB
+    await _drop_index(db.silence_timers, "expires_at")
+    await db.silence_timers.create_index(
+        "expires_at", name="expires_at_ttl", expireAfterSeconds=0
+    )
+    # Сырые записи activity_log живут ACTIVITY_RETENTION_DAYS
+    await _drop_index(db.activity_log, "timestamp")
+    await db.activity_log.create_index(
+        "timestamp", name="timestamp_ttl",
+        expireAfterSeconds=BotConfig.ACTIVITY_RETENTION_DAYS * 86400,
+    )
+
+
+@migration(3, "Индекс истории чата с _id для стабильного порядка")
+async def _chat_history_order(db):
+    # BSON datetime хранит миллисекунды — сообщения одной миллисекунды
+    # упорядочиваем по _id (ObjectId назначается при постановке в очередь)
+    await db.messages.create_index(
+        [("chat_id", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)],
+        name="chat_timestamp_id",
+    )
+    await _drop_index(db.messages, "chat_timestamp")
+
+
+@migration(4, "Коллекция conversations и документ счётчиков")
+async def _conversations_and_counters(db):
+    # Один документ на чат — total_chats считается по созданным upsert-ам
+    await db.messages.aggregate([
+        {"$group": {"_id": "$chat_id", "first_message_at": {"$min": "$timestamp"}}},
+        {"$merge": {"into": "conversations", "whenMatched": "keepExisting"}},
+    ]).to_list(None)
+    # Начальные значения счётчиков; дальше их поддерживает BotDatabase
+    from .database import BotDatabase
+    await BotDatabase(db).reconcile_counters()
+
+
+@migration(5, "Сводки диалогов в conversations")
+async def _conversation_summaries(db):
+    await db.messages.aggregate([
+        {"$sort": {"chat_id": 1, "timestamp": 1}},
+        {"$group": {
+            "_id": "$chat_id",
+            "first_message_at": {"$first": "$timestamp"},
+            "last_message_at": {"$last": "$timestamp"},
+            "message_count": {"$sum": 1},
+            "last_snippet": {"$last": {"$substrCP": [{"$ifNull": ["$text", ""]}, 0, 120]}},
+            "last_role": {"$last": "$role"},
+            # У ответов бота username пустой; $max пропускает null
+            "username": {"$max": "$username"},
+        }},
+        {"$merge": {"into": "conversations", "whenMatched": "merge"}},
+    ], allowDiskUse=True).to_list(None)
+    # Лента диалогов: диапазон по last_message_at + _id для курсора
+    await db.conversations.create_index(
+        [("last_message_at", DESCENDING), ("_id", DESCENDING)], name="last_message_at"
+    )
+
+
+@migration(6, "Индексы ленты активности и почасовые агрегаты")
+async def _activity_keyset_and_rollups(db):
+    # Keyset-пагинация (timestamp, id) с фильтрами по типу и чату;
+    # одиночный TTL-индекс timestamp_ttl остаётся для очистки
+    await db.activity_log.create_index(
+        [("timestamp", DESCENDING), ("id", DESCENDING)], name="timestamp_id"
+    )
+    await db.activity_log.create_index(
+        [("event_type", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+        name="event_type_timestamp",
+    )
+    await db.activity_log.create_index(
+        [("chat_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+        name="chat_id_timestamp",
+        partialFilterExpression={"chat_id": {"$type": "string"}},
+    )
+    await _drop_index(db.activity_log, "event_type")
+
+    # Агрегаты по тому, что ещё не удалил TTL
+    await db.activity_log.aggregate([
+        {"$match": {"timestamp": {"$type": "date"}}},
+        {"$group": {
+            "_id": {"$concat": [
+                {"$dateToString": {"format": "%Y-%m-%dT%H", "date": "$timestamp"}},
+                "|", "$event_type",
+            ]},
+            "hour": {"$min": {"$dateTrunc": {"date": "$timestamp", "unit": "hour"}}},
+            "event_type": {"$first": "$event_type"},
+            "count": {"$sum": 1},
+        }},
+        {"$merge": {"into": "activity_rollups", "whenMatched": "replace"}},
+    ], allowDiskUse=True).to_list(None)
+    await db.activity_rollups.create_index(
+        [("hour", DESCENDING), ("event_type", ASCENDING)], name="hour_event_type"
+    )
+
+
+@migration(7, "Текстовый индекс для поиска по сообщениям")
+async def _message_text_index(db):
+    # Русский стеммер MongoDB; английские слова индексируются почти как есть
+    await db.messages.create_index(
+        [("text", TEXT)], name="text", default_language="russian"
+    )
+
+
+@migration(8, "Хеш содержимого обучающих пар")
+async def _training_pair_hash(db):
+    # Инкрементальный рескан дописывает пары upsert-ом по хешу; у пар старых
+    # полных сканов хеша нет — их заменит первый скан после обновления
+    await db.training_data.create_index(
+        "hash", name="hash", unique=True,
+        partialFilterExpression={"hash": {"$type": "string"}},
+    )
+
+
+@migration(9, "Кэш скриншотов хранит описание, а не ответ")
+async def _screenshot_descriptions(db):
+    # Прежние записи — ответы конкретным клиентам; описания соберутся заново
+    await db.screenshot_cache.delete_many({})
+
+
+async def sync_ttl_settings(db):
+    """Apply a changed ACTIVITY_RETENTION_DAYS to the existing TTL index."""
+    seconds = BotConfig.ACTIVITY_RETENTION_DAYS * 86400
+    indexes = await db.activity_log.index_information()
+    current = indexes.get("timestamp_ttl", {}).get("expireAfterSeconds")
+    if current is not None and current != seconds:
+        await db.command({
+            "collMod": "activity_log",
+            "index": {"name": "timestamp_ttl", "expireAfterSeconds": seconds},
+        })
+        logger.info(f"TTL activity_log: {current} → {seconds} сек")
+
+
+# ── Раннер ───────────────────────────────────────────────
+
+async def get_schema_version(db):
+    doc = await db.schema_meta.find_one({"_id": "main"})
+    return (doc or {}).get("version", 0)
+
+
+async def run_migrations(db, target=None):
+    """Apply pending migrations in order; returns the resulting version."""
+    current = await get_schema_version(db)
+    for version, description, fn in MIGRATIONS:
+        if version <= current:
+            continue
+        if target is not None and version > target:
+            break
+        logger.info(f"Миграция {version}: {description}...")
+        await fn(db)
+        await db.schema_meta.update_one(
+            {"_id": "main"},
+            {
+                "$set": {"version": version},
+                "$push": {"applied": {
+                    "version": version,
+                    "description": description,
+                    "applied_at": datetime.now(timezone.utc),
+                }},
+            },
+            upsert=True,
+        )
+        current = version
+    return current
+
+
+async def _main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Миграции схемы MongoDB")
+    parser.add_argument("--status", action="store_true", help="показать версию схемы и выйти")
+    parser.add_argument("--target", type=int, default=None, help="применить миграции до этой версии")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], tz_aware=True)
+    db = client[os.environ["DB_NAME"]]
+    try:
+        current = await get_schema_version(db)
+        latest = MIGRATIONS[-1][0] if MIGRATIONS else 0
+        if args.status:
+            print(f"Версия схемы: {current} (последняя: {latest})")
+            return
+        version = await run_migrations(db, target=args.target)
+        await sync_ttl_settings(db)
+        print(f"Версия схемы: {current} → {version}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_main())
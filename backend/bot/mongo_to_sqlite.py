@@ -0,0 +1,173 @@
+"""One-shot copy of a MongoDB database into the SQLite storage.
+
+Stop the server first, then:
+
+    python -m bot.mongo_to_sqlite                   # MONGO_URL/DB_NAME → SQLITE_PATH
+    python -m bot.mongo_to_sqlite --sqlite /path/bot.db --force
+
+Pending Mongo migrations are applied first, so every date is a datetime.
+Afterwards set STORAGE_BACKEND=sqlite and start the server.
+"""
+import asyncio
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+from pathlib import Path
+
+from .config import BotConfig
+from .sqlite_database import SQLiteDatabase, _ts, _dumps
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+
+# Коллекции «один документ на _id» → таблица documents
+DOCUMENT_COLLECTIONS = [
+    "bot_config", "custom_prompt", "ai_settings", "voice_settings",
+    "telegram_creds", "style_profile", "bot_status", "auth_config",
+]
+
+
+def _ts_any(value):
+    if isinstance(value, datetime):
+        return _ts(value)
+    if isinstance(value, str) and value:
+        return _ts(datetime.fromisoformat(value))
+    return None
+
+
+def _clean(doc):
+    # Через JSON, чтобы ObjectId/datetime стали строками
+    return json.loads(_dumps({k: v for k, v in doc.items() if k != "_id"}))
+
+
+# Таблица → (коллекция, SQL вставки, строка из документа)
+TABLES = [
+    ("messages",
+     "INSERT INTO messages (chat_id, role, text, username, has_image, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+     lambda d: (str(d["chat_id"]), d.get("role", ""), d.get("text") or "", d.get("username"),
+                int(bool(d.get("has_image"))), _ts_any(d.get("timestamp")))),
+    ("conversations",
+     "INSERT OR REPLACE INTO conversations (chat_id, first_message_at, last_message_at, last_snippet, "
+     "last_role, username, message_count, archived_count, archived_images, archived_until, "
+     "archive_segments) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+     lambda d: (str(d["_id"]), _ts_any(d.get("first_message_at")), _ts_any(d.get("last_message_at")),
+                d.get("last_snippet"), d.get("last_role"), d.get("username"), d.get("message_count", 0),
+                d.get("archived_count", 0), d.get("archived_images", 0),
+                _ts_any(d.get("archived_until")), _dumps(d.get("archive_segments", [])))),
+    ("silence_timers",
+     "INSERT OR REPLACE INTO silence_timers (chat_id, expires_at) VALUES (?, ?)",
+     lambda d: (str(d["chat_id"]), _ts_any(d.get("expires_at")))),
+    ("activity_log",
+     "INSERT OR IGNORE INTO activity_log (id, timestamp, event_type, chat_id, username, details) "
+     "VALUES (?, ?, ?, ?, ?, ?)",
+     lambda d: (str(d.get("id") or d["_id"]), _ts_any(d.get("timestamp")), d.get("event_type", ""),
+                None if d.get("chat_id") is None else str(d["chat_id"]),
+                d.get("username"), d.get("details", ""))),
+    ("activity_rollups",
+     "INSERT OR REPLACE INTO activity_rollups (hour, event_type, count) VALUES (?, ?, ?)",
+     lambda d: (_ts_any(d.get("hour")), d.get("event_type", ""), d.get("count", 0))),
+    ("screenshot_cache",
+     "INSERT OR REPLACE INTO screenshot_cache (hash, fine, analysis, created_at) VALUES (?, ?, ?, ?)",
+     lambda d: (d["hash"], d.get("fine") or "", d.get("analysis", ""), _ts_any(d.get("created_at")))),
+    ("voice_transcripts",
+     "INSERT OR REPLACE INTO voice_transcripts (file_unique_id, text, model_id, created_at) "
+     "VALUES (?, ?, ?, ?)",
+     lambda d: (d["file_unique_id"], d.get("text", ""), d.get("model_id"), _ts_any(d.get("created_at")))),
+    ("media_rules",
+     "INSERT OR REPLACE INTO media_rules (tag, description) VALUES (?, ?)",
+     lambda d: (d["tag"], d.get("description", ""))),
+    ("training_data",
+     "INSERT OR IGNORE INTO training_data (chat_id, hash, data) VALUES (?, ?, ?)",
+     lambda d: (str(d.get("chat_id", "")), d.get("hash"), _dumps(_clean(d)))),
+    ("scan_checkpoints",
+     "INSERT OR REPLACE INTO scan_checkpoints (chat_id, data) VALUES (?, ?)",
+     lambda d: (str(d["_id"]), _dumps(_clean(d)))),
+]
+
+
+async def copy_database(mongo_db, target):
+    """Copy every collection into `target` (an SQLiteDatabase); returns row counts."""
+    from .migrations import run_migrations
+    await run_migrations(mongo_db)
+    await target.migrate()
+
+    copied = {}
+    for table, sql, to_row in TABLES:
+        copied[table] = 0
+        batch = []
+        # Историю пишем в порядке времени — autoincrement id повторяет порядок _id
+        cursor = mongo_db[table].find({})
+        if table == "messages":
+            cursor = cursor.sort([("timestamp", 1), ("_id", 1)])
+        async for doc in cursor:
+            try:
+                batch.append(to_row(doc))
+            except (KeyError, ValueError) as e:
+                logger.warning(f"{table}: пропущен документ {doc.get('_id')}: {e}")
+                continue
+            if len(batch) >= BATCH_SIZE:
+                await target._tx(lambda conn, rows=batch: conn.executemany(sql, rows))
+                copied[table] += len(batch)
+                batch = []
+        if batch:
+            await target._tx(lambda conn, rows=batch: conn.executemany(sql, rows))
+            copied[table] += len(batch)
+        logger.info(f"{table}: {copied[table]}")
+
+    for collection in DOCUMENT_COLLECTIONS:
+        rows = [
+            (collection, str(doc["_id"]), _dumps(_clean(doc)))
+            async for doc in mongo_db[collection].find({})
+        ]
+        if rows:
+            await target._tx(lambda conn, rows=rows: conn.executemany(
+                "INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)", rows
+            ))
+        copied[collection] = len(rows)
+
+    # media_sent живёт дольше сырого лога — переносим накопленное значение
+    counters = await mongo_db.counters.find_one({"_id": "main"}) or {}
+    await target._tx(lambda conn: conn.execute(
+        "INSERT OR REPLACE INTO counters (name, value) VALUES ('total_media_sent', ?)",
+        (counters.get("total_media_sent", 0),),
+    ))
+    await target.reconcile_counters()
+    return copied
+
+
+async def _main():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Перенос данных MongoDB → SQLite")
+    parser.add_argument("--sqlite", default=BotConfig.SQLITE_PATH, help="путь к файлу SQLite")
+    parser.add_argument("--force", action="store_true", help="перезаписать существующий файл")
+    args = parser.parse_args()
+
+    path = Path(args.sqlite)
+    if path.exists():
+        if not args.force:
+            raise SystemExit(f"{path} уже существует — укажите --force для перезаписи")
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], tz_aware=True)
+    target = SQLiteDatabase(path)
+    try:
+        copied = await copy_database(client[os.environ["DB_NAME"]], target)
+        total = sum(copied.values())
+        print(f"Перенесено {total} записей в {path}")
+        print("Теперь укажите STORAGE_BACKEND=sqlite и перезапустите сервер")
+    finally:
+        await target.close()
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    asyncio.run(_main())
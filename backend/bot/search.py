@@ -0,0 +1,98 @@
+"""Query normalization and highlighting for message search.
+
+Stemming is deliberately light: lowercase, ё → е and stripping of common
+Russian/English endings. A query term matches every word that starts with
+its stem, so «ошибка» finds «ошибки» and «ошибкой», «payment» finds
+«payments». Storage backends do the candidate lookup (Mongo text index,
+SQLite FTS5); this module decides what counts as a hit and where it is.
+
+Both backends return only messages `matches()` accepts, but the
+candidate lookup differs in one way. FTS5 looks up the stems as
+prefixes, so every accepted message is found, including by a partial
+word («опла» → «оплата»). MongoDB's text index only knows whole words
+reduced by its own Snowball stemmer: a partial word, or a form that
+Snowball stems differently from `stem()`, finds nothing there.
+"""
+import re
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+MAX_TERMS = 8
+SNIPPET_CHARS = 160
+
+# Длинные окончания раньше коротких
+RU_SUFFIXES = sorted([
+    "иями", "ться", "ями", "ами", "ого", "его", "ому", "ему", "ыми", "ими", "ией",
+    "ешь", "ия", "ья", "ие", "ье", "ий", "ый", "ой", "ей", "ая", "яя", "ое", "ее",
+    "ые", "ую", "юю", "ам", "ям", "ах", "ях", "ов", "ев", "ом", "ем", "ию",
+    "ью", "ет", "ут", "ют", "ит", "ат", "ят", "ть", "ла", "ло", "ли",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+], key=len, reverse=True)
+RU_VOWELS = set("аяоеыиую")
+EN_SUFFIXES = ["ing", "ies", "ed", "es", "ly", "s"]
+MIN_STEM = 3
+
+
+def normalize(word):
+    return word.lower().replace("ё", "е")
+
+
+def stem(word):
+    word = normalize(word)
+    suffixes = EN_SUFFIXES if word.isascii() else RU_SUFFIXES
+    for suffix in suffixes:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+            word = word[:-len(suffix)]
+            break
+    # «оплатить» → «оплати» → «оплат»: глагольная основа без гласной
+    if not word.isascii() and word[-1:] in RU_VOWELS and len(word) > MIN_STEM + 1:
+        word = word[:-1]
+    return word
+
+
+def parse_query(query):
+    """Stems of the query words (all must match), without duplicates."""
+    stems = []
+    for word in WORD_RE.findall(query or ""):
+        s = stem(word)
+        if len(s) >= 2 and s not in stems:
+            stems.append(s)
+    return stems[:MAX_TERMS]
+
+
+def query_words(query):
+    """Plain query words for engines that stem on their own (Mongo $text)."""
+    return " ".join(WORD_RE.findall(query or "")[:MAX_TERMS])
+
+
+def _word_spans(text, stems):
+    return [
+        (m.start(), m.end()) for m in WORD_RE.finditer(text)
+        if any(normalize(m.group()).startswith(s) for s in stems)
+    ]
+
+
+def matches(text, stems):
+    words = {normalize(w) for w in WORD_RE.findall(text or "")}
+    return all(any(w.startswith(s) for w in words) for s in stems)
+
+
+def highlight(text, stems, width=SNIPPET_CHARS):
+    """Snippet around the first hit plus [start, end) offsets of hits in it."""
+    text = text or ""
+    spans = _word_spans(text, stems)
+    if not spans:
+        return {"snippet": text[:width], "highlights": []}
+    start = max(0, min(spans[0][0] - width // 4, len(text) - width))
+    end = min(len(text), start + width)
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if end < len(text) else ""
+    offset = len(prefix) - start
+    return {
+        "snippet": prefix + text[start:end] + suffix,
+        "highlights": [[a + offset, b + offset] for a, b in spans if a >= start and b <= end],
+    }
+
+
+def fts5_query(stems):
+    """SQLite FTS5 MATCH expression: every stem as a prefix term."""
+    return " AND ".join('"{}"*'.format(s.replace('"', '""')) for s in stems)
@@ -0,0 +1,942 @@
+"""SQLite storage for single-node installs (STORAGE_BACKEND=sqlite).
+
+Implements the same public methods as BotDatabase. All work runs on one
+dedicated thread with a single connection in WAL mode, so the event loop
+never blocks on disk and no extra process (mongod) is needed.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+
+from bson import ObjectId
+
+from .config import BotConfig
+from .events import get_event_hub
+from .history_cache import get_history_cache
+from .search import parse_query, fts5_query
+
+logger = logging.getLogger(__name__)
+
+SNIPPET_CHARS = 120
+COUNTER_FIELDS = ("total_messages", "total_chats", "total_images_analyzed", "total_media_sent")
+
+# ── Схема ────────────────────────────────────────────────
+# Версия хранится в PRAGMA user_version; новые шаги дописываются в конец
+
+SCHEMA = [
+    # 1: исходные таблицы и индексы горячих запросов
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL DEFAULT '',
+        username TEXT,
+        has_image INTEGER NOT NULL DEFAULT 0,
+        timestamp TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS messages_chat_timestamp
+        ON messages (chat_id, timestamp DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS messages_has_image
+        ON messages (has_image) WHERE has_image = 1;
+
+    CREATE TABLE IF NOT EXISTS conversations (
+        chat_id TEXT PRIMARY KEY,
+        first_message_at TEXT,
+        last_message_at TEXT,
+        last_snippet TEXT,
+        last_role TEXT,
+        username TEXT,
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS conversations_last_message_at
+        ON conversations (last_message_at DESC, chat_id DESC);
+
+    CREATE TABLE IF NOT EXISTS silence_timers (
+        chat_id TEXT PRIMARY KEY,
+        expires_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS silence_timers_expires_at ON silence_timers (expires_at);
+
+    CREATE TABLE IF NOT EXISTS activity_log (
+        id TEXT PRIMARY KEY,
+        timestamp TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        chat_id TEXT,
+        username TEXT,
+        details TEXT
+    );
+    CREATE INDEX IF NOT EXISTS activity_timestamp_id ON activity_log (timestamp DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS activity_event_type_timestamp
+        ON activity_log (event_type, timestamp DESC, id DESC);
+    CREATE INDEX IF NOT EXISTS activity_chat_id_timestamp
+        ON activity_log (chat_id, timestamp DESC, id DESC) WHERE chat_id IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS activity_rollups (
+        hour TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, event_type)
+    );
+
+    CREATE TABLE IF NOT EXISTS screenshot_cache (
+        hash TEXT NOT NULL,
+        fine TEXT NOT NULL DEFAULT '',
+        analysis TEXT,
+        created_at TEXT NOT NULL,
+        PRIMARY KEY (hash, fine)
+    );
+    CREATE INDEX IF NOT EXISTS screenshot_cache_created_at ON screenshot_cache (created_at DESC);
+
+    CREATE TABLE IF NOT EXISTS voice_transcripts (
+        file_unique_id TEXT PRIMARY KEY,
+        text TEXT NOT NULL,
+        model_id TEXT,
+        created_at TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS media_rules (
+        tag TEXT PRIMARY KEY,
+        description TEXT NOT NULL DEFAULT ''
+    );
+
+    CREATE TABLE IF NOT EXISTS training_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT,
+        data TEXT NOT NULL
+    );
+
+    -- Документы настроек (bot_config, ai_settings, auth_config, ...)
+    CREATE TABLE IF NOT EXISTS documents (
+        collection TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (collection, id)
+    );
+
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    # 2: указатели на архивные сегменты (bot/archiver.py)
+    """
+    ALTER TABLE conversations ADD COLUMN archived_count INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE conversations ADD COLUMN archived_until TEXT;
+    ALTER TABLE conversations ADD COLUMN archive_segments TEXT NOT NULL DEFAULT '[]';
+    """,
+    # 3: полнотекстовый поиск. Contentless FTS5 — текст не дублируется;
+    # ё → е до индексации, как в bot/search.normalize
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        text, content='', tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts (rowid, text)
+        VALUES (new.id, replace(replace(new.text, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts (messages_fts, rowid, text)
+        VALUES ('delete', old.id, replace(replace(old.text, 'ё', 'е'), 'Ё', 'Е'));
+    END;
+    INSERT INTO messages_fts (rowid, text)
+        SELECT id, replace(replace(text, 'ё', 'е'), 'Ё', 'Е') FROM messages;
+    """,
+    # 4: хеш обучающих пар и чекпоинты инкрементального сканирования
+    """
+    ALTER TABLE training_data ADD COLUMN hash TEXT;
+    CREATE UNIQUE INDEX IF NOT EXISTS training_data_hash
+        ON training_data (hash) WHERE hash IS NOT NULL;
+
+    CREATE TABLE IF NOT EXISTS scan_checkpoints (
+        chat_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    """,
+    # 5: скриншоты в архиве — для сверки total_images_analyzed
+    """
+    ALTER TABLE conversations ADD COLUMN archived_images INTEGER NOT NULL DEFAULT 0;
+    """,
+    # 6: кэш скриншотов хранит описание, а не ответ клиенту — старые записи сбрасываем
+    """
+    DELETE FROM screenshot_cache;
+    """,
+]
+
+
+def _ts(dt):
+    """Datetime → fixed-width UTC string; sorts the same as the datetime."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _dt(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(data):
+    return json.dumps(data, default=_json_default, ensure_ascii=False)
+
+
+class SQLiteDatabase:
+    def __init__(self, path):
+        self.path = str(path)
+        # Один поток — одно соединение: запросы выполняются строго по очереди
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self.history_cache = get_history_cache()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _tx(self, fn, *args):
+        """Run fn(conn, *args) inside one transaction on the database thread."""
+        def work():
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn, *args)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+            if isinstance(result, sqlite3.Cursor):
+                # Курсор закрываем здесь: сборка мусора в потоке event loop
+                # сбрасывает его запрос параллельно с потоком БД (SQLITE_MISUSE)
+                result.close()
+                return None
+            return result
+        return await self._run(work)
+
+    async def _query(self, sql, params=()):
+        def work():
+            return [dict(r) for r in self._connect().execute(sql, params).fetchall()]
+        return await self._run(work)
+
+    @staticmethod
+    def _incr(conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+
+    # ── Сообщения и диалоги ───────────────────────────────
+
+    async def save_message(self, chat_id, role, text, username=None, has_image=False):
+        chat_id = str(chat_id)
+        text = text or ""
+        now = datetime.now(timezone.utc)
+        summary = {
+            "last_message_at": now,
+            "last_snippet": text[:SNIPPET_CHARS],
+            "last_role": role,
+        }
+        if username:
+            summary["username"] = username
+
+        def work(conn):
+            conn.execute(
+                "INSERT INTO messages (chat_id, role, text, username, has_image, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, role, text, username, int(bool(has_image)), _ts(now)),
+            )
+            self._incr(conn, "total_messages")
+            if has_image:
+                self._incr(conn, "total_images_analyzed")
+            cur = conn.execute(
+                "UPDATE conversations SET last_message_at = ?, last_snippet = ?, last_role = ?, "
+                "username = COALESCE(?, username), message_count = message_count + 1 "
+                "WHERE chat_id = ?",
+                (_ts(now), summary["last_snippet"], role, username or None, chat_id),
+            )
+            if cur.rowcount == 0:
+                conn.execute(
+                    "INSERT INTO conversations (chat_id, first_message_at, last_message_at, "
+                    "last_snippet, last_role, username, message_count) VALUES (?, ?, ?, ?, ?, ?, 1)",
+                    (chat_id, _ts(now), _ts(now), summary["last_snippet"], role, username or None),
+                )
+                self._incr(conn, "total_chats")
+
+        self.history_cache.append(chat_id, {
+            "chat_id": chat_id, "role": role, "text": text, "username": username,
+            "has_image": bool(has_image), "timestamp": now,
+        })
+        await self._tx(work)
+        get_event_hub().publish("conversation", {"chat_id": chat_id, **summary})
+
+    async def get_history(self, chat_id, limit=20):
+        chat_id = str(chat_id)
+        cached = self.history_cache.get(chat_id, limit)
+        if cached is not None:
+            return cached
+        self.history_cache.begin_fill(chat_id)
+        rows = await self._query(
+            "SELECT chat_id, role, text, username, has_image, timestamp FROM messages "
+            "WHERE chat_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (chat_id, limit),
+        )
+        for r in rows:
+            r["has_image"] = bool(r["has_image"])
+            r["timestamp"] = _dt(r["timestamp"])
+        history = list(reversed(rows))
+        self.history_cache.fill(chat_id, history, limit)
+        return list(history)
+
+    async def get_conversations(self, limit=50, before=None):
+        """Conversations ordered by last activity, newest first.
+
+        `before` is a (last_message_at, chat_id) keyset cursor.
+        """
+        now = _ts(datetime.now(timezone.utc))
+        where, params = "", [now]
+        if before:
+            last_at, chat_id = before
+            where = ("WHERE c.last_message_at < ? "
+                     "OR (c.last_message_at = ? AND c.chat_id < ?)")
+            params += [_ts(last_at), _ts(last_at), chat_id]
+        rows = await self._query(
+            "SELECT c.chat_id, c.first_message_at, c.last_message_at, c.last_snippet, c.last_role, "
+            "c.username, c.message_count, c.archived_count, s.chat_id IS NOT NULL AS is_silenced "
+            "FROM conversations c "
+            "LEFT JOIN silence_timers s ON s.chat_id = c.chat_id AND s.expires_at > ? "
+            f"{where} ORDER BY c.last_message_at DESC, c.chat_id DESC LIMIT ?",
+            (*params, limit),
+        )
+        for r in rows:
+            r["first_message_at"] = _dt(r["first_message_at"])
+            r["last_message_at"] = _dt(r["last_message_at"])
+            r["is_silenced"] = bool(r["is_silenced"])
+        return rows
+
+    # ── Тишина ───────────────────────────────────────────
+
+    async def is_silenced(self, chat_id):
+        rows = await self._query(
+            "SELECT 1 FROM silence_timers WHERE chat_id = ? AND expires_at > ?",
+            (str(chat_id), _ts(datetime.now(timezone.utc))),
+        )
+        return bool(rows)
+
+    async def activate_silence(self, chat_id, duration_min):
+        expires = datetime.now(timezone.utc) + timedelta(minutes=duration_min)
+
+        def work(conn):
+            conn.execute(
+                "INSERT INTO silence_timers (chat_id, expires_at) VALUES (?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET expires_at = excluded.expires_at",
+                (str(chat_id), _ts(expires)),
+            )
+
+        await self._tx(work)
+        get_event_hub().publish("silence", {"chat_id": str(chat_id), "expires_at": expires})
+
+    # ── Лог активности ────────────────────────────────────
+
+    async def log_activity(self, event_type, chat_id=None, details="", username=None):
+        entry = {
+            # ObjectId в hex растёт со временем — тай-брейк для курсора
+            "id": str(ObjectId()),
+            "timestamp": datetime.now(timezone.utc),
+            "event_type": event_type,
+            "chat_id": chat_id,
+            "username": username,
+            "details": details
+        }
+        hour = entry["timestamp"].replace(minute=0, second=0, microsecond=0)
+
+        def work(conn):
+            conn.execute(
+                "INSERT INTO activity_log (id, timestamp, event_type, chat_id, username, details) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (entry["id"], _ts(entry["timestamp"]), event_type,
+                 None if chat_id is None else str(chat_id), username, details),
+            )
+            conn.execute(
+                "INSERT INTO activity_rollups (hour, event_type, count) VALUES (?, ?, 1) "
+                "ON CONFLICT (hour, event_type) DO UPDATE SET count = count + 1",
+                (_ts(hour), event_type),
+            )
+            if event_type == "media_sent":
+                self._incr(conn, "total_media_sent")
+
+        get_event_hub().publish("activity", entry)
+        await self._tx(work)
+
+    async def get_activity(self, limit=100, before=None, event_type=None,
+                           chat_id=None, since=None, until=None):
+        """Activity entries, newest first; `before` is a (timestamp, id) cursor."""
+        clauses, params = [], []
+        if event_type:
+            types = event_type if isinstance(event_type, list) else [event_type]
+            clauses.append(f"event_type IN ({', '.join('?' * len(types))})")
+            params += types
+        if chat_id:
+            clauses.append("chat_id = ?")
+            params.append(str(chat_id))
+        if since:
+            clauses.append("timestamp >= ?")
+            params.append(_ts(since))
+        if until:
+            clauses.append("timestamp < ?")
+            params.append(_ts(until))
+        if before:
+            ts, entry_id = before
+            clauses.append("(timestamp < ? OR (timestamp = ? AND id < ?))")
+            params += [_ts(ts), _ts(ts), entry_id]
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = await self._query(
+            "SELECT id, timestamp, event_type, chat_id, username, details FROM activity_log "
+            f"{where} ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (*params, limit),
+        )
+        for r in rows:
+            r["timestamp"] = _dt(r["timestamp"])
+        return rows
+
+    async def get_activity_rollups(self, since, until=None, event_type=None):
+        clauses, params = ["hour >= ?"], [_ts(since)]
+        if until:
+            clauses.append("hour < ?")
+            params.append(_ts(until))
+        if event_type:
+            clauses.append("event_type = ?")
+            params.append(event_type)
+        rows = await self._query(
+            f"SELECT hour, event_type, count FROM activity_rollups WHERE {' AND '.join(clauses)} "
+            "ORDER BY hour",
+            params,
+        )
+        for r in rows:
+            r["hour"] = _dt(r["hour"])
+        return rows
+
+    # ── Кэши скриншотов и расшифровок ─────────────────────
+
+    async def load_screenshot_hashes(self, limit):
+        return await self._query(
+            "SELECT hash, fine, analysis FROM screenshot_cache ORDER BY created_at DESC LIMIT ?",
+            (limit,),
+        )
+
+    async def save_screenshot_analysis(self, image_hash, fine_hash, analysis):
+        def work(conn):
+            conn.execute(
+                "INSERT INTO screenshot_cache (hash, fine, analysis, created_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (hash, fine) DO UPDATE SET "
+                "analysis = excluded.analysis, created_at = excluded.created_at",
+                (image_hash, fine_hash, analysis, _ts(datetime.now(timezone.utc))),
+            )
+        await self._tx(work)
+
+    async def get_cached_transcript(self, file_unique_id):
+        rows = await self._query(
+            "SELECT text FROM voice_transcripts WHERE file_unique_id = ?", (file_unique_id,)
+        )
+        return rows[0]["text"] if rows else None
+
+    async def cache_transcript(self, file_unique_id, text, model_id):
+        def work(conn):
+            conn.execute(
+                "INSERT INTO voice_transcripts (file_unique_id, text, model_id, created_at) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT (file_unique_id) DO UPDATE SET "
+                "text = excluded.text, model_id = excluded.model_id, created_at = excluded.created_at",
+                (file_unique_id, text, model_id, _ts(datetime.now(timezone.utc))),
+            )
+        await self._tx(work)
+
+    # ── Статус бота и счётчики ────────────────────────────
+
+    async def update_bot_status(self, is_running, started_at=None):
+        update = {"is_running": is_running}
+        if started_at:
+            update["started_at"] = started_at
+        await self.update_doc("bot_status", update)
+        get_event_hub().publish("status", update)
+
+    async def set_auth_state(self, state):
+        """Track auth flow state: none, code_sent, authorized"""
+        await self.update_doc("bot_status", {"auth_state": state})
+        get_event_hub().publish("status", {"auth_state": state})
+
+    async def get_auth_state(self):
+        doc = await self.get_doc("bot_status")
+        return (doc or {}).get("auth_state", "none")
+
+    async def get_bot_status(self):
+        doc = await self.get_doc("bot_status")
+        return doc or {"is_running": False}
+
+    async def get_stats(self):
+        now = _ts(datetime.now(timezone.utc))
+        rows = await self._query(
+            "SELECT name, value FROM counters UNION ALL "
+            "SELECT 'silenced_chats', COUNT(*) FROM silence_timers WHERE expires_at > ?",
+            (now,),
+        )
+        values = {r["name"]: r["value"] for r in rows}
+        stats = {field: values.get(field, 0) for field in COUNTER_FIELDS}
+        stats["silenced_chats"] = values.get("silenced_chats", 0)
+        return stats
+
+    async def reconcile_counters(self):
+        """Recount counters from the tables and prune expired rows.
+
+        SQLite has no TTL indexes, so expired silences and activity entries
+        older than ACTIVITY_RETENTION_DAYS are deleted here. Hourly rollups
+        are kept, as with MongoDB.
+        """
+        now = datetime.now(timezone.utc)
+        retention = now - timedelta(days=BotConfig.ACTIVITY_RETENTION_DAYS)
+
+        def work(conn):
+            conn.execute("DELETE FROM silence_timers WHERE expires_at <= ?", (_ts(now),))
+            pruned = conn.execute(
+                "DELETE FROM activity_log WHERE timestamp < ?", (_ts(retention),)
+            ).rowcount
+            before = {r["name"]: r["value"] for r in conn.execute("SELECT name, value FROM counters")}
+            actual = {
+                # Архивные сообщения тоже входят в total_messages
+                "total_messages": conn.execute(
+                    "SELECT (SELECT COUNT(*) FROM messages) + "
+                    "(SELECT COALESCE(SUM(archived_count), 0) FROM conversations)"
+                ).fetchone()[0],
+                "total_chats": conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0],
+                "total_images_analyzed": conn.execute(
+                    "SELECT (SELECT COUNT(*) FROM messages WHERE has_image = 1) + "
+                    "(SELECT COALESCE(SUM(archived_images), 0) FROM conversations)"
+                ).fetchone()[0],
+            }
+            # Старые media_sent удалены из лога — счётчик только растёт
+            media_sent = conn.execute(
+                "SELECT COUNT(*) FROM activity_log WHERE event_type = 'media_sent'"
+            ).fetchone()[0]
+            actual["total_media_sent"] = max(media_sent, before.get("total_media_sent", 0))
+            conn.executemany(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = excluded.value",
+                list(actual.items()),
+            )
+            return before, actual, pruned
+
+        before, actual, pruned = await self._tx(work)
+        if pruned:
+            logger.info(f"activity_log: удалено {pruned} записей старше "
+                        f"{BotConfig.ACTIVITY_RETENTION_DAYS} дн.")
+        drift = {
+            k: actual[k] - before.get(k, 0) for k in ("total_messages", "total_chats")
+            if before.get(k, 0) != actual[k]
+        }
+        if drift and before:
+            logger.info(f"Сверка счётчиков: расхождение {drift}")
+            get_event_hub().publish("status", {})
+
+    async def search_messages(self, query, limit=20, before=None, chat_id=None):
+        """Messages containing every word of `query`, newest first.
+
+        FTS5 prefix terms over the stems find exactly what bot.search
+        accepts, partial words included (MongoDB finds whole words only);
+        rowid order follows insertion order, so paging walks the index
+        without sorting the matches.
+        Returns (messages, next_before).
+        """
+        stems = parse_query(query)
+        if not stems:
+            return [], None
+        clauses, params = ["messages_fts MATCH ?"], [fts5_query(stems)]
+        if chat_id:
+            clauses.append("m.chat_id = ?")
+            params.append(str(chat_id))
+        if before:
+            clauses.append("f.rowid < ?")
+            params.append(int(before[1]))
+        rows = await self._query(
+            "SELECT m.id, m.chat_id, m.role, m.text, m.username, m.has_image, m.timestamp "
+            "FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+            f"WHERE {' AND '.join(clauses)} ORDER BY f.rowid DESC LIMIT ?",
+            (*params, limit),
+        )
+        for r in rows:
+            r["id"] = str(r["id"])
+            r["has_image"] = bool(r["has_image"])
+            r["timestamp"] = _dt(r["timestamp"])
+        next_before = (rows[-1]["timestamp"], rows[-1]["id"]) if len(rows) == limit else None
+        return rows, next_before
+
+    # ── Архив старых сообщений ────────────────────────────
+
+    async def get_archive_candidates(self, cutoff, keep, limit=100):
+        rows = await self._query(
+            "SELECT chat_id FROM conversations WHERE first_message_at < ? "
+            "AND (archived_until IS NULL OR archived_until < ?) "
+            "AND message_count - archived_count > ? LIMIT ?",
+            (_ts(cutoff), _ts(cutoff), keep, limit),
+        )
+        return [r["chat_id"] for r in rows]
+
+    async def get_archivable_messages(self, chat_id, cutoff, keep, limit=5000):
+        chat_id = str(chat_id)
+        boundary = await self._query(
+            "SELECT id, timestamp FROM messages WHERE chat_id = ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?",
+            (chat_id, keep),
+        )
+        if not boundary:
+            return []
+        ts, row_id = boundary[0]["timestamp"], boundary[0]["id"]
+        rows = await self._query(
+            "SELECT id, chat_id, role, text, username, has_image, timestamp FROM messages "
+            "WHERE chat_id = ? AND timestamp < ? AND (timestamp < ? OR (timestamp = ? AND id <= ?)) "
+            "ORDER BY timestamp, id LIMIT ?",
+            (chat_id, _ts(cutoff), ts, ts, row_id, limit),
+        )
+        for r in rows:
+            r["id"] = str(r["id"])
+            r["has_image"] = bool(r["has_image"])
+            r["timestamp"] = _dt(r["timestamp"])
+        return rows
+
+    async def commit_archive_segment(self, chat_id, segment, ids):
+        chat_id = str(chat_id)
+
+        def work(conn):
+            row = conn.execute(
+                "SELECT archive_segments FROM conversations WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+            segments = json.loads(row["archive_segments"]) if row else []
+            conn.executemany("DELETE FROM messages WHERE id = ?", [(int(i),) for i in ids])
+            # Сегмент уже учтён — повторная фиксация не удваивает счётчики
+            if any(s["file"] == segment["file"] for s in segments):
+                return
+            segments.append(segment)
+            conn.execute(
+                "UPDATE conversations SET archive_segments = ?, archived_count = archived_count + ?, "
+                "archived_images = archived_images + ?, "
+                "archived_until = MAX(COALESCE(archived_until, ''), ?) WHERE chat_id = ?",
+                (_dumps(segments), segment["count"], segment.get("images", 0),
+                 _ts(segment["last_at"]), chat_id),
+            )
+
+        await self._tx(work)
+        self.history_cache.invalidate(chat_id)
+
+    async def get_pending_archive_chats(self):
+        # Сегмент и удаление сообщений фиксируются одной транзакцией
+        return []
+
+    async def get_archive_segments(self, chat_id):
+        rows = await self._query(
+            "SELECT archive_segments FROM conversations WHERE chat_id = ?", (str(chat_id),)
+        )
+        segments = json.loads(rows[0]["archive_segments"]) if rows else []
+        for seg in segments:
+            seg["first_at"] = _dt(seg["first_at"])
+            seg["last_at"] = _dt(seg["last_at"])
+        return segments
+
+    # ── Документы настроек ────────────────────────────────
+
+    async def get_doc(self, collection, doc_id="main"):
+        rows = await self._query(
+            "SELECT data FROM documents WHERE collection = ? AND id = ?", (collection, doc_id)
+        )
+        return json.loads(rows[0]["data"]) if rows else None
+
+    async def update_doc(self, collection, fields=None, doc_id="main",
+                         unset=None, set_on_insert=None, upsert=True):
+        if not (fields or unset or set_on_insert):
+            return
+
+        def work(conn):
+            row = conn.execute(
+                "SELECT data FROM documents WHERE collection = ? AND id = ?", (collection, doc_id)
+            ).fetchone()
+            if row is None:
+                if not upsert:
+                    return
+                data = dict(set_on_insert or {})
+            else:
+                data = json.loads(row["data"])
+            data.update(fields or {})
+            for key in unset or ():
+                data.pop(key, None)
+            conn.execute(
+                "INSERT INTO documents (collection, id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (collection, id) DO UPDATE SET data = excluded.data",
+                (collection, doc_id, _dumps(data)),
+            )
+
+        await self._tx(work)
+
+    async def delete_doc(self, collection, doc_id="main"):
+        await self._tx(lambda conn: conn.execute(
+            "DELETE FROM documents WHERE collection = ? AND id = ?", (collection, doc_id)
+        ))
+
+    async def clear_docs(self, collection):
+        await self._tx(lambda conn: conn.execute(
+            "DELETE FROM documents WHERE collection = ?", (collection,)
+        ))
+
+    # ── Правила медиа ─────────────────────────────────────
+
+    async def get_media_rules(self, tags=None):
+        if tags is None:
+            return await self._query("SELECT tag, description FROM media_rules")
+        tags = list(tags)
+        if not tags:
+            return []
+        return await self._query(
+            f"SELECT tag, description FROM media_rules WHERE tag IN ({', '.join('?' * len(tags))})",
+            tags,
+        )
+
+    async def save_media_rule(self, tag, description):
+        await self._tx(lambda conn: conn.execute(
+            "INSERT INTO media_rules (tag, description) VALUES (?, ?) "
+            "ON CONFLICT (tag) DO UPDATE SET description = excluded.description",
+            (tag, description),
+        ))
+
+    async def delete_media_rule(self, tag):
+        await self._tx(lambda conn: conn.execute("DELETE FROM media_rules WHERE tag = ?", (tag,)))
+
+    # ── Обучающие пары ────────────────────────────────────
+
+    async def count_training_pairs(self):
+        rows = await self._query("SELECT COUNT(*) AS n FROM training_data")
+        return rows[0]["n"]
+
+    async def upsert_training_pairs(self, pairs):
+        if not pairs:
+            return []
+
+        def work(conn):
+            stored = []
+            for p in pairs:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO training_data (chat_id, hash, data) VALUES (?, ?, ?)",
+                    (str(p.get("chat_id", "")), p["hash"], _dumps(p)),
+                )
+                if cur.rowcount:
+                    stored.append(p)
+            return stored
+        return await self._tx(work)
+
+    async def clear_training_pairs(self):
+        await self._tx(lambda conn: conn.execute("DELETE FROM training_data"))
+
+    # ── Чекпоинты сканирования ────────────────────────────
+
+    async def get_scan_checkpoints(self):
+        rows = await self._query("SELECT chat_id, data FROM scan_checkpoints")
+        checkpoints = {}
+        for r in rows:
+            cp = json.loads(r["data"])
+            for field in ("last_message_at", "scanned_at"):
+                cp[field] = _dt(cp.get(field))
+            checkpoints[r["chat_id"]] = cp
+        return checkpoints
+
+    async def save_scan_checkpoints(self, checkpoints):
+        if not checkpoints:
+            return
+        # Как $set в Mongo: поля дописываются поверх сохранённых
+        await self._tx(lambda conn: conn.executemany(
+            "INSERT INTO scan_checkpoints (chat_id, data) VALUES (?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET data = json_patch(data, excluded.data)",
+            [(chat_id, _dumps(cp)) for chat_id, cp in checkpoints.items()],
+        ))
+
+    async def clear_scan_checkpoints(self):
+        await self._tx(lambda conn: conn.execute("DELETE FROM scan_checkpoints"))
+
+    # ── Экспорт и импорт ──────────────────────────────────
+    # Выгрузка порциями по ключу: поток БД не занят дольше одного запроса
+
+    async def iter_conversation_ids(self, batch_size=1000):
+        last = ""
+        while True:
+            rows = await self._query(
+                "SELECT chat_id FROM conversations WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+                (last, batch_size),
+            )
+            for r in rows:
+                yield r["chat_id"]
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]["chat_id"]
+
+    async def iter_chat_messages(self, chat_id, batch_size=1000):
+        chat_id = str(chat_id)
+        ts, row_id = "", 0
+        while True:
+            rows = await self._query(
+                "SELECT id, chat_id, role, text, username, has_image, timestamp FROM messages "
+                "WHERE chat_id = ? AND (timestamp > ? OR (timestamp = ? AND id > ?)) "
+                "ORDER BY timestamp, id LIMIT ?",
+                (chat_id, ts, ts, row_id, batch_size),
+            )
+            for r in rows:
+                ts, row_id = r["timestamp"], r["id"]
+                r["id"] = str(r["id"])
+                r["has_image"] = bool(r["has_image"])
+                r["timestamp"] = _dt(r["timestamp"])
+                yield r
+            if len(rows) < batch_size:
+                return
+
+    async def iter_training_pairs(self, batch_size=1000):
+        last = 0
+        while True:
+            rows = await self._query(
+                "SELECT id, data FROM training_data WHERE id > ? ORDER BY id LIMIT ?",
+                (last, batch_size),
+            )
+            for r in rows:
+                yield json.loads(r["data"])
+            if len(rows) < batch_size:
+                return
+            last = rows[-1]["id"]
+
+    async def import_messages(self, messages):
+        """Bulk insert of exported messages; returns the number inserted.
+
+        Messages already present (same chat/time/role/text) are skipped,
+        and so is anything at or before the chat's archived_until (it is
+        in the archive already).
+        """
+        if not messages:
+            return 0
+
+        def work(conn):
+            chat_ids = list({m["chat_id"] for m in messages})
+            archived = dict(conn.execute(
+                "SELECT chat_id, archived_until FROM conversations "
+                f"WHERE archived_until IS NOT NULL AND chat_id IN ({', '.join('?' * len(chat_ids))})",
+                chat_ids,
+            ).fetchall())
+            by_chat = {}
+            for m in messages:
+                if m["chat_id"] in archived and _ts(m["timestamp"]) <= archived[m["chat_id"]]:
+                    continue
+                cur = conn.execute(
+                    "INSERT INTO messages (chat_id, role, text, username, has_image, timestamp) "
+                    "SELECT ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM messages "
+                    "WHERE chat_id = ? AND timestamp = ? AND role = ? AND text = ?)",
+                    (m["chat_id"], m["role"], m["text"], m["username"], int(bool(m["has_image"])),
+                     _ts(m["timestamp"]), m["chat_id"], _ts(m["timestamp"]), m["role"], m["text"]),
+                )
+                if cur.rowcount:
+                    by_chat.setdefault(m["chat_id"], []).append(m)
+            new_chats = 0
+            for chat_id, msgs in by_chat.items():
+                first = min(m["timestamp"] for m in msgs)
+                last = sorted(msgs, key=lambda m: m["timestamp"])[-1]
+                username = next((m["username"] for m in reversed(msgs) if m.get("username")), None)
+                exists = conn.execute(
+                    "SELECT 1 FROM conversations WHERE chat_id = ?", (chat_id,)
+                ).fetchone()
+                new_chats += exists is None
+                # В SET справа везде старые значения строки
+                conn.execute(
+                    "INSERT INTO conversations (chat_id, first_message_at, last_message_at, "
+                    "last_snippet, last_role, username, message_count) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat_id) DO UPDATE SET "
+                    "first_message_at = MIN(COALESCE(first_message_at, excluded.first_message_at), "
+                    "excluded.first_message_at), "
+                    "last_snippet = CASE WHEN last_message_at IS NULL "
+                    "OR excluded.last_message_at > last_message_at "
+                    "THEN excluded.last_snippet ELSE last_snippet END, "
+                    "last_role = CASE WHEN last_message_at IS NULL "
+                    "OR excluded.last_message_at > last_message_at "
+                    "THEN excluded.last_role ELSE last_role END, "
+                    "last_message_at = MAX(COALESCE(last_message_at, ''), excluded.last_message_at), "
+                    "username = COALESCE(username, excluded.username), "
+                    "message_count = message_count + excluded.message_count",
+                    (chat_id, _ts(first), _ts(last["timestamp"]), last["text"][:SNIPPET_CHARS],
+                     last["role"], username, len(msgs)),
+                )
+            inserted = sum(len(msgs) for msgs in by_chat.values())
+            images = sum(1 for msgs in by_chat.values() for m in msgs if m["has_image"])
+            if inserted:
+                self._incr(conn, "total_messages", inserted)
+            if new_chats:
+                self._incr(conn, "total_chats", new_chats)
+            if images:
+                self._incr(conn, "total_images_analyzed", images)
+            return by_chat
+
+        by_chat = await self._tx(work)
+        for chat_id in by_chat:
+            self.history_cache.invalidate(chat_id)
+        return sum(len(msgs) for msgs in by_chat.values())
+
+    async def import_training_pairs(self, pairs):
+        if not pairs:
+            return 0
+        from .dedup import pair_hash
+        # Пары с уже известным хешем пропускаются; паре без хеша (старый
+        # экспорт) считаем его, иначе повторный импорт её задвоит
+        docs = [
+            p if p.get("hash") else dict(p, hash=pair_hash(
+                p.get("chat_id", ""), p["user_message"], p["admin_response"]
+            ))
+            for p in pairs
+        ]
+        return await self._tx(lambda conn: sum(
+            conn.execute(
+                "INSERT OR IGNORE INTO training_data (chat_id, hash, data) VALUES (?, ?, ?)",
+                (str(p.get("chat_id", "")), p["hash"], _dumps(p)),
+            ).rowcount
+            for p in docs
+        ))
+
+    # ── Жизненный цикл ────────────────────────────────────
+
+    async def migrate(self):
+        """Create or upgrade the schema; returns the schema version."""
+        def work():
+            conn = self._connect()
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for step, script in enumerate(SCHEMA[version:], start=version + 1):
+                logger.info(f"SQLite: схема версии {step}...")
+                conn.executescript(f"BEGIN; {script}; PRAGMA user_version = {step}; COMMIT;")
+                version = step
+            return version
+        return await self._run(work)
+
+    async def flush(self):
+        # Запись синхронная — буфера нет
+        return None
+
+    async def close(self):
+        def work():
+            if self._conn is not None:
+                self._conn.execute("PRAGMA optimize")
+                self._conn.close()
+                self._conn = None
+        await self._run(work)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,26 @@
+import logging
+import os
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+
+def create_storage():
+    """Build the storage backend selected by STORAGE_BACKEND.
+
+    Both backends expose the same methods (see BotDatabase); callers
+    never touch the underlying driver directly.
+    """
+    if BotConfig.STORAGE_BACKEND == "sqlite":
+        from .sqlite_database import SQLiteDatabase
+        logger.info(f"Хранилище: SQLite ({BotConfig.SQLITE_PATH})")
+        return SQLiteDatabase(BotConfig.SQLITE_PATH)
+
+    if BotConfig.STORAGE_BACKEND != "mongo":
+        raise ValueError(f"Неизвестный STORAGE_BACKEND: {BotConfig.STORAGE_BACKEND}")
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from .database import BotDatabase
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], tz_aware=True)
+    return BotDatabase(client[os.environ["DB_NAME"]])
@@ -0,0 +1,54 @@
+"""Online statistics of admin responses for the style profile.
+
+A scan feeds every new pair through `add()` once and never keeps the
+full list: averages and markers are running counters, and the pairs the
+AI analysis and few-shot selection pick from come from a fixed-size
+reservoir sample. Memory stays the same for a hundred chats or for ten
+thousand.
+"""
+import random
+
+# Пар в равномерной выборке для AI-анализа и few-shot
+SAMPLE_SIZE = 1000
+# Маркеры стиля ищем в первых ответах, как и раньше
+MARKER_RESPONSES = 50
+BASIC_EXAMPLES = 15
+
+INFORMAL_WORDS = ("бро", "братан", "чел", "го", "норм", "кста", "братуха", "ахах")
+FORMAL_WORDS = ("уважаемый", "обращаем ваше внимание", "рады сообщить")
+
+
+class StyleStats:
+    def __init__(self, sample_size=SAMPLE_SIZE, seed=42):
+        self.sample_size = sample_size
+        self.sample = []  # равномерная выборка пар (reservoir sampling)
+        self.count = 0
+        self.total_len = 0
+        self.uses_emoji = False
+        self.uses_informal = False
+        self.uses_formal = False
+        self.examples = []  # первые ответы подходящей длины — для базового профиля
+        self._random = random.Random(seed)
+
+    def add(self, pair):
+        response = pair["admin_response"]
+        self.count += 1
+        self.total_len += len(response)
+        if self.count <= MARKER_RESPONSES:
+            lowered = response.lower()
+            self.uses_emoji = self.uses_emoji or any(ord(c) > 0x1F600 for c in response)
+            self.uses_informal = self.uses_informal or any(w in lowered for w in INFORMAL_WORDS)
+            self.uses_formal = self.uses_formal or any(w in lowered for w in FORMAL_WORDS)
+        if len(self.examples) < BASIC_EXAMPLES and 20 < len(response) < 500:
+            self.examples.append(response)
+
+        if len(self.sample) < self.sample_size:
+            self.sample.append(pair)
+        else:
+            slot = self._random.randrange(self.count)
+            if slot < self.sample_size:
+                self.sample[slot] = pair
+
+    @property
+    def avg_len(self):
+        return self.total_len / self.count if self.count else 0
@@ -1,22 +1,102 @@
 import asyncio
 import os
 import logging
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
 from .config import BotConfig
-from .database import BotDatabase
+from .dedup import near_duplicate_labels, unique_indices, pair_hash
 from .gemini_client import AIClient
+from .image_hash import get_screenshot_cache, image_fingerprint
 from .media_handler import parse_media_tags, find_media_file, list_media_files
+from .style_stats import StyleStats
 from .system_prompt import SYSTEM_PROMPT
+from .throttle import get_telegram_limiter
+from .tts_cache import get_tts_cache
 from .voice_handler import get_voice_handler
 
 logger = logging.getLogger(__name__)
 
+# Сколько раз продолжать историю чата после FloodWait
+SCAN_FLOOD_RETRIES = 3
+# Меньше новых пар — профиль стиля при рескане не пересчитывается
+STYLE_REFRESH_MIN_PAIRS = 20
+# Пары чата пишутся в training_data пачками такого размера
+SCAN_PAIR_BATCH = 200
+
+# Описание скриншота для кэша: без обращения к клиенту и без ответа, чтобы
+# его можно было подставить в диалог любого чата
+SCREENSHOT_DESCRIBE_SYSTEM = (
+    "Ты извлекаешь информацию из скриншотов для службы поддержки. "
+    "Не отвечай пользователю и не давай советов."
+)
+SCREENSHOT_DESCRIBE_PROMPT = (
+    "Опиши, что на скриншоте: какое приложение или экран, какая ошибка или проблема. "
+    "Текст ошибок и кодов приведи дословно. 2–5 предложений, только факты."
+)
+
+
+class _PairExtractor:
+    """(user → admin) pairs from a chat history read newest → oldest, the
+    order Telegram returns it in.
+
+    Only the pair being assembled is kept: the run of admin messages and
+    the run of client messages before it. A pair closes when an older
+    message starts a new admin run (or breaks the dialog) and is returned
+    from `feed()` right away. Multi-message turns on both sides are joined.
+
+    `resume_id` is the oldest client message of the unanswered tail, so a
+    pair split across two scans is not lost; None when nothing is pending.
+    """
+
+    def __init__(self, my_id):
+        self.my_id = my_id
+        self.admin_texts = []  # от новых к старым
+        self.user_texts = []
+        self.tail = True  # ответа оператора ещё не было — клиент ждёт ответа
+        self.resume_id = None
+        self.pair_messages = 0
+
+    def feed(self, msg):
+        """Next (older) text message; returns the pair it closes, if any."""
+        sender = msg.from_user.id if msg.from_user else None
+        if sender is not None and sender != self.my_id:
+            if self.tail:
+                self.resume_id = msg.id
+            elif self.admin_texts:
+                self.user_texts.append(msg.text)
+            return None
+        self.tail = False
+        if sender is None:
+            # Служебное/анонимное сообщение разрывает диалог
+            pair = self.finish()
+            self.admin_texts = []
+            return pair
+        if self.user_texts:
+            pair = self.finish()
+            self.admin_texts = [msg.text]
+            return pair
+        self.admin_texts.append(msg.text)
+        return None
+
+    def finish(self):
+        """Close the pair in progress (end of the fetched history)."""
+        pair = None
+        if self.user_texts and self.admin_texts:
+            pair = {
+                "user": "\n".join(reversed(self.user_texts)),
+                "admin": "\n".join(reversed(self.admin_texts)),
+            }
+            self.pair_messages += len(self.user_texts) + len(self.admin_texts)
+        self.user_texts = []
+        return pair
+
 
 class SupportAIBot:
-    def __init__(self, db_instance):
-        self.database = BotDatabase(db_instance)
+    def __init__(self, database):
+        # BotDatabase или SQLiteDatabase — см. bot/storage.py
+        self.database = database
         self.admin_id = BotConfig.ADMIN_USER_ID
         self.silence_duration = BotConfig.SILENCE_DURATION_MIN
         self.history_limit = BotConfig.HISTORY_LIMIT
@@ -25,7 +105,6 @@ class SupportAIBot:
         self._phone_code_hash = None
         self._api_id = BotConfig.TELEGRAM_API_ID
         self._api_hash = BotConfig.TELEGRAM_API_HASH
-        self._db_instance = db_instance
 
     def set_creds(self, api_id, api_hash):
         self._api_id = str(api_id)
@@ -45,7 +124,7 @@ class SupportAIBot:
 
     async def _get_ai_client(self):
         """Создать AI клиент из текущих настроек в БД."""
-        doc = await self._db_instance.ai_settings.find_one({"_id": "main"}, {"_id": 0})
+        doc = await self.database.get_doc("ai_settings")
         gemini_key = os.environ.get("GEMINI_API_KEY", "")
         if not doc:
             return AIClient(provider="gemini", model="gemini-2.0-flash", api_key=gemini_key)
@@ -64,14 +143,14 @@ class SupportAIBot:
 
     async def _get_temperature(self):
         """Получить температуру AI из конфига."""
-        doc = await self._db_instance.bot_config.find_one({"_id": "main"}, {"_id": 0})
+        doc = await self.database.get_doc("bot_config")
         if doc:
             return doc.get("temperature", 0.7)
         return 0.7
 
     async def _get_voice_settings(self):
         """Get voice settings from DB."""
-        doc = await self._db_instance.voice_settings.find_one({"_id": "main"}, {"_id": 0})
+        doc = await self.database.get_doc("voice_settings")
         if not doc:
             return {
                 "voice_enabled": False,
@@ -91,13 +170,11 @@ class SupportAIBot:
 
     async def _get_system_prompt_async(self):
         """Build system prompt using custom prompt from DB if available."""
-        custom_doc = await self.database.db.custom_prompt.find_one({"_id": "main"}, {"_id": 0})
+        custom_doc = await self.database.get_doc("custom_prompt")
         custom_prompt = custom_doc.get("prompt", "") if custom_doc else ""
 
         media_files = list_media_files()
-        rules = {}
-        async for r in self.database.db.media_rules.find({}, {"_id": 0}):
-            rules[r["tag"]] = r["description"]
+        rules = {r["tag"]: r["description"] for r in await self.database.get_media_rules()}
 
         if media_files:
             templates_str = "\n".join(
@@ -109,7 +186,7 @@ class SupportAIBot:
             templates_str = "Медиа-шаблоны отсутствуют."
 
         # Get style profile and few-shot examples from training data
-        style_doc = await self.database.db.style_profile.find_one({"_id": "main"}, {"_id": 0})
+        style_doc = await self.database.get_doc("style_profile")
         style_section = ""
         training_enabled = style_doc.get("training_enabled", True) if style_doc else True
 
@@ -194,14 +271,10 @@ class SupportAIBot:
         self._phone_code_hash = sent_code.phone_code_hash
 
         # Persist phone_code_hash in DB so it survives server restarts
-        await self._db_instance.bot_status.update_one(
-            {"_id": "main"},
-            {"$set": {
-                "phone_code_hash": sent_code.phone_code_hash,
-                "auth_phone": phone_number
-            }},
-            upsert=True
-        )
+        await self.database.update_doc("bot_status", {
+            "phone_code_hash": sent_code.phone_code_hash,
+            "auth_phone": phone_number
+        })
 
         logger.info(f"Auth code sent to {phone_number}")
         return {"status": "code_sent", "phone_code_hash": sent_code.phone_code_hash}
@@ -210,7 +283,7 @@ class SupportAIBot:
         """Step 2: Verify the auth code."""
         # Try to recover phone_code_hash from DB if lost (e.g. server restart)
         if not self._phone_code_hash:
-            doc = await self._db_instance.bot_status.find_one({"_id": "main"}, {"_id": 0})
+            doc = await self.database.get_doc("bot_status")
             if doc:
                 self._phone_code_hash = doc.get("phone_code_hash")
 
@@ -232,9 +305,8 @@ class SupportAIBot:
             user = await self.app.sign_in(phone_number, self._phone_code_hash, code)
             await self.app.disconnect()
             # Clean up auth state from DB
-            await self._db_instance.bot_status.update_one(
-                {"_id": "main"},
-                {"$unset": {"phone_code_hash": "", "auth_phone": ""}}
+            await self.database.update_doc(
+                "bot_status", unset=["phone_code_hash", "auth_phone"], upsert=False
             )
             logger.info(f"Auth successful: {user.first_name}")
             return {"status": "authorized", "user": user.first_name}
@@ -298,25 +370,64 @@ class SupportAIBot:
             await self.app.stop()
             await self.database.update_bot_status(is_running=False)
             await self.database.log_activity("bot_stopped", details="Support AI бот остановлен")
+            await self.database.flush()
             self._running = False
             logger.info("Bot stopped")
 
-    async def scan_dialogs(self, max_chats=50, messages_per_chat=100):
-        """Scan existing Telegram dialogs and extract training data from admin's responses."""
+    async def scan_dialogs(self, max_chats=50, messages_per_chat=100, concurrency=None, full=False,
+                           progress=None):
+        """Scan existing Telegram dialogs and extract training data from admin's responses.
+
+        Histories are fetched by `concurrency` workers at once; all of them
+        share the Telegram rate limiter, so a FloodWait pauses every worker
+        and the chat resumes where it stopped.
+
+        Rescans are incremental: every chat keeps a checkpoint (last seen
+        message id), only newer messages are fetched and pairs are upserted
+        by content hash. `full=True` (or no checkpoints yet) starts over.
+        Checkpoints are saved chat by chat, so an interrupted scan resumes
+        with an incremental one. A full scan marks the style profile for
+        rebuild: until a scan completes, the profile and few-shot set are
+        built from all stored pairs, never merged with the replaced ones.
+
+        Each history is streamed through `_PairExtractor`: pairs are written
+        in batches of SCAN_PAIR_BATCH as they close and only the online
+        StyleStats (with a fixed-size sample) is kept for the style profile,
+        so memory does not grow with max_chats × messages_per_chat.
+
+        `progress(phase=None, **counters)` is called as the scan advances
+        (see bot/jobs.py).
+        """
         if not self.app or not self._running:
             raise ValueError("Бот должен быть запущен для сканирования")
 
+        concurrency = max(1, concurrency or BotConfig.SCAN_CONCURRENCY)
+        progress = progress or (lambda phase=None, **counters: None)
+        progress("dialogs")
+        limiter = get_telegram_limiter()
+        flood_waits_before = limiter.flood_waits
+        started = time.monotonic()
+
         me = await self.app.get_me()
         my_id = me.id
-        training_examples = []
-        scanned_chats = 0
-        total_messages = 0
         skipped_chats = 0
+        unchanged_chats = 0
+
+        checkpoints = {} if full else await self.database.get_scan_checkpoints()
+        incremental = bool(checkpoints)
+        if not incremental:
+            # Прежний профиль работает до конца скана, но с новыми парами
+            # его уже не смешиваем — даже если скан прервётся и продолжится
+            await self.database.update_doc("style_profile", {"rebuild_pending": True})
+            await self.database.clear_training_pairs()
+            await self.database.clear_scan_checkpoints()
 
         await self.database.log_activity(
-            "scan_started", details=f"Сканирование личных диалогов (до {max_chats} чатов)"
+            "scan_started",
+            details=f"{'Дозагрузка' if incremental else 'Сканирование'} личных диалогов (до {max_chats} чатов)"
         )
 
+        candidates = []
         async for dialog in self.app.get_dialogs(limit=max_chats * 3):
             # ONLY private (personal) chats — skip groups, channels, bots
             if dialog.chat.type.value != "private":
@@ -328,137 +439,253 @@ class SupportAIBot:
             if getattr(dialog.chat, 'is_bot', False):
                 skipped_chats += 1
                 continue
-
-            if scanned_chats >= max_chats:
-                break
-
-            chat_id = dialog.chat.id
-            username = dialog.chat.username or ""
-            first_name = dialog.chat.first_name or ""
-            pair_buffer = []
-
-            try:
-                messages_list = []
-                async for msg in self.app.get_chat_history(chat_id, limit=messages_per_chat):
-                    if msg.text:
-                        messages_list.append(msg)
-
-                # Reverse to chronological order
-                messages_list.reverse()
-
-                # Extract conversation pairs with context
-                # Support multi-message admin responses (admin sends 2-3 msgs in a row)
-                i = 0
-                while i < len(messages_list) - 1:
-                    curr = messages_list[i]
-                    is_user_msg = curr.from_user and curr.from_user.id != my_id
-
-                    if is_user_msg and curr.text:
-                        # Collect user's message(s) — could be multiple in a row
-                        user_texts = [curr.text]
-                        j = i + 1
-                        while j < len(messages_list):
-                            nxt = messages_list[j]
-                            if nxt.from_user and nxt.from_user.id != my_id and nxt.text:
-                                user_texts.append(nxt.text)
-                                j += 1
-                            else:
-                                break
-
-                        # Now collect admin's response(s) — could be multiple in a row
-                        admin_texts = []
-                        while j < len(messages_list):
-                            nxt = messages_list[j]
-                            if nxt.from_user and nxt.from_user.id == my_id and nxt.text:
-                                admin_texts.append(nxt.text)
-                                j += 1
-                            else:
-                                break
-
-                        if admin_texts:
-                            pair_buffer.append({
-                                "user": "\n".join(user_texts),
-                                "admin": "\n".join(admin_texts)
-                            })
-                            total_messages += len(user_texts) + len(admin_texts)
-
-                        i = j
-                    else:
-                        i += 1
-
-                if pair_buffer:
-                    training_examples.append({
-                        "chat_id": str(chat_id),
+            checkpoint = checkpoints.get(str(dialog.chat.id))
+            top = getattr(dialog, "top_message", None)
+            top_id = top.id if top else 0
+            if checkpoint and top_id <= checkpoint["last_message_id"]:
+                # Новых сообщений нет — историю не запрашиваем
+                unchanged_chats += 1
+                continue
+            candidates.append((dialog.chat, checkpoint, top_id))
+
+        progress("fetch", chats_total=len(candidates), chats_done=0, unchanged_chats=unchanged_chats,
+                 pairs_found=0, new_pairs=0)
+        queue = asyncio.Queue()
+        for item in candidates:
+            queue.put_nowait(item)
+        style_stats = StyleStats()
+        counts = {"chats": 0, "done": 0, "scanned": 0, "messages": 0, "fetched": 0, "pairs": 0, "new": 0}
+
+        async def store(batch):
+            stored = await self.database.upsert_training_pairs(batch)
+            counts["pairs"] += len(batch)
+            counts["new"] += len(stored)
+            for pair in stored:
+                style_stats.add(pair)
+            progress(pairs_found=counts["pairs"], new_pairs=counts["new"])
+            batch.clear()
+            return len(stored)
+
+        async def worker():
+            while counts["scanned"] < max_chats:
+                try:
+                    chat, checkpoint, top_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                counts["chats"] += 1
+                chat_id = str(chat.id)
+                username = chat.username or ""
+                extractor = _PairExtractor(my_id)
+                history = self._iter_chat_history(
+                    chat.id, messages_per_chat, min_id=checkpoint["resume_id"] if checkpoint else 0, counts=counts
+                )
+                newest = None
+                batch = []
+                stored = 0
+                failed = False
+                while True:
+                    try:
+                        msg = await history.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    except Exception as e:
+                        logger.warning(f"Ошибка сканирования чата {chat.id}: {e}")
+                        failed = True
+                        break
+                    newest = newest or msg
+                    pair = extractor.feed(msg)
+                    if pair:
+                        batch.append(self._pair_doc(pair, chat_id, username))
+                        # Пары пишутся пачками по мере закрытия — в памяти не больше одной пачки
+                        if len(batch) >= SCAN_PAIR_BATCH:
+                            stored += await store(batch)
+                if not failed:
+                    pair = extractor.finish()
+                    if pair:
+                        batch.append(self._pair_doc(pair, chat_id, username))
+                if batch:
+                    stored += await store(batch)
+                if failed:
+                    # Без чекпоинта: чат перечитается, записанные пары отсеет хеш
+                    continue
+                counts["done"] += 1
+                progress(chats_done=counts["done"], fetched_messages=counts["fetched"])
+                last_message_id = max(top_id, checkpoint["last_message_id"] if checkpoint else 0)
+                if newest is None:
+                    # Только медиа/служебные — запоминаем, чтобы не качать снова
+                    update = {"last_message_id": last_message_id, "scanned_at": datetime.now(timezone.utc)}
+                    if not checkpoint:
+                        update.update(resume_id=last_message_id + 1, pairs=0)
+                else:
+                    update = {
+                        "last_message_id": max(last_message_id, newest.id),
+                        "resume_id": extractor.resume_id or newest.id + 1,
+                        "last_message_at": newest.date,
                         "username": username,
-                        "first_name": first_name,
-                        "pairs": pair_buffer
-                    })
-                    scanned_chats += 1
+                        "pairs": (checkpoint.get("pairs", 0) if checkpoint else 0) + stored,
+                        "scanned_at": datetime.now(timezone.utc),
+                    }
+                # Чекпоинт сразу после записи пар: прерванный скан продолжится с этого места
+                await self.database.save_scan_checkpoints({chat_id: update})
+                checkpoints[chat_id] = {**(checkpoint or {}), **update}
+                if stored:
+                    counts["scanned"] += 1
+                    counts["messages"] += extractor.pair_messages
+
+        workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(candidates)) or 1)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # Ошибка одного воркера (например, БД) останавливает остальных
+            for task in workers:
+                task.cancel()
+
+        new_pairs = counts["new"]
+        scanned_chats = counts["scanned"]
+        total_messages = counts["messages"]
+        elapsed = max(time.monotonic() - started, 0.001)
+        throughput = {
+            "concurrency": concurrency,
+            "elapsed_sec": round(elapsed, 1),
+            "fetched_messages": counts["fetched"],
+            "chats_per_sec": round(counts["chats"] / elapsed, 2),
+            "messages_per_sec": round(counts["fetched"] / elapsed, 1),
+            "flood_waits": limiter.flood_waits - flood_waits_before,
+        }
+        logger.info(f"Scan fetch: {counts['chats']} chats, {throughput}")
+
+        progress("analyze")
+        total_pairs = await self.database.count_training_pairs()
+        style_doc = await self.database.get_doc("style_profile") or {}
+        # Сколько пар не отражено в текущем профиле
+        fresh_pairs = new_pairs
+        if style_doc.get("rebuild_pending"):
+            # Полный скан (или его продолжение): профиль строится заново по
+            # всем записанным парам, включая пары прерванного запуска
+            style_doc = {}
+            if incremental:
+                style_stats = StyleStats()
+                async for pair in self.database.iter_training_pairs():
+                    style_stats.add(pair)
+                fresh_pairs = style_stats.count
+        previous_profile = style_doc.get("profile", "")
+        # Прежние примеры снова участвуют в отборе вместе с новыми парами
+        previous_examples = [
+            {"user_message": ex["user"], "admin_response": ex["admin"]}
+            for ex in style_doc.get("few_shot_examples", [])
+        ]
 
-            except Exception as e:
-                logger.warning(f"Ошибка сканирования чата {chat_id}: {e}")
-                continue
+        # Новые пары представлены равномерной выборкой фиксированного размера
+        style_pairs = previous_examples + style_stats.sample
+        # Кластеры почти одинаковых ответов — один индекс на оба отбора
+        labels = near_duplicate_labels([p["admin_response"] for p in style_pairs]) if fresh_pairs else None
+        if previous_profile and fresh_pairs < STYLE_REFRESH_MIN_PAIRS:
+            # Мало нового — профиль прежний, AI не вызываем
+            style_profile = previous_profile
+        else:
+            style_profile = await self._analyze_style_with_ai(
+                style_pairs, style_stats, previous_profile=previous_profile, labels=labels
+            )
 
-        # Store training data in MongoDB
-        await self._db_instance.training_data.delete_many({})
-
-        # Save all pairs as flat documents
-        all_pairs = []
-        for example in training_examples:
-            for pair in example["pairs"]:
-                all_pairs.append({
-                    "user_message": pair["user"],
-                    "admin_response": pair["admin"],
-                    "chat_id": example["chat_id"],
-                    "username": example["username"]
-                })
-
-        if all_pairs:
-            await self._db_instance.training_data.insert_many(all_pairs)
-
-        # Build style profile — use AI if possible, fallback to basic analysis
-        style_profile = await self._analyze_style_with_ai(all_pairs)
-
-        # Select best few-shot examples for the system prompt
-        few_shot_examples = self._select_few_shot_examples(all_pairs, max_count=25)
-
-        await self._db_instance.style_profile.update_one(
-            {"_id": "main"},
-            {"$set": {
-                "profile": style_profile,
-                "few_shot_examples": few_shot_examples,
-                "total_examples": len(all_pairs),
-                "scanned_chats": scanned_chats,
-                "scanned_at": datetime.now(timezone.utc).isoformat()
-            }},
-            upsert=True
+        few_shot_examples = (
+            self._select_few_shot_examples(style_pairs, max_count=25, labels=labels)
+            if fresh_pairs else style_doc.get("few_shot_examples", [])
         )
 
+        await self.database.update_doc("style_profile", {
+            "profile": style_profile,
+            "few_shot_examples": few_shot_examples,
+            "total_examples": total_pairs,
+            "scanned_chats": sum(1 for cp in checkpoints.values() if cp.get("pairs")),
+            "scanned_at": datetime.now(timezone.utc).isoformat()
+        }, unset=["rebuild_pending"])
+
         await self.database.log_activity(
             "scan_completed",
-            details=f"Просканировано {scanned_chats} личных чатов, {len(all_pairs)} пар сообщений, пропущено {skipped_chats} не-личных"
+            details=f"Просканировано {scanned_chats} личных чатов, {new_pairs} новых пар сообщений, "
+                    f"без изменений {unchanged_chats}, пропущено {skipped_chats} не-личных"
         )
 
-        logger.info(f"Scan complete: {scanned_chats} private chats, {len(all_pairs)} pairs, skipped {skipped_chats}")
+        logger.info(
+            f"Scan complete: {scanned_chats} private chats, {new_pairs} new pairs "
+            f"({total_pairs} total), unchanged {unchanged_chats}, skipped {skipped_chats}"
+        )
         return {
+            "incremental": incremental,
             "scanned_chats": scanned_chats,
-            "total_pairs": len(all_pairs),
+            "unchanged_chats": unchanged_chats,
+            "new_pairs": new_pairs,
+            "total_pairs": total_pairs,
             "total_messages": total_messages,
             "skipped_non_private": skipped_chats,
             "style_profile": style_profile,
-            "few_shot_count": len(few_shot_examples)
+            "few_shot_count": len(few_shot_examples),
+            **throughput,
         }
 
-    async def _analyze_style_with_ai(self, all_pairs):
-        """Use AI to deeply analyze the admin's communication style."""
+    async def _iter_chat_history(self, chat_id, limit, min_id=0, counts=None):
+        """Text messages of a chat with id >= min_id, newest first, as they
+        arrive; `counts["fetched"]` counts every message received.
+
+        FloodWait pauses the shared limiter and the fetch resumes from the
+        last received message instead of starting over.
+        """
+        from pyrogram.errors import FloodWait
+
+        limiter = get_telegram_limiter()
+        fetched = 0
+        offset_id = 0
+        for _ in range(SCAN_FLOOD_RETRIES + 1):
+            try:
+                await limiter.acquire()
+                async for msg in self.app.get_chat_history(chat_id, limit=limit - fetched, offset_id=offset_id):
+                    # История идёт от новых к старым — дальше всё уже разобрано
+                    if msg.id < min_id:
+                        return
+                    fetched += 1
+                    offset_id = msg.id
+                    if counts is not None:
+                        counts["fetched"] += 1
+                    if msg.text:
+                        yield msg
+                    # Pyrogram запрашивает историю страницами по 100 сообщений
+                    if fetched % 100 == 0 and fetched < limit:
+                        await limiter.acquire()
+                return
+            except FloodWait as e:
+                wait = int(e.value or 1)
+                if wait > BotConfig.SCAN_MAX_FLOOD_WAIT_SEC:
+                    raise
+                limiter.pause(wait)
+        raise RuntimeError(f"FloodWait: история чата не получена за {SCAN_FLOOD_RETRIES + 1} попыток")
+
+    @staticmethod
+    def _pair_doc(pair, chat_id, username):
+        return {
+            "user_message": pair["user"],
+            "admin_response": pair["admin"],
+            "chat_id": chat_id,
+            "username": username,
+            "hash": pair_hash(chat_id, pair["user"], pair["admin"]),
+        }
+
+    async def _analyze_style_with_ai(self, all_pairs, stats, previous_profile="", labels=None):
+        """Use AI to deeply analyze the admin's communication style.
+
+        `all_pairs` is the sample to pick dialogs from (`labels` — its
+        near-duplicate clusters, if known), `stats` the online StyleStats of
+        every new pair (for the basic fallback). With
+        `previous_profile` (incremental rescan) the AI refines the existing
+        profile using the new dialogs instead of starting over.
+        """
         if not all_pairs:
-            return ""
+            return previous_profile
 
         try:
             ai_client = await self._get_ai_client()
 
             # Select a diverse sample of pairs for analysis (up to 60)
-            sample = self._select_diverse_pairs(all_pairs, max_count=60)
+            sample = self._select_diverse_pairs(all_pairs, max_count=60, labels=labels)
 
             # Format conversation pairs for AI analysis
             conversations_text = ""
@@ -485,6 +712,12 @@ class SupportAIBot:
                 "НЕ пиши примеры диалогов, только инструкции по стилю.\n"
                 "Пиши кратко и по делу, максимум 500 слов."
             )
+            if previous_profile:
+                analysis_prompt += (
+                    "\n\nУ тебя уже есть профиль, составленный по прошлым диалогам. "
+                    "Уточни и дополни его по новым примерам, сохрани то, что они не опровергают, "
+                    "и верни профиль целиком.\n\nТЕКУЩИЙ ПРОФИЛЬ:\n" + previous_profile
+                )
 
             response = await ai_client.get_response(
                 "style_analysis_session",
@@ -498,30 +731,38 @@ class SupportAIBot:
 
         except Exception as e:
             logger.warning(f"AI style analysis failed, using basic fallback: {e}")
+            if previous_profile:
+                return previous_profile
             # Fallback to basic analysis
-            admin_responses = [p["admin_response"] for p in all_pairs]
-            return self._analyze_style_basic(admin_responses)
+            return self._analyze_style_basic(stats)
 
-    def _select_diverse_pairs(self, pairs, max_count=60):
-        """Select diverse representative conversation pairs."""
+    def _select_diverse_pairs(self, pairs, max_count=60, labels=None):
+        """Select diverse representative conversation pairs.
+
+        Near-duplicate responses (MinHash clusters, see bot/dedup.py) are
+        taken once; pass `labels` when the clusters of `pairs` are known.
+        """
         if not pairs:
             return []
+        if labels is None:
+            labels = near_duplicate_labels([p.get("admin_response", "") for p in pairs])
 
         # Filter quality pairs (not too short, not too long)
-        good_pairs = [
-            p for p in pairs
+        good = [
+            i for i, p in enumerate(pairs)
             if 5 < len(p.get("admin_response", "")) < 1500
             and len(p.get("user_message", "")) > 2
         ]
 
-        if not good_pairs:
-            good_pairs = pairs
+        if not good:
+            good = range(len(pairs))
+        good_pairs = [pairs[i] for i in unique_indices(labels, good)]
 
         if len(good_pairs) <= max_count:
             return good_pairs
 
         import random
-        random.seed(42)  # Reproducible selection
+        rng = random.Random(42)  # Reproducible selection
 
         # Sort by response length to get diverse lengths
         sorted_by_len = sorted(good_pairs, key=lambda p: len(p["admin_response"]))
@@ -532,65 +773,57 @@ class SupportAIBot:
 
         # Ensure we have some short, medium and long responses
         if len(selected) < max_count:
-            remaining = [p for p in good_pairs if p not in selected]
-            random.shuffle(remaining)
+            taken = {id(p) for p in selected}
+            remaining = [p for p in good_pairs if id(p) not in taken]
+            rng.shuffle(remaining)
             selected.extend(remaining[:max_count - len(selected)])
 
         return selected[:max_count]
 
-    def _select_few_shot_examples(self, all_pairs, max_count=25):
-        """Select the best conversation examples for few-shot prompting."""
+    def _select_few_shot_examples(self, all_pairs, max_count=25, labels=None):
+        """Select the best conversation examples for few-shot prompting.
+
+        Paraphrases of the same response are one cluster and give a single
+        example; pass `labels` when the clusters of `all_pairs` are known.
+        """
         if not all_pairs:
             return []
+        if labels is None:
+            labels = near_duplicate_labels([p.get("admin_response", "") for p in all_pairs])
 
         # Filter good quality pairs
-        good_pairs = [
-            p for p in all_pairs
+        good = [
+            i for i, p in enumerate(all_pairs)
             if 20 < len(p.get("admin_response", "")) < 600
             and 5 < len(p.get("user_message", "")) < 300
         ]
 
-        if not good_pairs:
-            good_pairs = [p for p in all_pairs if len(p.get("admin_response", "")) > 10]
+        if not good:
+            good = [i for i, p in enumerate(all_pairs) if len(p.get("admin_response", "")) > 10]
 
-        if len(good_pairs) <= max_count:
-            return [{"user": p["user_message"], "admin": p["admin_response"]} for p in good_pairs]
-
-        import random
-        random.seed(42)
-
-        # Deduplicate similar responses (keep unique ones)
-        seen_starts = set()
-        unique_pairs = []
-        for p in good_pairs:
-            start = p["admin_response"][:40].lower().strip()
-            if start not in seen_starts:
-                seen_starts.add(start)
-                unique_pairs.append(p)
+        # Deduplicate similar responses (keep the first of each cluster)
+        unique_pairs = [all_pairs[i] for i in unique_indices(labels, good)]
 
-        # Sort by diversity of response length
-        unique_pairs.sort(key=lambda p: len(p["admin_response"]))
+        if len(unique_pairs) > max_count:
+            # Sort by diversity of response length
+            unique_pairs.sort(key=lambda p: len(p["admin_response"]))
 
-        # Take evenly spaced samples
-        step = max(1, len(unique_pairs) // max_count)
-        selected = unique_pairs[::step][:max_count]
+            # Take evenly spaced samples
+            step = max(1, len(unique_pairs) // max_count)
+            unique_pairs = unique_pairs[::step][:max_count]
 
-        return [{"user": p["user_message"], "admin": p["admin_response"]} for p in selected]
+        return [{"user": p["user_message"], "admin": p["admin_response"]} for p in unique_pairs]
 
-    def _analyze_style_basic(self, responses):
-        """Basic fallback style analysis without AI."""
-        if not responses:
+    def _analyze_style_basic(self, stats):
+        """Basic fallback style analysis without AI, from StyleStats."""
+        if not stats.count:
             return ""
 
-        avg_len = sum(len(r) for r in responses) / len(responses)
-        uses_emoji = any(any(ord(c) > 0x1F600 for c in r) for r in responses[:50])
-        uses_informal = any(word in " ".join(responses[:50]).lower()
-                          for word in ["бро", "братан", "чел", "го", "норм", "кста", "братуха", "ахах"])
-        uses_formal = any(word in " ".join(responses[:50]).lower()
-                         for word in ["уважаемый", "обращаем ваше внимание", "рады сообщить"])
-
-        good_examples = [r for r in responses if 20 < len(r) < 500]
-        sample = good_examples[:15] if len(good_examples) > 15 else good_examples
+        avg_len = stats.avg_len
+        uses_emoji = stats.uses_emoji
+        uses_informal = stats.uses_informal
+        uses_formal = stats.uses_formal
+        sample = stats.examples
 
         style_parts = []
         style_parts.append(f"Средняя длина ответа: ~{int(avg_len)} символов.")
@@ -616,13 +849,44 @@ class SupportAIBot:
 
         return profile
 
+    async def _send_voice_reply(self, chat_id, text, voice_id, tts_model, tts_language):
+        """Send a TTS reply, reusing cached Opus blobs and Telegram file_ids."""
+        tts_cache = get_tts_cache()
+        cache_key = tts_cache.make_key(text, voice_id, tts_model, tts_language)
+        entry = await tts_cache.lookup(cache_key)
+
+        if entry and entry.get("file_id"):
+            try:
+                await self.app.send_voice(chat_id, entry["file_id"])
+                return
+            except Exception as e:
+                logger.warning(f"Cached voice file_id rejected, re-uploading: {e}")
+                await tts_cache.forget_file_id(cache_key)
+
+        audio = await tts_cache.load(cache_key) if entry else None
+        if audio is None:
+            audio = await get_voice_handler().synthesize(
+                text, voice_id, model_id=tts_model, language=tts_language
+            )
+            if audio.name.endswith(".ogg"):
+                await tts_cache.store(cache_key, audio)
+
+        if audio.name.endswith(".ogg"):
+            sent = await self.app.send_voice(chat_id, audio)
+            voice = getattr(sent, "voice", None)
+            if voice and voice.file_id:
+                await tts_cache.set_file_id(cache_key, voice.file_id)
+        else:
+            # MP3 fallback — send as audio file
+            await self.app.send_audio(chat_id, audio)
+
     async def _on_user_message(self, message):
         chat_id = message.chat.id
         username = message.from_user.username if message.from_user else None
         is_voice_input = False
 
         # Проверяем auto_reply — если выключен, ИИ не отвечает
-        config_doc = await self._db_instance.bot_config.find_one({"_id": "main"}, {"_id": 0})
+        config_doc = await self.database.get_doc("bot_config")
         if config_doc and not config_doc.get("auto_reply", True):
             logger.info(f"Авто-ответ выключен, пропуск сообщения от {chat_id}")
             return
@@ -661,14 +925,24 @@ class SupportAIBot:
             # ── Обработка голосовых сообщений ───────────────────────
             if message.voice or message.audio:
                 is_voice_input = True
-                voice_path = await message.download()
+                media = message.voice or message.audio
 
                 # Transcribe voice to text
                 voice_handler = get_voice_handler()
                 if voice_handler.is_configured:
                     try:
-                        stt_model = voice_settings.get("stt_model", "scribe_v2")
-                        transcribed_text = await voice_handler.transcribe(voice_path, model_id=stt_model)
+                        # Пересланные/повторные голосовые не распознаём дважды
+                        transcribed_text = await self.database.get_cached_transcript(media.file_unique_id)
+                        if transcribed_text is None:
+                            stt_model = voice_settings.get("stt_model", "scribe_v2")
+                            audio_file = await message.download(in_memory=True)
+                            transcribed_text = await voice_handler.transcribe(
+                                audio_file, model_id=stt_model, duration=media.duration
+                            )
+                            if transcribed_text:
+                                await self.database.cache_transcript(
+                                    media.file_unique_id, transcribed_text, stt_model
+                                )
                         user_text = transcribed_text or "[голосовое сообщение — не удалось распознать]"
                     except Exception as e:
                         logger.warning(f"Voice transcription failed: {e}")
@@ -682,9 +956,6 @@ class SupportAIBot:
                     f"Голосовое: {user_text[:80]}", username
                 )
 
-                if os.path.exists(voice_path):
-                    os.remove(voice_path)
-
                 # Обновляем статус пока AI думает
                 if will_send_voice:
                     await self.app.send_chat_action(chat_id, enums.ChatAction.RECORD_AUDIO)
@@ -712,16 +983,57 @@ class SupportAIBot:
                     await self.app.send_chat_action(chat_id, enums.ChatAction.TYPING)
 
                 history = await self.database.get_history(chat_id, self.history_limit)
-                response = await ai_client.analyze_image(
-                    str(chat_id), photo_path, system_prompt,
-                    message.caption or "Пользователь отправил скриншот. Проанализируй и помоги."
-                )
+
+                # Повторные скриншоты ищем по перцептивному хешу
+                screenshot_cache = get_screenshot_cache()
+                await screenshot_cache.ensure_loaded(self.database)
+                fingerprint = None
+                cached_analysis, distance, is_exact = None, None, False
+                try:
+                    fingerprint = await asyncio.to_thread(image_fingerprint, photo_path)
+                    cached_analysis, distance, is_exact = screenshot_cache.lookup(fingerprint)
+                except Exception as e:
+                    logger.warning(f"Не удалось посчитать хеш скриншота: {e}")
+
+                if ai_client.provider == "groq":
+                    # Groq не видит изображения — описания нет, кэшировать нечего
+                    response = await ai_client.analyze_image(
+                        str(chat_id), photo_path, system_prompt, message.caption
+                    )
+                    analyzed_details = "Скриншот получен (провайдер без vision)"
+                else:
+                    if cached_analysis and is_exact:
+                        # Тот же скриншот уже описан — vision не вызываем
+                        description = cached_analysis
+                        screenshot_cache.vision_calls_saved += 1
+                        analyzed_details = f"Скриншот из кэша (расстояние {distance})"
+                    else:
+                        describe_prompt = SCREENSHOT_DESCRIBE_PROMPT
+                        if cached_analysis:
+                            describe_prompt += (
+                                "\n\nПохожий скриншот ранее описан так (проверь, что изменилось):\n"
+                                f"{cached_analysis}"
+                            )
+                        description = await ai_client.analyze_image(
+                            str(chat_id), photo_path, SCREENSHOT_DESCRIBE_SYSTEM, describe_prompt
+                        )
+                        if fingerprint is not None:
+                            await screenshot_cache.add(self.database, fingerprint, description)
+                        analyzed_details = "Скриншот проанализирован"
+                    # Ответ строится для этого чата: его история, язык и персона
+                    user_text = (
+                        f"{message.caption or 'Пользователь отправил скриншот.'}\n\n"
+                        f"[Содержимое скриншота: {description}]"
+                    )
+                    response = await ai_client.get_response(
+                        str(chat_id), history, system_prompt, user_text
+                    )
 
                 if os.path.exists(photo_path):
                     os.remove(photo_path)
 
                 await self.database.log_activity(
-                    "image_analyzed", str(chat_id), "Скриншот проанализирован", username
+                    "image_analyzed", str(chat_id), analyzed_details, username
                 )
 
             # ── Обработка текстовых сообщений ────────────────────────
@@ -767,18 +1079,10 @@ class SupportAIBot:
                             tts_model = voice_settings.get("tts_model", "eleven_multilingual_v2")
                             tts_language = voice_settings.get("language", "ru")
                             await self.app.send_chat_action(chat_id, enums.ChatAction.RECORD_AUDIO)
-                            audio_path = await voice_handler.synthesize(
-                                clean_response, voice_id, model_id=tts_model, language=tts_language
+                            await self._send_voice_reply(
+                                chat_id, clean_response, voice_id, tts_model, tts_language
                             )
-                            if audio_path.endswith(".ogg"):
-                                await self.app.send_voice(chat_id, audio_path)
-                            else:
-                                # MP3 fallback — send as audio file
-                                await self.app.send_audio(chat_id, audio_path)
                             voice_sent = True
-                            # Clean up temp file
-                            if os.path.exists(audio_path):
-                                os.remove(audio_path)
                             await self.database.log_activity(
                                 "voice_sent", str(chat_id),
                                 f"Голосовой ответ: {clean_response[:60]}", username
@@ -858,7 +1162,7 @@ class SupportAIBot:
         chat_id = message.chat.id
         if chat_id != self.admin_id:
             # Read current silence duration from DB config (not cached value)
-            config_doc = await self._db_instance.bot_config.find_one({"_id": "main"}, {"_id": 0})
+            config_doc = await self.database.get_doc("bot_config")
             silence_min = (config_doc.get("silence_duration_min", self.silence_duration)
                           if config_doc else self.silence_duration)
 
@@ -874,13 +1178,13 @@ class SupportAIBot:
 _bot_instance = None
 
 
-def get_bot(db_instance):
+def get_bot(database):
     global _bot_instance
     if _bot_instance is None:
-        _bot_instance = SupportAIBot(db_instance)
+        _bot_instance = SupportAIBot(database)
     return _bot_instance
 
 
-async def start_bot(db_instance):
-    bot = get_bot(db_instance)
+async def start_bot(database):
+    bot = get_bot(database)
     await bot.start_listening()
@@ -0,0 +1,79 @@
+"""Shared rate limiting for Telegram API calls.
+
+A token bucket caps the request rate across all concurrent workers. When
+Telegram answers with FloodWait, `pause()` stops every worker for the
+requested time rather than only the one that hit the limit — the limit
+is per account, so the others would get the same error a moment later.
+"""
+import asyncio
+import logging
+import time
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = max(float(rate), 0.1)
+        self.burst = max(float(burst or rate), 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self.acquired = 0
+        self.waited_sec = 0.0
+        self.flood_waits = 0
+        self.flood_wait_sec = 0
+
+    async def acquire(self):
+        """Wait for a request slot (and for any FloodWait pause to end)."""
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            # _updated может быть в будущем (конец паузы) — время до него не копит токены
+            self._tokens = min(self.burst, self._tokens + max(now - self._updated, 0) * self.rate)
+            self._updated = max(now, self._updated)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.acquired += 1
+                self.waited_sec += now - started
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """FloodWait from Telegram: hold back every caller for `seconds`."""
+        until = time.monotonic() + seconds
+        if until > self._paused_until:
+            self._paused_until = until
+        # Бакет пуст после паузы и копится только с её конца —
+        # не отправляем пачку запросов разом
+        self._tokens = 0
+        self._updated = max(self._updated, self._paused_until)
+        self.flood_waits += 1
+        self.flood_wait_sec += seconds
+        logger.warning(f"Telegram FloodWait: пауза {seconds} с")
+
+    @property
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "acquired": self.acquired,
+            "waited_sec": round(self.waited_sec, 1),
+            "flood_waits": self.flood_waits,
+            "flood_wait_sec": self.flood_wait_sec,
+        }
+
+
+# Global instance — один на аккаунт Telegram
+_telegram_limiter = None
+
+
+def get_telegram_limiter() -> RateLimiter:
+    global _telegram_limiter
+    if _telegram_limiter is None:
+        _telegram_limiter = RateLimiter(BotConfig.TELEGRAM_RPS, burst=BotConfig.TELEGRAM_RPS * 2)
+    return _telegram_limiter
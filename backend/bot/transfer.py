@@ -0,0 +1,199 @@
+"""Streaming export and bulk import of chats and training data.
+
+The format is gzip-compressed NDJSON, one record per line:
+
+    {"type": "meta", "version": 1, "exported_at": "...", "include": [...]}
+    {"type": "style_profile", "profile": "...", ...}
+    {"type": "training_pair", "user_message": "...", "admin_response": "...", ...}
+    {"type": "message", "id": "...", "chat_id": "...", "role": "...", "text": "...", ...}
+
+Export walks storage cursors chat by chat (cold archive first, then hot
+messages) and compresses on the fly, so memory stays flat whatever the
+database size. Import reads the request body as a stream and writes in
+batches; messages already present are skipped, so a file can be
+imported twice safely.
+"""
+import json
+import logging
+import zlib
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+EXPORT_PARTS = ("messages", "training", "style")
+IMPORT_BATCH = 1000
+CHUNK_BYTES = 64 * 1024
+MAX_LINE_BYTES = 16 * 1024 * 1024
+MESSAGE_FIELDS = ("id", "chat_id", "role", "text", "username", "has_image", "timestamp")
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _line(record):
+    return (json.dumps(record, default=_json_default, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+# ── Экспорт ──────────────────────────────────────────────
+
+async def _records(database, archiver, include):
+    yield {
+        "type": "meta",
+        "version": FORMAT_VERSION,
+        "exported_at": datetime.now(timezone.utc),
+        "include": list(include),
+    }
+    if "style" in include:
+        style = await database.get_doc("style_profile")
+        if style:
+            yield {"type": "style_profile", **style}
+    if "training" in include:
+        async for pair in database.iter_training_pairs():
+            yield {"type": "training_pair", **pair}
+    if "messages" in include:
+        async for chat_id in database.iter_conversation_ids():
+            archived_ids = set()
+            if archiver is not None:
+                async for msg in archiver.iter_archived(chat_id):
+                    archived_ids.add(msg["id"])
+                    yield {"type": "message", **{k: msg.get(k) for k in MESSAGE_FIELDS}}
+            async for msg in database.iter_chat_messages(chat_id):
+                # После сбоя архивации сообщение может остаться и в сегменте, и в коллекции
+                if msg["id"] in archived_ids:
+                    continue
+                yield {"type": "message", **{k: msg.get(k) for k in MESSAGE_FIELDS}}
+
+
+async def export_stream(database, archiver=None, include=EXPORT_PARTS):
+    """Async generator of gzip NDJSON chunks (~CHUNK_BYTES each)."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    buf = bytearray()
+    lines = 0
+    async for record in _records(database, archiver, include):
+        buf += compressor.compress(_line(record))
+        lines += 1
+        if len(buf) >= CHUNK_BYTES:
+            yield bytes(buf)
+            buf.clear()
+    buf += compressor.flush()
+    yield bytes(buf)
+    logger.info(f"Экспорт: {lines} записей")
+
+
+# ── Импорт ───────────────────────────────────────────────
+
+async def _decompressed(chunks):
+    """Raw bytes of the body: gzip (also concatenated members) or plain NDJSON."""
+    decomp = None
+    first = True
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if first:
+            first = False
+            if chunk[:2] == b"\x1f\x8b":
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decomp is None:
+            yield chunk
+            continue
+        while chunk:
+            if decomp.eof:
+                # Следующий член склеенного gzip (cat a.gz b.gz)
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = decomp.decompress(chunk)
+            except zlib.error as e:
+                raise ImportFormatError(f"Повреждённый gzip: {e}")
+            if data:
+                yield data
+            chunk = decomp.unused_data if decomp.eof else b""
+    if decomp is not None and not decomp.eof:
+        raise ImportFormatError("Файл gzip обрезан")
+
+
+async def _lines(chunks):
+    pending = b""
+    async for data in _decompressed(chunks):
+        pending += data
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+        if len(pending) > MAX_LINE_BYTES:
+            raise ImportFormatError("Слишком длинная строка")
+    if pending.strip():
+        yield pending
+
+
+def _parse_message(record):
+    ts = datetime.fromisoformat(record["timestamp"])
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return {
+        "id": str(record.get("id") or ""),
+        "chat_id": str(record["chat_id"]),
+        "role": str(record.get("role") or "user"),
+        "text": str(record.get("text") or ""),
+        "username": record.get("username"),
+        "has_image": bool(record.get("has_image")),
+        "timestamp": ts,
+    }
+
+
+async def import_stream(database, chunks, batch_size=IMPORT_BATCH):
+    """Import an export file from an async iterator of byte chunks; returns counts."""
+    stats = {"messages": 0, "duplicates": 0, "training_pairs": 0, "style_profile": 0, "errors": 0}
+    messages, pairs = [], []
+
+    async def flush_messages():
+        inserted = await database.import_messages(messages)
+        stats["messages"] += inserted
+        stats["duplicates"] += len(messages) - inserted
+        messages.clear()
+
+    async def flush_pairs():
+        stats["training_pairs"] += await database.import_training_pairs(pairs)
+        pairs.clear()
+
+    async for line in _lines(chunks):
+        try:
+            record = json.loads(line)
+            kind = record.pop("type", None)
+            if kind == "message":
+                messages.append(_parse_message(record))
+            elif kind == "training_pair":
+                if not record.get("user_message") or not record.get("admin_response"):
+                    raise ValueError("пустая пара")
+                pairs.append(record)
+            elif kind == "style_profile":
+                await database.update_doc("style_profile", record)
+                stats["style_profile"] += 1
+            elif kind == "meta":
+                if record.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+                    raise ImportFormatError(f"Неизвестная версия формата: {record['version']}")
+            else:
+                raise ValueError(f"неизвестный тип {kind!r}")
+        except ImportFormatError:
+            raise
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            stats["errors"] += 1
+            if stats["errors"] <= 5:
+                logger.warning(f"Импорт: пропущена строка ({e})")
+            continue
+        if len(messages) >= batch_size:
+            await flush_messages()
+        if len(pairs) >= batch_size:
+            await flush_pairs()
+
+    await flush_messages()
+    await flush_pairs()
+    logger.info(f"Импорт: {stats}")
+    return stats
@@ -0,0 +1,205 @@
+import io
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import unicodedata
+from pathlib import Path
+
+from .config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "tts_index.json"
+# Отметки last_used от попаданий пишутся пачкой: каждые N попаданий или раз в T секунд
+TOUCH_FLUSH_COUNT = 50
+TOUCH_FLUSH_SEC = 300
+
+
+class TTSCache:
+    """Disk-backed LRU cache of synthesized voice replies (OGG/Opus).
+
+    Key is a hash of normalized text, voice, model and language. The index
+    (size, last use, Telegram file_id) is a JSON file next to the blobs, so
+    it survives restarts. Blobs live in the voice_previews directory with a
+    `tts_` prefix. Last-use bumps from hits are persisted in batches and on
+    close(), so LRU order is kept across restarts.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._index = None
+        self._lock = asyncio.Lock()
+        self._touched = 0  # попаданий с несохранённым last_used
+        self._persisted_at = time.monotonic()
+        self.hits = 0
+        self.upload_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text, voice_id, model_id, language):
+        normalized = " ".join(unicodedata.normalize("NFC", text or "").split())
+        raw = "\x1f".join([normalized, voice_id or "", model_id or "", language or ""])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _blob_path(self, key):
+        return self.cache_dir / f"tts_{key}.ogg"
+
+    def _load_index(self):
+        path = self.cache_dir / INDEX_FILE
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"TTS cache index is corrupted, starting fresh: {e}")
+            return {}
+        # Записи без файла на диске нам не нужны
+        return {k: v for k, v in index.items() if self._blob_path(k).exists()}
+
+    def _save_index(self, snapshot):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_dir / INDEX_FILE
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    async def _ensure_index(self):
+        if self._index is None:
+            self._index = await asyncio.to_thread(self._load_index)
+
+    async def _persist(self):
+        self._touched = 0
+        self._persisted_at = time.monotonic()
+        await asyncio.to_thread(self._save_index, {k: dict(v) for k, v in self._index.items()})
+
+    async def lookup(self, key):
+        """Return the index entry for key (may contain `file_id`) or None."""
+        async with self._lock:
+            await self._ensure_index()
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["last_used"] = time.time()
+            self.hits += 1
+            if entry.get("file_id"):
+                self.upload_hits += 1
+            self._touched += 1
+            if (self._touched >= TOUCH_FLUSH_COUNT
+                    or time.monotonic() - self._persisted_at >= TOUCH_FLUSH_SEC):
+                await self._persist()
+            return dict(entry)
+
+    async def close(self):
+        """Persist pending last-use bumps (on shutdown)."""
+        async with self._lock:
+            if self._index is not None and self._touched:
+                await self._persist()
+
+    async def load(self, key):
+        """Read the cached blob as an in-memory .ogg file, or None."""
+        try:
+            data = await asyncio.to_thread(self._blob_path(key).read_bytes)
+        except FileNotFoundError:
+            async with self._lock:
+                self._index.pop(key, None)
+                await self._persist()
+            return None
+        audio = io.BytesIO(data)
+        audio.name = "voice.ogg"
+        return audio
+
+    async def store(self, key, audio):
+        data = audio.getvalue()
+        if not data:
+            return
+        async with self._lock:
+            await self._ensure_index()
+            path = self._blob_path(key)
+
+            def _write():
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(path, "wb") as f:
+                    f.write(data)
+
+            await asyncio.to_thread(_write)
+            self._index[key] = {
+                "size": len(data),
+                "last_used": time.time(),
+                "file_id": None,
+            }
+            await self._evict()
+            await self._persist()
+
+    async def set_file_id(self, key, file_id):
+        """Remember the Telegram file_id so repeats skip the upload too."""
+        async with self._lock:
+            await self._ensure_index()
+            entry = self._index.get(key)
+            if entry is None or entry.get("file_id") == file_id:
+                return
+            entry["file_id"] = file_id
+            await self._persist()
+
+    async def forget_file_id(self, key):
+        async with self._lock:
+            await self._ensure_index()
+            entry = self._index.get(key)
+            if entry and entry.get("file_id"):
+                entry["file_id"] = None
+                await self._persist()
+
+    async def _evict(self):
+        total = sum(e["size"] for e in self._index.values())
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for key, entry in sorted(self._index.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entry["size"]
+            victims.append(key)
+        for key in victims:
+            self._index.pop(key, None)
+
+        def _unlink():
+            for key in victims:
+                try:
+                    self._blob_path(key).unlink()
+                except FileNotFoundError:
+                    pass
+
+        await asyncio.to_thread(_unlink)
+        logger.info(f"TTS cache: evicted {len(victims)} entries")
+
+    @property
+    def stats(self):
+        index = self._index or {}
+        return {
+            "entries": len(index),
+            "size_bytes": sum(e["size"] for e in index.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "upload_hits": self.upload_hits,
+            "misses": self.misses,
+        }
+
+
+# Global instance
+_tts_cache = None
+
+
+def get_tts_cache() -> TTSCache:
+    global _tts_cache
+    if _tts_cache is None:
+        _tts_cache = TTSCache(
+            BotConfig.MEDIA_DIR / "voice_previews",
+            BotConfig.TTS_CACHE_MAX_MB * 1024 * 1024,
+        )
+    return _tts_cache
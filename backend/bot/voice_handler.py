@@ -1,12 +1,19 @@
+import io
 import os
+import re
+import math
+import time
 import asyncio
 import logging
-import tempfile
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 _ffmpeg_checked = False
+# ffmpeg без прогресса дольше этого убивается (раньше — timeout=30 у subprocess.run)
+FFMPEG_TIMEOUT_SEC = 30
 
 
 def _ensure_ffmpeg():
@@ -29,6 +36,102 @@ def _ensure_ffmpeg():
     except Exception as e:
         logger.warning(f"Failed to install ffmpeg: {e}")
 
+
+def _encode_opus_stream(chunks, timeout=FFMPEG_TIMEOUT_SEC):
+    """Pipe MP3 chunks through ffmpeg into OGG/Opus without temp files.
+
+    A feeder thread writes chunks to ffmpeg's stdin as they arrive, so
+    encoding overlaps with synthesis. Returns (data, is_opus); on ffmpeg
+    failure the collected MP3 is returned instead. ffmpeg is killed when
+    it makes no progress for `timeout` seconds after the last chunk
+    written (a stuck process would otherwise hang the reply forever).
+    """
+    _ensure_ffmpeg()
+    try:
+        proc = subprocess.Popen(
+            [
+                "ffmpeg", "-loglevel", "error",
+                "-f", "mp3", "-i", "pipe:0",
+                "-c:a", "libopus",
+                "-b:a", "64k",
+                "-ar", "48000",
+                "-ac", "1",
+                "-f", "ogg", "pipe:1",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError as e:
+        logger.warning(f"ffmpeg not available: {e}, sending MP3 directly")
+        return b"".join(chunks), False
+
+    mp3_parts = []
+    feed_errors = []
+    deadline = [time.monotonic() + timeout]
+
+    def _feed():
+        try:
+            for chunk in chunks:
+                mp3_parts.append(chunk)
+                deadline[0] = time.monotonic() + timeout
+                try:
+                    proc.stdin.write(chunk)
+                except (BrokenPipeError, OSError):
+                    # ffmpeg упал или убит — дочитываем MP3 для фолбэка
+                    mp3_parts.extend(chunks)
+                    break
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            deadline[0] = time.monotonic() + timeout
+            try:
+                proc.stdin.close()
+            except Exception:
+                pass
+
+    # stdout и stderr читаются параллельно: иначе ffmpeg, заполнивший
+    # буфер stderr, ждёт нас, а мы ждём конца stdout
+    outputs = {}
+
+    def _drain(name, stream):
+        outputs[name] = stream.read()
+
+    threads = [
+        threading.Thread(target=_feed, name="tts-ffmpeg-feed", daemon=True),
+        threading.Thread(target=_drain, args=("stdout", proc.stdout), name="tts-ffmpeg-out", daemon=True),
+        threading.Thread(target=_drain, args=("stderr", proc.stderr), name="tts-ffmpeg-err", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    timed_out = False
+    while True:
+        try:
+            proc.wait(timeout=max(0.1, deadline[0] - time.monotonic()))
+            break
+        except subprocess.TimeoutExpired:
+            if time.monotonic() >= deadline[0]:
+                proc.kill()
+                proc.wait()
+                timed_out = True
+                break
+    for thread in threads:
+        thread.join()
+
+    if feed_errors:
+        # Ошибка ElevenLabs посреди стрима — наверх, как раньше
+        raise feed_errors[0]
+    ogg_data = outputs.get("stdout", b"")
+    if timed_out or proc.returncode != 0 or not ogg_data:
+        reason = f"no progress for {timeout}s" if timed_out else f"{proc.returncode}"
+        logger.warning(
+            f"ffmpeg conversion failed ({reason}): "
+            f"{outputs.get('stderr', b'').decode(errors='ignore')[:200]}, sending MP3 directly"
+        )
+        return b"".join(mp3_parts), False
+    return ogg_data, True
+
 # ElevenLabs TTS model options
 TTS_MODELS = {
     "eleven_v3": {
@@ -81,15 +184,128 @@ TTS_LANGUAGES = {
     "auto": "Авто-определение",
 }
 
+ELEVENLABS_MAX_CONCURRENCY = int(os.environ.get("ELEVENLABS_MAX_CONCURRENCY") or "3")
+
+# Long answers are synthesized as parallel sentence chunks
+TTS_CHUNK_CHARS = 400
+
+# Voice input: trim silence + downmix before upload, split long recordings
+STT_COMPACT = os.environ.get("STT_COMPACT", "1") not in ("0", "false", "no")
+STT_CHUNK_SEC = int(os.environ.get("STT_CHUNK_SEC") or "90")
+STT_OVERLAP_SEC = 1
+_stt_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="stt")
+
+# Voice catalog caching and preview pre-warming
+VOICES_TTL_SEC = 600
+VOICES_STALE_SEC = 24 * 3600
+VOICE_PREVIEW_PREWARM = int(os.environ.get("VOICE_PREVIEW_PREWARM") or "5")
+
 PREVIEW_TEXT_RU = "Здравствуйте! Я ваш AI ассистент поддержки. Чем могу вам помочь сегодня?"
 
 
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _compact_audio(data, start=None, length=None, compact=True):
+    """Downmix to mono 16 kHz Opus, trimming leading/trailing silence
+    unless `compact` is off.
+
+    Optionally cuts a [start, start + length) window for chunked STT.
+    For the whole file the original bytes are returned if ffmpeg is
+    unavailable or fails; for a window — None, so the caller can fall back
+    to the whole file instead of losing that window's speech.
+    """
+    _ensure_ffmpeg()
+    silence = "silenceremove=start_periods=1:start_threshold=-45dB:start_silence=0.2"
+    cmd = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0"]
+    if start is not None:
+        cmd += ["-ss", str(start), "-t", str(length)]
+    if compact:
+        cmd += ["-af", f"{silence},areverse,{silence},areverse"]
+    cmd += [
+        "-ac", "1", "-ar", "16000",
+        "-c:a", "libopus", "-b:a", "24k",
+        "-f", "ogg", "pipe:1",
+    ]
+    try:
+        result = subprocess.run(cmd, input=data, capture_output=True, timeout=60, check=True)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
+        if start is not None:
+            logger.warning(f"Cutting audio window at {start}s failed: {e}")
+            return None
+        logger.warning(f"Audio compaction failed: {e}, uploading original")
+        return data
+    return result.stdout
+
+
+def _merge_transcripts(texts, max_words=8):
+    """Join window transcripts, dropping words repeated by the overlap."""
+    merged = []
+    for text in texts:
+        words = text.split()
+        # Самый длинный хвост предыдущего окна, которым начинается следующее
+        for n in range(min(max_words, len(merged), len(words)), 0, -1):
+            tail = [w.lower().strip(".,!?…") for w in merged[-n:]]
+            head = [w.lower().strip(".,!?…") for w in words[:n]]
+            if tail == head:
+                words = words[n:]
+                break
+        merged.extend(words)
+    return " ".join(merged)
+
+
+_SENTENCE_BREAK = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+
+def split_sentences(text, max_chars=TTS_CHUNK_CHARS):
+    """Split text into chunks of whole sentences, each up to max_chars."""
+    chunks = []
+    current = ""
+    for sentence in _SENTENCE_BREAK.split(text.strip()):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) > max_chars:
+            # Очень длинное предложение режем по словам
+            if current:
+                chunks.append(current)
+                current = ""
+            for word in sentence.split():
+                if current and len(current) + 1 + len(word) > max_chars:
+                    chunks.append(current)
+                    current = word
+                else:
+                    current = f"{current} {word}" if current else word
+            continue
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+
 class VoiceHandler:
     """Handles voice message transcription (STT) and synthesis (TTS) via ElevenLabs."""
 
     def __init__(self, api_key=None):
         self.api_key = api_key or os.environ.get("ELEVENLABS_API_KEY", "")
         self._client = None
+        self._request_semaphores = {}
+        self._inflight = {}
+        self._background = set()
+        self._voices_cache = None
+        self._voices_fetched_at = 0.0
+        self.stt_stats = {
+            "transcriptions": 0,
+            "bytes_in": 0,
+            "bytes_uploaded": 0,
+            "seconds_total": 0.0,
+        }
 
     @property
     def is_configured(self):
@@ -99,6 +315,9 @@ class VoiceHandler:
         """Update the API key and reset client."""
         self.api_key = new_key
         self._client = None
+        # Каталог голосов зависит от аккаунта
+        self._voices_cache = None
+        self._voices_fetched_at = 0.0
 
     def _get_client(self):
         if not self._client and self.api_key:
@@ -108,32 +327,95 @@ class VoiceHandler:
 
     # ── Speech-to-Text ──────────────────────────────────────
 
-    async def transcribe(self, audio_path: str, model_id: str = None) -> str:
-        """Convert voice message to text using ElevenLabs STT."""
+    async def transcribe(self, audio, model_id: str = None, duration: float = None) -> str:
+        """Convert voice message to text using ElevenLabs STT.
+
+        `audio` is a file path, bytes or an in-memory file. Audio is compacted
+        (silence trimmed, downmixed to mono 16 kHz Opus) in the worker pool,
+        and recordings longer than STT_CHUNK_SEC are transcribed as parallel,
+        slightly overlapping windows; if a window cannot be cut, the whole
+        file is transcribed in one request.
+        """
         if not self.is_configured:
             raise ValueError("ElevenLabs API key not configured")
 
         if not model_id:
             model_id = DEFAULT_STT_MODEL
 
-        def _do_transcribe():
+        started = time.monotonic()
+        if isinstance(audio, str):
+            audio = await asyncio.to_thread(_read_file, audio)
+        elif hasattr(audio, "getvalue"):
+            audio = audio.getvalue()
+
+        loop = asyncio.get_running_loop()
+        parts = None
+        if duration and duration > STT_CHUNK_SEC:
+            # Окна перекрываются на STT_OVERLAP_SEC — слово на стыке попадёт целиком
+            count = math.ceil(duration / STT_CHUNK_SEC)
+            spans = [
+                (i * STT_CHUNK_SEC - (STT_OVERLAP_SEC if i else 0),
+                 STT_CHUNK_SEC + (STT_OVERLAP_SEC if i else 0))
+                for i in range(count)
+            ]
+            parts = await asyncio.gather(*(
+                loop.run_in_executor(_stt_pool, _compact_audio, audio, start, length, STT_COMPACT)
+                for start, length in spans
+            ))
+            if any(p is None for p in parts):
+                logger.warning("Audio window cut failed, transcribing the whole file")
+                parts = None
+        if parts is None:
+            if STT_COMPACT:
+                parts = [await loop.run_in_executor(_stt_pool, _compact_audio, audio)]
+            else:
+                parts = [audio]
+
+        slots = self._request_slots()
+
+        def _do_transcribe(data):
             client = self._get_client()
-            with open(audio_path, "rb") as f:
-                result = client.speech_to_text.convert(
-                    file=f,
-                    model_id=model_id,
-                )
+            result = client.speech_to_text.convert(
+                file=("voice.ogg", data, "audio/ogg"),
+                model_id=model_id,
+            )
             return result.text if hasattr(result, 'text') else str(result)
 
-        text = await asyncio.to_thread(_do_transcribe)
-        logger.info(f"Transcribed voice ({model_id}): {text[:100]}...")
+        async def _transcribe_part(data):
+            async with slots:
+                return await loop.run_in_executor(_stt_pool, _do_transcribe, data)
+
+        texts = await asyncio.gather(*(_transcribe_part(p) for p in parts if p))
+        text = _merge_transcripts(t.strip() for t in texts if t and t.strip())
+
+        elapsed = time.monotonic() - started
+        uploaded = sum(len(p) for p in parts)
+        self.stt_stats["transcriptions"] += 1
+        self.stt_stats["bytes_in"] += len(audio)
+        self.stt_stats["bytes_uploaded"] += uploaded
+        self.stt_stats["seconds_total"] = round(self.stt_stats["seconds_total"] + elapsed, 3)
+        logger.info(
+            f"Transcribed voice ({model_id}): {len(audio)}→{uploaded} bytes, "
+            f"{len(parts)} chunk(s), {elapsed:.2f}s: {text[:100]}..."
+        )
         return text
 
     # ── Text-to-Speech ──────────────────────────────────────
 
-    async def synthesize(self, text: str, voice_id: str = None, model_id: str = None, language: str = None) -> str:
+    def _request_slots(self):
+        """Concurrency cap for ElevenLabs requests, one semaphore per API key."""
+        slots = self._request_semaphores.get(self.api_key)
+        if slots is None:
+            slots = asyncio.Semaphore(ELEVENLABS_MAX_CONCURRENCY)
+            self._request_semaphores[self.api_key] = slots
+        return slots
+
+    async def synthesize(self, text: str, voice_id: str = None, model_id: str = None, language: str = None) -> io.BytesIO:
         """Convert text to voice using ElevenLabs TTS.
-        Returns path to .ogg file ready for Telegram.
+        Returns an in-memory .ogg (Opus) file ready for Telegram,
+        or .mp3 if ffmpeg is unavailable (check the `name` attribute).
+        Long texts are split on sentence boundaries and the chunks are
+        synthesized concurrently, then encoded as one voice message.
         """
         if not self.is_configured:
             raise ValueError("ElevenLabs API key not configured")
@@ -151,72 +433,76 @@ class VoiceHandler:
         if len(text) > char_limit:
             text = text[:char_limit]
 
-        def _do_synthesize():
+        def _convert(part):
             client = self._get_client()
             kwargs = {
-                "text": text,
+                "text": part,
                 "voice_id": voice_id,
                 "model_id": model_id,
             }
             # Pass language_code only if not auto-detect
             if language and language != "auto":
                 kwargs["language_code"] = language
+            return client.text_to_speech.convert(**kwargs)
 
-            audio_generator = client.text_to_speech.convert(**kwargs)
-
-            # Collect audio data (MP3)
-            audio_data = b""
-            for chunk in audio_generator:
-                audio_data += chunk
+        chunks = split_sentences(text, TTS_CHUNK_CHARS)
+        slots = self._request_slots()
 
-            # Save as temp MP3
-            mp3_fd, mp3_path = tempfile.mkstemp(suffix=".mp3")
-            with os.fdopen(mp3_fd, "wb") as f:
-                f.write(audio_data)
-
-            # Ensure ffmpeg is available
-            _ensure_ffmpeg()
-
-            # Convert MP3 → OGG (Opus) for Telegram voice messages
-            ogg_path = mp3_path.replace(".mp3", ".ogg")
-            try:
-                subprocess.run(
-                    [
-                        "ffmpeg", "-i", mp3_path,
-                        "-c:a", "libopus",
-                        "-b:a", "64k",
-                        "-ar", "48000",
-                        "-ac", "1",
-                        ogg_path,
-                        "-y", "-loglevel", "error"
-                    ],
-                    check=True,
-                    capture_output=True,
-                    timeout=30
+        if len(chunks) <= 1:
+            # MP3 chunks go straight into ffmpeg while ElevenLabs is still streaming
+            async with slots:
+                data, is_opus = await asyncio.to_thread(
+                    lambda: _encode_opus_stream(_convert(text))
                 )
-            except (subprocess.CalledProcessError, FileNotFoundError) as e:
-                logger.warning(f"ffmpeg conversion failed: {e}, sending MP3 directly")
-                # Telegram can accept MP3 as voice too via send_audio
-                # But try renaming to .ogg — Pyrogram/Telegram may still accept it
-                ogg_path = mp3_path
-            finally:
-                if os.path.exists(ogg_path) and ogg_path != mp3_path:
-                    os.remove(mp3_path)
-
-            return ogg_path
-
-        result_path = await asyncio.to_thread(_do_synthesize)
-        logger.info(f"Synthesized voice ({model_id}): {len(text)} chars → {result_path}")
-        return result_path
+        else:
+            async def _synthesize_chunk(part):
+                async with slots:
+                    return await asyncio.to_thread(lambda: b"".join(_convert(part)))
+
+            # Latency ≈ slowest chunk instead of the sum of all chunks
+            mp3_parts = await asyncio.gather(*(_synthesize_chunk(c) for c in chunks))
+            data, is_opus = await asyncio.to_thread(_encode_opus_stream, iter(mp3_parts))
+
+        audio = io.BytesIO(data)
+        audio.name = "voice.ogg" if is_opus else "voice.mp3"
+        logger.info(
+            f"Synthesized voice ({model_id}): {len(text)} chars in {len(chunks)} chunk(s) "
+            f"→ {audio.name}, {len(data)} bytes"
+        )
+        return audio
 
     # ── Get available voices ────────────────────────────────
 
     async def get_voices(self) -> list:
-        """Get list of available ElevenLabs voices with preview URLs and descriptions."""
+        """Get list of available ElevenLabs voices with preview URLs and descriptions.
+
+        The catalog is cached for VOICES_TTL_SEC; an older copy (up to
+        VOICES_STALE_SEC) is returned immediately while a background refresh
+        runs. Concurrent callers share one upstream request.
+        """
         if not self.is_configured:
             logger.warning("ElevenLabs не настроен - нет API ключа")
             return []
 
+        age = time.monotonic() - self._voices_fetched_at
+        if self._voices_cache is not None:
+            if age < VOICES_TTL_SEC:
+                return self._voices_cache
+            if age < VOICES_STALE_SEC:
+                self._run_in_background(self._single_flight("voices", self._fetch_voices))
+                return self._voices_cache
+        return await self._single_flight("voices", self._fetch_voices)
+
+    async def _fetch_voices(self) -> list:
+        api_key = self.api_key
+        voices = await self._get_voices_uncached()
+        # Пустой список — это ошибка API, старый каталог не затираем
+        if voices and api_key == self.api_key:
+            self._voices_cache = voices
+            self._voices_fetched_at = time.monotonic()
+        return voices or self._voices_cache or []
+
+    async def _get_voices_uncached(self) -> list:
         def _do_get_voices():
             client = self._get_client()
             try:
@@ -285,6 +571,13 @@ class VoiceHandler:
         if os.path.exists(cache_path) and os.path.getsize(cache_path) > 100:
             return cache_path
 
+        # Одновременные запросы одного голоса ждут одну генерацию
+        return await self._single_flight(
+            f"preview:{voice_id}",
+            lambda: self._generate_preview_uncached(voice_id, cache_path, cache_dir),
+        )
+
+    async def _generate_preview_uncached(self, voice_id, cache_path, cache_dir):
         def _do_generate():
             client = self._get_client()
             audio_generator = client.text_to_speech.convert(
@@ -293,19 +586,73 @@ class VoiceHandler:
                 model_id="eleven_flash_v2_5",  # Fast model for previews
                 language_code="ru",
             )
-            audio_data = b""
-            for chunk in audio_generator:
-                audio_data += chunk
+            audio_data = b"".join(audio_generator)
 
             os.makedirs(cache_dir, exist_ok=True)
-            with open(cache_path, "wb") as f:
+            tmp_path = f"{cache_path}.tmp"
+            with open(tmp_path, "wb") as f:
                 f.write(audio_data)
+            os.replace(tmp_path, cache_path)
             return cache_path
 
-        result = await asyncio.to_thread(_do_generate)
+        async with self._request_slots():
+            result = await asyncio.to_thread(_do_generate)
         logger.info(f"Generated Russian preview for voice {voice_id}: {result}")
         return result
 
+    def prewarm_previews(self, voice_ids, cache_dir):
+        """Generate missing previews in the background, one at a time."""
+        if not self.is_configured or VOICE_PREVIEW_PREWARM <= 0:
+            return
+        wanted = []
+        for voice_id in voice_ids:
+            if voice_id and voice_id not in wanted:
+                wanted.append(voice_id)
+        wanted = [
+            v for v in wanted[:VOICE_PREVIEW_PREWARM]
+            if not os.path.exists(os.path.join(cache_dir, f"preview_{v}.mp3"))
+        ]
+        if not wanted or "prewarm" in self._inflight:
+            return
+
+        async def _prewarm():
+            for voice_id in wanted:
+                try:
+                    await self.generate_preview(voice_id, cache_dir)
+                except Exception as e:
+                    logger.warning(f"Preview prewarm failed for {voice_id}: {e}")
+                    return
+
+        self._run_in_background(self._single_flight("prewarm", _prewarm))
+
+    # ── Single-flight helpers ───────────────────────────────
+
+    async def _single_flight(self, key, factory):
+        """Run factory() once per key; concurrent callers await the same task."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+
+            def _done(t, key=key):
+                if self._inflight.get(key) is t:
+                    del self._inflight[key]
+
+            task.add_done_callback(_done)
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _run_in_background(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+
+        def _done(t):
+            self._background.discard(t)
+            if not t.cancelled() and t.exception():
+                logger.warning(f"Background voice task failed: {t.exception()}")
+
+        task.add_done_callback(_done)
+
 
 # Global instance
 _voice_handler = None
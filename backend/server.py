@@ -1,8 +1,10 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Request, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Request, Response, Depends
+from fastapi.encoders import jsonable_encoder
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from starlette.middleware.gzip import GZipMiddleware
 import os
+import base64
 import logging
 import asyncio
 import aiofiles
@@ -11,27 +13,30 @@ import hmac
 import time
 import secrets
 from pathlib import Path
+from collections import OrderedDict
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import jwt as pyjwt
 
-from bot.database import BotDatabase
+from bot.storage import create_storage
+from bot.events import get_event_hub, format_sse
 from bot.media_handler import list_media_files
+from bot.transfer import export_stream, import_stream, ImportFormatError, EXPORT_PARTS
+from bot.jobs import get_job_runner, JobConflict
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
-bot_db = BotDatabase(db)
+# MongoDB или SQLite — выбирается STORAGE_BACKEND
+bot_db = create_storage()
 bot_task = None
+reconcile_task = None
+archive_task = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -52,6 +57,8 @@ class BotStatusResponse(BaseModel):
     silenced_chats: int = 0
     total_images_analyzed: int = 0
     total_media_sent: int = 0
+    screenshot_cache: dict = {}
+    history_cache: dict = {}
     telegram_configured: bool = False
     auth_status: str = "not_configured"
     phone_number: str = ""
@@ -77,19 +84,30 @@ class ConversationSummary(BaseModel):
     chat_id: str
     username: Optional[str] = None
     message_count: int = 0
-    last_message_at: Optional[str] = None
+    last_message_at: Optional[datetime] = None
+    last_snippet: Optional[str] = None
     is_silenced: bool = False
 
 
 class ActivityLogEntry(BaseModel):
     id: str
-    timestamp: str
+    timestamp: datetime
     event_type: str
     chat_id: Optional[str] = None
     username: Optional[str] = None
     details: str
 
 
+class SearchHit(BaseModel):
+    id: str
+    chat_id: str
+    role: str
+    username: Optional[str] = None
+    timestamp: datetime
+    snippet: str
+    highlights: List[List[int]] = []
+
+
 class MediaTemplateEntry(BaseModel):
     tag: str
     filename: str
@@ -185,26 +203,83 @@ class TelegramAuthRequest(BaseModel):
 
 
 # ── Auth хелперы ────────────────────────────────────────
+# Настройки auth и JWT secret меняются только через /auth/setup и /auth/reset,
+# поэтому держим их в памяти и сбрасываем в этих эндпоинтах
+_auth_cache = {}
+# Уже проверенные токены: token → (secret, payload), живут не дольше exp
+_verified_tokens = OrderedDict()
+VERIFIED_TOKENS_MAX = 256
+# Одноразовые билеты на SSE-поток: ticket → monotonic-время истечения.
+# EventSource не умеет заголовки, а JWT в URL оседает в логах прокси
+_sse_tickets = {}
+SSE_TICKET_TTL_SEC = 60
+SSE_TICKETS_MAX = 1024
+
+
+def invalidate_auth_cache():
+    _auth_cache.clear()
+    _verified_tokens.clear()
+    _sse_tickets.clear()
+
+
+def issue_sse_ticket():
+    now = time.monotonic()
+    for ticket in [t for t, exp in _sse_tickets.items() if exp <= now]:
+        del _sse_tickets[ticket]
+    if len(_sse_tickets) >= SSE_TICKETS_MAX:
+        # Dict хранит порядок вставки — вытесняем самые старые
+        del _sse_tickets[next(iter(_sse_tickets))]
+    ticket = secrets.token_urlsafe(24)
+    _sse_tickets[ticket] = now + SSE_TICKET_TTL_SEC
+    return ticket
+
+
+def redeem_sse_ticket(ticket):
+    """True if the ticket was issued, unused and not expired; it is spent either way."""
+    expires = _sse_tickets.pop(ticket, None)
+    return expires is not None and expires > time.monotonic()
+
+
 async def get_jwt_secret():
     """Получить или создать JWT secret из БД."""
-    doc = await db.auth_config.find_one({"_id": "jwt_secret"})
-    if doc:
-        return doc["secret"]
-    secret = secrets.token_hex(32)
-    await db.auth_config.update_one(
-        {"_id": "jwt_secret"},
-        {"$set": {"secret": secret}},
-        upsert=True,
-    )
-    return secret
+    secret = _auth_cache.get("jwt_secret")
+    if secret:
+        return secret
+    doc = await bot_db.get_doc("auth_config", "jwt_secret")
+    if not doc:
+        # set_on_insert: при гонке двух запросов оба получат один secret
+        await bot_db.update_doc(
+            "auth_config", doc_id="jwt_secret",
+            set_on_insert={"secret": secrets.token_hex(32)},
+        )
+        doc = await bot_db.get_doc("auth_config", "jwt_secret")
+    _auth_cache["jwt_secret"] = doc["secret"]
+    return doc["secret"]
 
 
 async def get_auth_setup():
     """Получить настройки auth (bot_token, bot_username)."""
-    doc = await db.auth_config.find_one({"_id": "auth_setup"})
-    if not doc:
-        return None
-    return doc
+    if "auth_setup" not in _auth_cache:
+        _auth_cache["auth_setup"] = await bot_db.get_doc("auth_config", "auth_setup")
+    return _auth_cache["auth_setup"]
+
+
+def decode_jwt(token, jwt_secret):
+    """pyjwt.decode with an LRU of tokens that already passed verification."""
+    cached = _verified_tokens.get(token)
+    if cached is not None:
+        secret, payload = cached
+        if secret == jwt_secret and payload["exp"] > time.time():
+            _verified_tokens.move_to_end(token)
+            return payload
+        del _verified_tokens[token]
+    payload = pyjwt.decode(token, jwt_secret, algorithms=["HS256"])
+    if "exp" in payload:
+        # Без exp не кэшируем — нечем ограничить срок записи
+        _verified_tokens[token] = (jwt_secret, payload)
+        if len(_verified_tokens) > VERIFIED_TOKENS_MAX:
+            _verified_tokens.popitem(last=False)
+    return payload
 
 
 def verify_telegram_auth(data: dict, bot_token: str) -> bool:
@@ -238,8 +313,7 @@ async def get_current_user(request: Request):
     token = auth_header.split(" ", 1)[1]
     try:
         jwt_secret = await get_jwt_secret()
-        payload = pyjwt.decode(token, jwt_secret, algorithms=["HS256"])
-        return payload
+        return decode_jwt(token, jwt_secret)
     except pyjwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Сессия истекла")
     except pyjwt.InvalidTokenError:
@@ -251,10 +325,44 @@ async def require_auth(request: Request):
     return await get_current_user(request)
 
 
+# ── HTTP кэширование ────────────────────────────────────────
+try:
+    import orjson  # noqa: F401
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:  # orjson не установлен — обычный json
+    from fastapi.responses import JSONResponse as FastJSONResponse
+
+# Версии ресурсов живут в памяти процесса; BOOT_ID делает ETag-и
+# прошлого запуска недействительными после рестарта
+BOOT_ID = secrets.token_hex(4)
+
+
+def resource_etag(*resources, extra=""):
+    hub = get_event_hub()
+    parts = "-".join(f"{r}{hub.version(r)}" for r in resources)
+    return f'W/"{BOOT_ID}-{parts}{extra}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [t.strip() for t in header.split(",")]
+
+
+async def conditional_json(request: Request, etag: str, build):
+    """Empty 304 if the client has this version, otherwise JSON with the ETag."""
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    content = await build()
+    return FastJSONResponse(jsonable_encoder(content), headers=headers)
+
+
 # ── Хелперы ──────────────────────────────────────────────
 async def get_telegram_creds():
     """Get TG creds from MongoDB first, fallback to env."""
-    doc = await db.telegram_creds.find_one({"_id": "main"}, {"_id": 0})
+    doc = await bot_db.get_doc("telegram_creds")
     if doc and doc.get("api_id"):
         return doc
     from bot.config import BotConfig
@@ -272,7 +380,7 @@ def has_telegram_creds_sync(creds):
 
 async def get_ai_settings():
     """Получить AI провайдер/модель/ключи из MongoDB."""
-    doc = await db.ai_settings.find_one({"_id": "main"}, {"_id": 0})
+    doc = await bot_db.get_doc("ai_settings")
     gemini_key = os.environ.get("GEMINI_API_KEY", "")
     if not doc:
         return {
@@ -335,14 +443,11 @@ async def setup_auth(req: AuthSetupRequest):
         # Но для первой настройки — пропускаем
         raise HTTPException(status_code=400, detail="Авторизация уже настроена")
 
-    await db.auth_config.update_one(
-        {"_id": "auth_setup"},
-        {"$set": {
-            "bot_token": req.bot_token,
-            "bot_username": req.bot_username.replace("@", "").strip(),
-        }},
-        upsert=True,
-    )
+    await bot_db.update_doc("auth_config", {
+        "bot_token": req.bot_token,
+        "bot_username": req.bot_username.replace("@", "").strip(),
+    }, doc_id="auth_setup")
+    invalidate_auth_cache()
     logger.info(f"Auth настроен: @{req.bot_username}")
     return {"status": "ok"}
 
@@ -377,25 +482,21 @@ async def auth_telegram(req: TelegramAuthRequest):
         raise HTTPException(status_code=401, detail="Невалидная подпись")
 
     # Проверяем — есть ли уже admin?
-    admin_doc = await db.auth_config.find_one({"_id": "admin_user"})
+    admin_doc = await bot_db.get_doc("auth_config", "admin_user")
     if admin_doc:
         # Проверяем что это тот же пользователь
         if admin_doc["telegram_id"] != req.id:
             raise HTTPException(status_code=403, detail="Доступ запрещён. Вы не являетесь администратором.")
     else:
         # Первый вход — сохраняем как админа
-        await db.auth_config.update_one(
-            {"_id": "admin_user"},
-            {"$set": {
-                "telegram_id": req.id,
-                "first_name": req.first_name,
-                "last_name": req.last_name or "",
-                "username": req.username or "",
-                "photo_url": req.photo_url or "",
-                "created_at": datetime.now(timezone.utc).isoformat(),
-            }},
-            upsert=True,
-        )
+        await bot_db.update_doc("auth_config", {
+            "telegram_id": req.id,
+            "first_name": req.first_name,
+            "last_name": req.last_name or "",
+            "username": req.username or "",
+            "photo_url": req.photo_url or "",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }, doc_id="admin_user")
         logger.info(f"Admin установлен: {req.first_name} (ID: {req.id})")
 
     # Генерируем JWT (срок 7 дней)
@@ -435,7 +536,7 @@ async def auth_me(request: Request):
     token = auth_header.split(" ", 1)[1]
     try:
         jwt_secret = await get_jwt_secret()
-        payload = pyjwt.decode(token, jwt_secret, algorithms=["HS256"])
+        payload = decode_jwt(token, jwt_secret)
         return {
             "authenticated": True,
             "auth_required": True,
@@ -460,7 +561,8 @@ async def auth_logout():
 async def auth_reset(request: Request):
     """Сбросить настройки авторизации (только для админа)."""
     user = await get_current_user(request)
-    await db.auth_config.delete_many({})
+    await bot_db.clear_docs("auth_config")
+    invalidate_auth_cache()
     logger.info("Auth настройки сброшены")
     return {"status": "ok"}
 
@@ -472,6 +574,8 @@ async def root():
 
 @api_router.get("/bot/status", response_model=BotStatusResponse)
 async def get_bot_status():
+    from bot.image_hash import get_screenshot_cache
+    from bot.history_cache import get_history_cache
     status = await bot_db.get_bot_status()
     stats = await bot_db.get_stats()
     auth_state = await bot_db.get_auth_state()
@@ -497,15 +601,63 @@ async def get_bot_status():
         silenced_chats=stats["silenced_chats"],
         total_images_analyzed=stats["total_images_analyzed"],
         total_media_sent=stats["total_media_sent"],
+        screenshot_cache=get_screenshot_cache().stats,
+        history_cache=get_history_cache().stats,
         telegram_configured=has_creds,
         auth_status=auth_status,
         phone_number=creds.get("phone_number", "") or ""
     )
 
 
-@api_router.get("/bot/config", response_model=BotConfigResponse)
-async def get_bot_config():
-    config_doc = await db.bot_config.find_one({"_id": "main"}, {"_id": 0})
+SSE_HEARTBEAT_SEC = 15
+
+
+@api_router.post("/bot/events/ticket")
+async def bot_events_ticket():
+    """One-time ticket for /bot/events, valid SSE_TICKET_TTL_SEC seconds."""
+    return {"ticket": issue_sse_ticket(), "expires_in": SSE_TICKET_TTL_SEC}
+
+
+@api_router.get("/bot/events")
+async def bot_events(request: Request):
+    """Server-Sent Events stream of dashboard updates.
+
+    EventSource cannot send headers, so the client first takes a one-time
+    ticket from POST /bot/events/ticket and passes it as ?ticket=; it opens
+    this stream only and is spent on connect. After connecting the client loads a snapshot via the regular endpoints
+    and then applies events: status, counters, activity, conversation,
+    silence, config and resync.
+    """
+    from starlette.responses import StreamingResponse
+
+    hub = get_event_hub()
+    queue = hub.subscribe()
+
+    async def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event_type, data = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT_SEC)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    # Комментарий держит соединение живым через прокси
+                    yield ": ping\n\n"
+                    continue
+                yield format_sse(event_type, data)
+        finally:
+            hub.unsubscribe(queue)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def load_bot_config() -> BotConfigResponse:
+    config_doc = await bot_db.get_doc("bot_config")
     if not config_doc:
         return BotConfigResponse()
     return BotConfigResponse(**{
@@ -514,66 +666,152 @@ async def get_bot_config():
     })
 
 
+@api_router.get("/bot/config", response_model=BotConfigResponse)
+async def get_bot_config(request: Request):
+    return await conditional_json(request, resource_etag("config"), load_bot_config)
+
+
 @api_router.post("/bot/config", response_model=BotConfigResponse)
 async def update_bot_config(config: BotConfigUpdate):
     update_data = {k: v for k, v in config.model_dump().items() if v is not None}
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет полей для обновления")
-    await db.bot_config.update_one(
-        {"_id": "main"},
-        {"$set": update_data},
-        upsert=True
-    )
-    return await get_bot_config()
+    await bot_db.update_doc("bot_config", update_data)
+    get_event_hub().bump("config")
+    updated = await load_bot_config()
+    get_event_hub().publish("config", updated.model_dump())
+    return updated
+
+
+def _encode_cursor(last_message_at, chat_id):
+    raw = f"{last_message_at.isoformat()}|{chat_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_at, chat_id = base64.urlsafe_b64decode(padded).decode().split("|", 1)
+        return datetime.fromisoformat(last_at), chat_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Невалидный курсор")
 
 
 @api_router.get("/bot/conversations", response_model=List[ConversationSummary])
-async def get_conversations():
-    pipeline = [
-        {"$group": {
-            "_id": "$chat_id",
-            "username": {"$last": "$username"},
-            "message_count": {"$sum": 1},
-            "last_message_at": {"$max": "$timestamp"}
-        }},
-        {"$sort": {"last_message_at": -1}},
-        {"$limit": 50}
-    ]
-    convos = await db.messages.aggregate(pipeline).to_list(50)
-    now = datetime.now(timezone.utc).isoformat()
-    results = []
-    for c in convos:
-        silence = await db.silence_timers.find_one(
-            {"chat_id": str(c["_id"]), "expires_at": {"$gt": now}},
-            {"_id": 0}
-        )
-        results.append(ConversationSummary(
-            chat_id=str(c["_id"]),
-            username=c.get("username"),
-            message_count=c["message_count"],
-            last_message_at=c.get("last_message_at"),
-            is_silenced=silence is not None
-        ))
-    return results
+async def get_conversations(response: Response, limit: int = 50, cursor: Optional[str] = None):
+    """Conversations by last activity; next page cursor is in X-Next-Cursor."""
+    limit = max(1, min(limit, 200))
+    before = _decode_cursor(cursor) if cursor else None
+    convos = await bot_db.get_conversations(limit, before)
+    if len(convos) == limit and convos[-1].get("last_message_at"):
+        last = convos[-1]
+        response.headers["X-Next-Cursor"] = _encode_cursor(last["last_message_at"], last["chat_id"])
+    return [ConversationSummary(**{
+        k: v for k, v in c.items() if k in ConversationSummary.model_fields
+    }) for c in convos]
+
+
+def _as_utc(value: Optional[datetime]):
+    if value is not None and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
 
 
 @api_router.get("/bot/activity", response_model=List[ActivityLogEntry])
-async def get_activity_log():
-    logs = await db.activity_log.find(
-        {}, {"_id": 0}
-    ).sort("timestamp", -1).limit(100).to_list(100)
+async def get_activity_log(
+    response: Response,
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    event_type: Optional[str] = None,
+    chat_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Activity log, newest first. event_type accepts a comma-separated list;
+    the next page cursor is returned in X-Next-Cursor."""
+    limit = max(1, min(limit, 500))
+    types = [t for t in (event_type or "").split(",") if t] or None
+    if types and len(types) == 1:
+        types = types[0]
+    logs = await bot_db.get_activity(
+        limit,
+        before=_decode_cursor(cursor) if cursor else None,
+        event_type=types,
+        chat_id=chat_id,
+        since=_as_utc(since),
+        until=_as_utc(until),
+    )
+    if len(logs) == limit:
+        response.headers["X-Next-Cursor"] = _encode_cursor(logs[-1]["timestamp"], logs[-1]["id"])
     return [ActivityLogEntry(**log) for log in logs]
 
 
-@api_router.get("/bot/media-templates", response_model=List[MediaTemplateEntry])
-async def get_media_templates():
+@api_router.get("/bot/activity/rollups")
+async def get_activity_rollups(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    event_type: Optional[str] = None,
+):
+    """Hourly event counts (kept after raw entries expire). Default: last 7 days."""
+    since = _as_utc(since) or datetime.now(timezone.utc) - timedelta(days=7)
+    return await bot_db.get_activity_rollups(since, _as_utc(until), event_type)
+
+
+@api_router.get("/bot/search", response_model=List[SearchHit])
+async def search_messages(
+    response: Response,
+    q: str,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    chat_id: Optional[str] = None,
+):
+    """Full-text search over messages still in the database (not the
+    archive), newest first. Every word must match; highlights are
+    [start, end) offsets in the snippet. Next page cursor: X-Next-Cursor.
+    A short page with a cursor means the scan budget ran out (MongoDB):
+    X-Search-Truncated is set and older matches may follow."""
+    from bot.search import parse_query, highlight
+    stems = parse_query(q)
+    if not stems:
+        raise HTTPException(status_code=400, detail="Пустой поисковый запрос")
+    limit = max(1, min(limit, 100))
+    try:
+        hits, next_before = await bot_db.search_messages(
+            q, limit, before=_decode_cursor(cursor) if cursor else None, chat_id=chat_id
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Невалидный курсор")
+    if next_before:
+        response.headers["X-Next-Cursor"] = _encode_cursor(*next_before)
+        if len(hits) < limit:
+            response.headers["X-Search-Truncated"] = "1"
+    return [
+        SearchHit(
+            id=h["id"], chat_id=h["chat_id"], role=h["role"], username=h.get("username"),
+            timestamp=h["timestamp"], **highlight(h.get("text"), stems),
+        )
+        for h in hits
+    ]
+
+
+async def load_media_templates():
     files = list_media_files()
-    result = []
-    for f in files:
-        rule = await db.media_rules.find_one({"tag": f["tag"]}, {"_id": 0})
-        f["description"] = rule.get("description", "") if rule else ""
-        result.append(MediaTemplateEntry(**f))
-    return result
+    rules = {
+        r["tag"]: r.get("description", "")
+        for r in await bot_db.get_media_rules([f["tag"] for f in files])
+    }
+    return [MediaTemplateEntry(**f, description=rules.get(f["tag"], "")) for f in files]
+
+
+@api_router.get("/bot/media-templates", response_model=List[MediaTemplateEntry])
+async def get_media_templates(request: Request):
+    # mtime каталога ловит файлы, положенные мимо API
+    try:
+        mtime = MEDIA_DIR.stat().st_mtime_ns
+    except FileNotFoundError:
+        mtime = 0
+    etag = resource_etag("media", extra=f"-{mtime:x}")
+    return await conditional_json(request, etag, load_media_templates)
 
 
 @api_router.post("/bot/test-message", response_model=TestMessageResponse)
@@ -585,7 +823,7 @@ async def test_message(req: TestMessageRequest):
     ai_client = create_ai_client_from_settings(ai_settings)
 
     # Применяем температуру из конфига
-    config_doc = await db.bot_config.find_one({"_id": "main"}, {"_id": 0})
+    config_doc = await bot_db.get_doc("bot_config")
     if config_doc:
         ai_client.temperature = config_doc.get("temperature", 0.7)
 
@@ -633,16 +871,12 @@ async def get_telegram_settings():
 
 @api_router.post("/bot/settings/telegram")
 async def save_telegram_settings(req: TelegramCredsRequest):
-    await db.telegram_creds.update_one(
-        {"_id": "main"},
-        {"$set": {
-            "api_id": req.api_id,
-            "api_hash": req.api_hash,
-            "phone_number": req.phone_number,
-            "admin_user_id": req.admin_user_id
-        }},
-        upsert=True
-    )
+    await bot_db.update_doc("telegram_creds", {
+        "api_id": req.api_id,
+        "api_hash": req.api_hash,
+        "phone_number": req.phone_number,
+        "admin_user_id": req.admin_user_id
+    })
     # Reset auth state since creds changed
     await bot_db.set_auth_state("none")
     await bot_db.update_bot_status(is_running=False)
@@ -652,23 +886,23 @@ async def save_telegram_settings(req: TelegramCredsRequest):
 # ── Управление промптом ────────────────────────────
 
 @api_router.get("/bot/settings/prompt")
-async def get_custom_prompt():
-    doc = await db.custom_prompt.find_one({"_id": "main"}, {"_id": 0})
-    from bot.system_prompt import SYSTEM_PROMPT
-    default = SYSTEM_PROMPT.replace("{media_templates}", "(автоматически подставляется)")
-    return {
-        "prompt": doc.get("prompt", "") if doc else "",
-        "default_prompt": default
-    }
+async def get_custom_prompt(request: Request):
+    async def build():
+        doc = await bot_db.get_doc("custom_prompt")
+        from bot.system_prompt import SYSTEM_PROMPT
+        default = SYSTEM_PROMPT.replace("{media_templates}", "(автоматически подставляется)")
+        return {
+            "prompt": doc.get("prompt", "") if doc else "",
+            "default_prompt": default
+        }
+
+    return await conditional_json(request, resource_etag("prompt"), build)
 
 
 @api_router.post("/bot/settings/prompt")
 async def save_custom_prompt(req: CustomPromptRequest):
-    await db.custom_prompt.update_one(
-        {"_id": "main"},
-        {"$set": {"prompt": req.prompt}},
-        upsert=True
-    )
+    await bot_db.update_doc("custom_prompt", {"prompt": req.prompt})
+    get_event_hub().bump("prompt")
     return {"status": "saved"}
 
 
@@ -687,6 +921,7 @@ async def upload_media(file: UploadFile = File(...)):
         await f.write(content)
 
     tag = Path(safe_name).stem
+    get_event_hub().bump("media")
     await bot_db.log_activity("media_uploaded", details=f"Загружен: {safe_name}")
 
     return {"status": "uploaded", "filename": safe_name, "tag": tag, "size": len(content)}
@@ -704,49 +939,59 @@ async def delete_media(tag: str):
                 deleted = True
     if not deleted:
         raise HTTPException(404, "Файл не найден")
-    await db.media_rules.delete_one({"tag": tag})
+    await bot_db.delete_media_rule(tag)
+    get_event_hub().bump("media")
     await bot_db.log_activity("media_deleted", details=f"Удалён: {tag}")
     return {"status": "deleted", "tag": tag}
 
 
 @api_router.post("/bot/media/rules")
 async def save_media_rule(req: MediaRuleRequest):
-    await db.media_rules.update_one(
-        {"tag": req.tag},
-        {"$set": {"tag": req.tag, "description": req.description}},
-        upsert=True
-    )
+    await bot_db.save_media_rule(req.tag, req.description)
+    get_event_hub().bump("media")
     return {"status": "saved"}
 
 
 @api_router.get("/bot/media/rules")
 async def get_media_rules():
-    rules = await db.media_rules.find({}, {"_id": 0}).to_list(100)
-    return rules
+    return await bot_db.get_media_rules()
 
 
 # ── AI настройки ───────────────────────────────
 
+_providers_list = None
+
+
+def get_providers_list():
+    """PROVIDERS is static — build the public list once."""
+    global _providers_list
+    if _providers_list is None:
+        from bot.gemini_client import PROVIDERS
+        _providers_list = [
+            {
+                "id": pid,
+                "name": p["name"],
+                "models": p["models"],
+                "default_model": p["default_model"],
+                "needs_key": p["needs_key"],
+            }
+            for pid, p in PROVIDERS.items()
+        ]
+    return _providers_list
+
+
 @api_router.get("/bot/settings/ai")
-async def get_ai_settings_endpoint():
-    from bot.gemini_client import PROVIDERS
-    settings = await get_ai_settings()
-    providers_list = [
-        {
-            "id": pid,
-            "name": p["name"],
-            "models": p["models"],
-            "default_model": p["default_model"],
-            "needs_key": p["needs_key"],
+async def get_ai_settings_endpoint(request: Request):
+    async def build():
+        settings = await get_ai_settings()
+        return {
+            "provider": settings.get("provider", "gemini"),
+            "model": settings.get("model", "gemini-2.5-flash"),
+            "api_keys": {k: "***" + v[-4:] if v and len(v) > 4 else "" for k, v in settings.get("api_keys", {}).items()},
+            "providers_list": get_providers_list(),
         }
-        for pid, p in PROVIDERS.items()
-    ]
-    return {
-        "provider": settings.get("provider", "gemini"),
-        "model": settings.get("model", "gemini-2.5-flash"),
-        "api_keys": {k: "***" + v[-4:] if v and len(v) > 4 else "" for k, v in settings.get("api_keys", {}).items()},
-        "providers_list": providers_list,
-    }
+
+    return await conditional_json(request, resource_etag("ai"), build)
 
 
 @api_router.post("/bot/settings/ai")
@@ -756,17 +1001,14 @@ async def save_ai_settings(req: AISettingsRequest):
         "model": req.model,
     }
     if req.api_keys:
-        existing = await db.ai_settings.find_one({"_id": "main"}, {"_id": 0})
+        existing = await bot_db.get_doc("ai_settings")
         existing_keys = existing.get("api_keys", {}) if existing else {}
         for k, v in req.api_keys.items():
             if v and not v.startswith("***"):
                 existing_keys[k] = v
         update["api_keys"] = existing_keys
-    await db.ai_settings.update_one(
-        {"_id": "main"},
-        {"$set": update},
-        upsert=True
-    )
+    await bot_db.update_doc("ai_settings", update)
+    get_event_hub().bump("ai")
     await bot_db.log_activity("ai_settings_changed", details=f"Провайдер: {req.provider}, Модель: {req.model}")
     return {"status": "saved"}
 
@@ -776,8 +1018,9 @@ async def save_ai_settings(req: AISettingsRequest):
 @api_router.get("/bot/settings/voice")
 async def get_voice_settings():
     from bot.voice_handler import get_voice_handler, TTS_MODELS, STT_MODELS, TTS_LANGUAGES
+    from bot.tts_cache import get_tts_cache
     handler = get_voice_handler()
-    doc = await db.voice_settings.find_one({"_id": "main"}, {"_id": 0})
+    doc = await bot_db.get_doc("voice_settings")
 
     voice_enabled = doc.get("voice_enabled", False) if doc else False
     voice_mode = doc.get("voice_mode", "voice_only") if doc else "voice_only"
@@ -795,13 +1038,18 @@ async def get_voice_settings():
     if active_key and handler.api_key != active_key:
         handler.update_key(active_key)
 
-    # Get voices list
+    # Get voices list (cached in the handler, refreshed in background)
     voices = []
     if handler.is_configured:
         try:
             voices = await handler.get_voices()
         except Exception as e:
             logger.warning(f"Failed to fetch voices: {e}")
+        # Заранее готовим превью выбранного голоса и начала списка
+        handler.prewarm_previews(
+            [voice_id] + [v["voice_id"] for v in voices],
+            str(MEDIA_DIR / "voice_previews"),
+        )
 
     return {
         "voice_enabled": voice_enabled,
@@ -815,6 +1063,8 @@ async def get_voice_settings():
         "api_key_source": "saved" if stored_key else ("env" if env_key else "none"),
         "api_key_masked": f"...{active_key[-8:]}" if active_key and len(active_key) > 8 else "",
         "voices": voices,
+        "tts_cache": get_tts_cache().stats,
+        "stt_stats": handler.stt_stats,
         "tts_models": [
             {"id": mid, **info} for mid, info in TTS_MODELS.items()
         ],
@@ -848,11 +1098,7 @@ async def save_voice_settings(req: VoiceSettingsRequest):
         handler = get_voice_handler()
         handler.update_key(req.elevenlabs_api_key)
 
-    await db.voice_settings.update_one(
-        {"_id": "main"},
-        {"$set": update_data},
-        upsert=True
-    )
+    await bot_db.update_doc("voice_settings", update_data)
     status = "вкл" if req.voice_enabled else "выкл"
     await bot_db.log_activity("voice_settings_changed", details=f"Голосовые ответы: {status}")
     return {"status": "saved"}
@@ -870,7 +1116,7 @@ async def get_voice_preview(voice_id: str):
     handler = get_voice_handler()
 
     # Sync handler key from DB/env
-    doc = await db.voice_settings.find_one({"_id": "main"}, {"_id": 0})
+    doc = await bot_db.get_doc("voice_settings")
     stored_key = doc.get("elevenlabs_api_key", "") if doc else ""
     env_key = os.environ.get("ELEVENLABS_API_KEY", "")
     active_key = stored_key or env_key
@@ -906,7 +1152,7 @@ async def auth_send_code(req: SendCodeRequest):
         raise HTTPException(400, "Telegram API ID и Hash не настроены")
     try:
         from bot.telegram_bot import get_bot
-        bot = get_bot(db)
+        bot = get_bot(bot_db)
         bot.set_creds(creds["api_id"], creds["api_hash"])
         result = await bot.send_auth_code(req.phone_number)
         await bot_db.set_auth_state("code_sent")
@@ -920,7 +1166,7 @@ async def auth_send_code(req: SendCodeRequest):
 async def auth_verify_code(req: VerifyCodeRequest):
     try:
         from bot.telegram_bot import get_bot
-        bot = get_bot(db)
+        bot = get_bot(bot_db)
         result = await bot.verify_auth_code(req.phone_number, req.code)
 
         if result["status"] == "authorized":
@@ -928,7 +1174,7 @@ async def auth_verify_code(req: VerifyCodeRequest):
             global bot_task
             if bot_task is None or bot_task.done():
                 from bot.telegram_bot import start_bot
-                bot_task = asyncio.create_task(start_bot(db))
+                bot_task = asyncio.create_task(start_bot(bot_db))
                 logger.info("Бот запущен после авторизации")
 
         return result
@@ -941,7 +1187,7 @@ async def auth_verify_code(req: VerifyCodeRequest):
 async def auth_verify_2fa(req: Verify2FARequest):
     try:
         from bot.telegram_bot import get_bot
-        bot = get_bot(db)
+        bot = get_bot(bot_db)
         result = await bot.verify_2fa(req.password)
 
         if result["status"] == "authorized":
@@ -949,7 +1195,7 @@ async def auth_verify_2fa(req: Verify2FARequest):
             global bot_task
             if bot_task is None or bot_task.done():
                 from bot.telegram_bot import start_bot
-                bot_task = asyncio.create_task(start_bot(db))
+                bot_task = asyncio.create_task(start_bot(bot_db))
 
         return result
     except Exception as e:
@@ -964,7 +1210,7 @@ async def start_bot_endpoint():
         return {"status": "already_running"}
     try:
         from bot.telegram_bot import start_bot
-        bot_task = asyncio.create_task(start_bot(db))
+        bot_task = asyncio.create_task(start_bot(bot_db))
         return {"status": "started"}
     except Exception as e:
         raise HTTPException(400, f"Ошибка запуска: {str(e)}")
@@ -985,31 +1231,90 @@ async def stop_bot_endpoint():
 class ScanRequest(BaseModel):
     max_chats: int = 50
     messages_per_chat: int = 100
+    # Параллельных загрузок истории; по умолчанию SCAN_CONCURRENCY
+    concurrency: Optional[int] = Field(default=None, ge=1, le=16)
+    # False — только новые сообщения после прошлого скана
+    full: bool = False
 
 
-@api_router.post("/bot/training/scan")
+async def run_training_scan(params, progress):
+    from bot.telegram_bot import get_bot
+    bot = get_bot(bot_db)
+    try:
+        return await bot.scan_dialogs(
+            max_chats=params["max_chats"],
+            messages_per_chat=params["messages_per_chat"],
+            concurrency=params.get("concurrency"),
+            # Продолжение полного скана — уже инкрементальное, по сохранённым чекпоинтам
+            full=params.get("full", False) and not params.get("resume"),
+            progress=progress,
+        )
+    finally:
+        get_event_hub().bump("training")
+
+
+job_runner = get_job_runner(bot_db)
+job_runner.register("training_scan", run_training_scan)
+
+
+@api_router.post("/bot/training/scan", status_code=202)
 async def scan_dialogs(req: ScanRequest):
-    """Scan existing Telegram dialogs to learn the admin's communication style."""
+    """Start a background scan of Telegram dialogs to learn the admin's style.
+
+    Returns the job at once; progress arrives as `job` SSE events and via
+    /bot/jobs/{job_id}.
+    """
     from bot.telegram_bot import get_bot
-    bot = get_bot(db)
+    bot = get_bot(bot_db)
     if not bot._running:
         raise HTTPException(400, "Бот должен быть запущен для сканирования диалогов")
     try:
-        result = await bot.scan_dialogs(
-            max_chats=req.max_chats,
-            messages_per_chat=req.messages_per_chat
-        )
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка сканирования: {e}")
-        raise HTTPException(400, f"Ошибка: {str(e)}")
+        return await job_runner.submit("training_scan", req.model_dump())
+    except JobConflict as e:
+        raise HTTPException(409, str(e))
 
 
-@api_router.get("/bot/training/status")
-async def get_training_status():
-    """Get training/scan status and style profile."""
-    style_doc = await db.style_profile.find_one({"_id": "main"}, {"_id": 0})
-    total_pairs = await db.training_data.count_documents({})
+# ── Фоновые задачи ────────────────────────────────────
+
+@api_router.get("/bot/jobs/latest")
+async def get_latest_job(kind: str = "training_scan"):
+    return await job_runner.latest(kind)
+
+
+@api_router.get("/bot/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(404, "Задача не найдена")
+    return job
+
+
+@api_router.post("/bot/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    if not await job_runner.cancel(job_id):
+        raise HTTPException(409, "Задача не выполняется")
+    await bot_db.log_activity("job_cancelled", details=f"Задача {job_id} отменена")
+    return await job_runner.get(job_id)
+
+
+@api_router.post("/bot/jobs/{job_id}/resume", status_code=202)
+async def resume_job(job_id: str):
+    from bot.telegram_bot import get_bot
+    if not get_bot(bot_db)._running:
+        raise HTTPException(400, "Бот должен быть запущен для сканирования диалогов")
+    try:
+        return await job_runner.resume(job_id)
+    except KeyError:
+        raise HTTPException(404, "Задача не найдена")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except JobConflict as e:
+        raise HTTPException(409, str(e))
+
+
+async def load_training_status():
+    style_doc = await bot_db.get_doc("style_profile")
+    total_pairs = await bot_db.count_training_pairs()
     few_shot = style_doc.get("few_shot_examples", []) if style_doc else []
     training_enabled = style_doc.get("training_enabled", True) if style_doc else True
     return {
@@ -1024,17 +1329,20 @@ async def get_training_status():
     }
 
 
+@api_router.get("/bot/training/status")
+async def get_training_status(request: Request):
+    """Get training/scan status and style profile."""
+    return await conditional_json(request, resource_etag("training"), load_training_status)
+
+
 @api_router.post("/bot/training/toggle")
 async def toggle_training():
     """Toggle training data usage on/off."""
-    style_doc = await db.style_profile.find_one({"_id": "main"})
+    style_doc = await bot_db.get_doc("style_profile")
     current = style_doc.get("training_enabled", True) if style_doc else True
     new_val = not current
-    await db.style_profile.update_one(
-        {"_id": "main"},
-        {"$set": {"training_enabled": new_val}},
-        upsert=True
-    )
+    await bot_db.update_doc("style_profile", {"training_enabled": new_val})
+    get_event_hub().bump("training")
     status = "вкл" if new_val else "выкл"
     await bot_db.log_activity("training_toggled", details=f"Обучение: {status}")
     return {"training_enabled": new_val}
@@ -1043,21 +1351,67 @@ async def toggle_training():
 @api_router.delete("/bot/training/reset")
 async def reset_training():
     """Clear all training data."""
-    await db.training_data.delete_many({})
-    await db.style_profile.delete_one({"_id": "main"})
+    await bot_db.clear_training_pairs()
+    await bot_db.clear_scan_checkpoints()
+    await bot_db.delete_doc("style_profile")
+    get_event_hub().bump("training")
     await bot_db.log_activity("training_reset", details="Данные обучения сброшены")
     return {"status": "reset"}
 
 
+# ── Экспорт / импорт ─────────────────────────────────────
+
+@api_router.get("/bot/export")
+async def export_data(include: str = ",".join(EXPORT_PARTS)):
+    """Stream messages, training pairs and the style profile as gzip NDJSON."""
+    from starlette.responses import StreamingResponse
+    from bot.archiver import get_archiver
+
+    parts = [p.strip() for p in include.split(",") if p.strip()]
+    unknown = set(parts) - set(EXPORT_PARTS)
+    if not parts or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"include: допустимые значения {', '.join(EXPORT_PARTS)}",
+        )
+    # Сообщения из буфера записи тоже должны попасть в выгрузку
+    await bot_db.flush()
+    filename = f"support-bot-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.ndjson.gz"
+    return StreamingResponse(
+        export_stream(bot_db, get_archiver(bot_db), parts),
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@api_router.post("/bot/import")
+async def import_data(request: Request):
+    """Bulk import of an export file (gzip or plain NDJSON) sent as the raw body."""
+    try:
+        stats = await import_stream(bot_db, request.stream())
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    get_event_hub().bump("training")
+    get_event_hub().publish("resync", {})
+    await bot_db.log_activity(
+        "data_imported",
+        details=f"Импорт: {stats['messages']} сообщений, {stats['training_pairs']} пар",
+    )
+    return stats
+
+
 # ── Сборка системного промпта ───────────────────────────────
 
 async def build_system_prompt():
     from bot.system_prompt import SYSTEM_PROMPT
-    custom_doc = await db.custom_prompt.find_one({"_id": "main"}, {"_id": 0})
+    custom_doc = await bot_db.get_doc("custom_prompt")
     custom_prompt = custom_doc.get("prompt", "") if custom_doc else ""
 
     files = list_media_files()
-    rules = {r["tag"]: r["description"] for r in await db.media_rules.find({}, {"_id": 0}).to_list(100)}
+    rules = {r["tag"]: r["description"] for r in await bot_db.get_media_rules()}
 
     if files:
         templates_str = "\n".join(
@@ -1069,7 +1423,7 @@ async def build_system_prompt():
         templates_str = "Медиа-шаблоны отсутствуют."
 
     # Get style profile and few-shot examples from training data
-    style_doc = await db.style_profile.find_one({"_id": "main"}, {"_id": 0})
+    style_doc = await bot_db.get_doc("style_profile")
     style_section = ""
     training_enabled = style_doc.get("training_enabled", True) if style_doc else True
 
@@ -1100,9 +1454,26 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Search-Truncated", "ETag"],
 )
 
 
+class JSONGZipMiddleware(GZipMiddleware):
+    """GZip for API responses, except the SSE stream (gzip would buffer
+    events), voice previews and exports that are already compressed."""
+
+    SKIP_PREFIXES = ("/api/bot/events", "/api/bot/voice/", "/api/bot/export")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.SKIP_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(JSONGZipMiddleware, minimum_size=1024, compresslevel=6)
+
+
 # ── Auth Middleware ─────────────────────────────────────
 @app.middleware("http")
 async def auth_middleware(request: Request, call_next):
@@ -1126,17 +1497,27 @@ async def auth_middleware(request: Request, call_next):
 
     # Auth настроен — проверяем JWT
     auth_header = request.headers.get("Authorization", "")
-    if not auth_header.startswith("Bearer "):
+    if path == "/api/bot/events" and request.query_params.get("ticket"):
+        # EventSource не умеет заголовки — вместо JWT одноразовый билет
+        if redeem_sse_ticket(request.query_params["ticket"]):
+            return await call_next(request)
+        from starlette.responses import JSONResponse
+        return JSONResponse(
+            status_code=401,
+            content={"detail": "Билет SSE недействителен"},
+        )
+    if auth_header.startswith("Bearer "):
+        token = auth_header.split(" ", 1)[1]
+    else:
         from starlette.responses import JSONResponse
         return JSONResponse(
             status_code=401,
             content={"detail": "Требуется авторизация"},
         )
 
-    token = auth_header.split(" ", 1)[1]
     try:
         jwt_secret = await get_jwt_secret()
-        pyjwt.decode(token, jwt_secret, algorithms=["HS256"])
+        decode_jwt(token, jwt_secret)
     except pyjwt.ExpiredSignatureError:
         from starlette.responses import JSONResponse
         return JSONResponse(
@@ -1154,14 +1535,46 @@ async def auth_middleware(request: Request, call_next):
 
 
 # ── Жизненный цикл ───────────────────────────────────────────
+async def reconcile_counters_loop():
+    """Periodically recount dashboard counters to repair any drift."""
+    from bot.config import BotConfig
+    while True:
+        try:
+            await bot_db.reconcile_counters()
+        except Exception as e:
+            logger.warning(f"Сверка счётчиков не удалась: {e}")
+        await asyncio.sleep(BotConfig.COUNTERS_RECONCILE_MIN * 60)
+
+
+async def archive_loop():
+    """Move old messages to the compressed archive in the background."""
+    from bot.archiver import get_archiver, ARCHIVE_INTERVAL_SEC
+    archiver = get_archiver(bot_db)
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SEC)
+        try:
+            await archiver.run_once()
+        except Exception as e:
+            logger.warning(f"Архивация сообщений не удалась: {e}")
+
+
 @app.on_event("startup")
 async def startup():
-    existing = await db.bot_config.find_one({"_id": "main"})
-    if not existing:
-        await db.bot_config.insert_one({
-            "_id": "main",
-            **BotConfigResponse().model_dump()
-        })
+    try:
+        version = await bot_db.migrate()
+        logger.info(f"Схема БД: версия {version}")
+    except Exception as e:
+        # Код рассчитывает на новую схему — без неё не стартуем
+        logger.error(f"Ошибка миграции БД: {e}", exc_info=True)
+        raise
+
+    await job_runner.recover()
+
+    global reconcile_task, archive_task
+    reconcile_task = asyncio.create_task(reconcile_counters_loop())
+    archive_task = asyncio.create_task(archive_loop())
+
+    await bot_db.update_doc("bot_config", set_on_insert=BotConfigResponse().model_dump())
 
     creds = await get_telegram_creds()
     if has_telegram_creds_sync(creds):
@@ -1171,13 +1584,13 @@ async def startup():
             if session_path.exists():
                 try:
                     from bot.telegram_bot import get_bot
-                    bot = get_bot(db)
+                    bot = get_bot(bot_db)
                     bot.set_creds(creds["api_id"], creds["api_hash"])
                     is_valid = await bot.check_session_valid()
                     if is_valid:
                         from bot.telegram_bot import start_bot
                         global bot_task
-                        bot_task = asyncio.create_task(start_bot(db))
+                        bot_task = asyncio.create_task(start_bot(bot_db))
                         logger.info("Бот запущен с существующей сессией")
                     else:
                         await bot_db.set_auth_state("none")
@@ -1195,6 +1608,17 @@ async def startup():
 
 @app.on_event("shutdown")
 async def shutdown():
+    for task in (reconcile_task, archive_task):
+        if task:
+            task.cancel()
+    # Скан сохранит статус interrupted, пока бот и БД ещё доступны
+    await job_runner.shutdown()
     if bot_task:
         bot_task.cancel()
-    client.close()
+        try:
+            await bot_task
+        except (asyncio.CancelledError, Exception):
+            pass
+    from bot.tts_cache import get_tts_cache
+    await get_tts_cache().close()
+    await bot_db.close()
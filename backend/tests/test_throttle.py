@@ -0,0 +1,21 @@
+import asyncio
+import time
+
+from bot.throttle import RateLimiter
+
+
+def test_no_burst_after_pause():
+    """После FloodWait запросы идут с шагом 1/rate, а не пачкой."""
+    async def run():
+        limiter = RateLimiter(10, burst=4)
+        limiter.pause(0.3)
+        times = []
+        for _ in range(4):
+            await limiter.acquire()
+            times.append(time.monotonic())
+        return limiter, times
+
+    limiter, times = asyncio.run(run())
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert all(gap >= 0.08 for gap in gaps), gaps
+    assert limiter.acquired == 4
@@ -1,4 +1,4 @@
-import { useState, useEffect, useCallback } from "react";
+import { useState, useEffect, useCallback, useRef } from "react";
 import "@/App.css";
 import axios from "axios";
 import { Toaster, toast } from "sonner";
@@ -11,6 +11,7 @@ import TerminalFeed from "./components/TerminalFeed";
 import ConfigPanel from "./components/ConfigPanel";
 import MediaGallery from "./components/MediaGallery";
 import ConversationsList from "./components/ConversationsList";
+import MessageSearch from "./components/MessageSearch";
 import TestChat from "./components/TestChat";
 import AuthDialog from "./components/AuthDialog";
 import TelegramSettings from "./components/TelegramSettings";
@@ -84,7 +85,13 @@ function AppContent() {
   const [config, setConfig] = useState(null);
   const [logs, setLogs] = useState([]);
   const [conversations, setConversations] = useState([]);
+  // Страницы диалогов, догруженные кнопкой «Ещё» (опрос обновляет только первую)
+  const [olderConversations, setOlderConversations] = useState([]);
+  const [convosCursor, setConvosCursor] = useState(null);
+  const olderLoadedRef = useRef(false);
+  const conversationsRef = useRef([]);
   const [mediaTemplates, setMediaTemplates] = useState([]);
+  const [scanJob, setScanJob] = useState(null);
   const [loading, setLoading] = useState(true);
 
   // ── Проверка авторизации при загрузке ──
@@ -160,6 +167,17 @@ function AppContent() {
     return () => axios.interceptors.response.eject(interceptor);
   }, [authenticated, handleLogout]);
 
+  useEffect(() => {
+    conversationsRef.current = conversations;
+  }, [conversations]);
+
+  const applyConversations = useCallback((res) => {
+    setConversations(res.data);
+    if (!olderLoadedRef.current) {
+      setConvosCursor(res.headers["x-next-cursor"] || null);
+    }
+  }, []);
+
   const fetchAll = useCallback(async () => {
     try {
       const [statusRes, configRes, logsRes, convosRes, mediaRes] =
@@ -174,19 +192,160 @@ function AppContent() {
       if (statusRes.status === "fulfilled") setStatus(statusRes.value.data);
       if (configRes.status === "fulfilled") setConfig(configRes.value.data);
       if (logsRes.status === "fulfilled") setLogs(logsRes.value.data);
-      if (convosRes.status === "fulfilled") setConversations(convosRes.value.data);
+      if (convosRes.status === "fulfilled") applyConversations(convosRes.value);
       if (mediaRes.status === "fulfilled") setMediaTemplates(mediaRes.value.data);
     } catch (e) {
       console.error("Ошибка загрузки:", e);
     }
     setLoading(false);
+  }, [applyConversations]);
+
+  const refetch = useCallback(async (path, apply) => {
+    try {
+      apply(await axios.get(`${API}${path}`));
+    } catch (e) {
+      console.error("Ошибка загрузки:", e);
+    }
   }, []);
 
+  // ── Живые обновления: SSE-поток, при обрыве — опрос ──
   useEffect(() => {
+    if (!authenticated) return undefined;
     fetchAll();
-    const interval = setInterval(fetchAll, 5000);
-    return () => clearInterval(interval);
-  }, [fetchAll]);
+
+    let interval = null;
+    const poll = (ms) => {
+      clearInterval(interval);
+      interval = setInterval(fetchAll, ms);
+    };
+    if (typeof EventSource === "undefined") {
+      poll(5000);
+      return () => clearInterval(interval);
+    }
+
+    // EventSource не шлёт заголовки — поток открывается по одноразовому билету.
+    // Автопереподключение браузера с тем же билетом получит 401 и закроет
+    // поток; тогда берём новый билет сами
+    let source = null;
+    let stopped = false;
+    let retry = null;
+    const reconnect = () => {
+      clearTimeout(retry);
+      retry = setTimeout(connect, 3000);
+    };
+    const connect = async () => {
+      let ticket;
+      try {
+        ticket = (await axios.post(`${API}/bot/events/ticket`)).data.ticket;
+      } catch {
+        poll(5000);
+        reconnect();
+        return;
+      }
+      if (stopped) return;
+      source = new EventSource(`${API}/bot/events?ticket=${encodeURIComponent(ticket)}`);
+      source.onopen = () => {
+        // Снимок после подписки, дальше — только события; редкий опрос
+        // подбирает то, что не публикуется (истечение тишины по TTL)
+        fetchAll();
+        poll(60000);
+      };
+      source.onerror = () => {
+        poll(5000);
+        if (source.readyState === EventSource.CLOSED) reconnect();
+      };
+      subscribe(source);
+    };
+
+    const refetchStatus = () => refetch("/bot/status", (res) => setStatus(res.data));
+    const subscribe = (stream) => {
+      const on = (type, handler) =>
+        stream.addEventListener(type, (e) => handler(JSON.parse(e.data || "{}")));
+
+      on("resync", fetchAll);
+      on("status", refetchStatus);
+      on("silence", (data) => {
+        setConversations((prev) =>
+          prev.map((c) => (c.chat_id === data.chat_id ? { ...c, is_silenced: true } : c))
+        );
+        refetchStatus();
+      });
+      on("config", (data) => setConfig(data));
+      on("job", (job) => {
+        if (job.kind === "training_scan") setScanJob(job);
+      });
+      on("counters", (data) => {
+        const fields = {
+          total_messages: "total_messages",
+          total_chats: "active_chats",
+          total_images_analyzed: "total_images_analyzed",
+          total_media_sent: "total_media_sent",
+        };
+        setStatus((prev) => {
+          if (!prev) return prev;
+          const next = { ...prev };
+          Object.entries(data).forEach(([field, delta]) => {
+            const key = fields[field];
+            if (key) next[key] = (next[key] || 0) + delta;
+          });
+          return next;
+        });
+      });
+      on("activity", (entry) => {
+        setLogs((prev) => [entry, ...prev].slice(0, 100));
+        if (entry.event_type === "media_uploaded" || entry.event_type === "media_deleted") {
+          refetch("/bot/media-templates", (res) => setMediaTemplates(res.data));
+        }
+      });
+      on("conversation", (data) => {
+        if (!conversationsRef.current.some((c) => c.chat_id === data.chat_id)) {
+          // Новый чат (или вне первой страницы) — счётчик знает только сервер
+          refetch("/bot/conversations", applyConversations);
+          return;
+        }
+        setConversations((prev) => {
+          const existing = prev.find((c) => c.chat_id === data.chat_id);
+          if (!existing) return prev;
+          const updated = {
+            ...existing,
+            ...data,
+            username: data.username || existing.username,
+            message_count: existing.message_count + 1,
+          };
+          return [updated, ...prev.filter((c) => c.chat_id !== data.chat_id)];
+        });
+      });
+    };
+    connect();
+
+    return () => {
+      stopped = true;
+      clearTimeout(retry);
+      if (source) source.close();
+      clearInterval(interval);
+    };
+  }, [authenticated, fetchAll, refetch, applyConversations]);
+
+  const handleLoadMoreConversations = async () => {
+    if (!convosCursor) return;
+    try {
+      const res = await axios.get(`${API}/bot/conversations`, {
+        params: { cursor: convosCursor },
+      });
+      olderLoadedRef.current = true;
+      setOlderConversations((prev) => [...prev, ...res.data]);
+      setConvosCursor(res.headers["x-next-cursor"] || null);
+    } catch {
+      toast.error("Ошибка загрузки диалогов");
+    }
+  };
+
+  // Первая страница свежее догруженных — дубликаты берём из неё
+  const firstPageIds = new Set(conversations.map((c) => c.chat_id));
+  const allConversations = [
+    ...conversations,
+    ...olderConversations.filter((c) => !firstPageIds.has(c.chat_id)),
+  ];
 
   const handleConfigUpdate = async (newConfig) => {
     try {
@@ -337,7 +496,12 @@ function AppContent() {
             {/* Левая колонка */}
             <div className="lg:col-span-3 space-y-4">
               <StatusCards status={status} />
-              <ConversationsList conversations={conversations} />
+              <ConversationsList
+                conversations={allConversations}
+                hasMore={Boolean(convosCursor)}
+                onLoadMore={handleLoadMoreConversations}
+              />
+              <MessageSearch apiUrl={API} />
             </div>
 
             {/* Центральная колонка */}
@@ -464,7 +628,7 @@ function AppContent() {
             {/* Right: Prompt + Training + Media */}
             <div className="space-y-4">
               <PromptEditor apiUrl={API} />
-              <TrainingPanel apiUrl={API} botRunning={status?.is_running} />
+              <TrainingPanel apiUrl={API} botRunning={status?.is_running} scanJob={scanJob} />
               <MediaManager apiUrl={API} onRefresh={fetchAll} />
             </div>
           </div>
@@ -1,6 +1,6 @@
 import { Users, VolumeX, MessageSquare } from "lucide-react";
 
-export default function ConversationsList({ conversations }) {
+export default function ConversationsList({ conversations, hasMore, onLoadMore }) {
   return (
     <div
       data-testid="conversations-list"
@@ -49,6 +49,11 @@ export default function ConversationsList({ conversations }) {
                     {c.message_count} сообщ.
                     {c.is_silenced && <span className="text-amber-500 ml-1">ТИШИНА</span>}
                   </div>
+                  {c.last_snippet && (
+                    <div className="font-mono text-[10px] text-neutral-700 truncate">
+                      {c.last_snippet}
+                    </div>
+                  )}
                 </div>
               </div>
               {c.last_message_at && (
@@ -62,6 +67,16 @@ export default function ConversationsList({ conversations }) {
             </div>
           ))
         )}
+        {hasMore && (
+          <button
+            data-testid="conversations-load-more"
+            onClick={onLoadMore}
+            className="w-full mt-1 py-1.5 font-mono text-[10px] uppercase tracking-widest
+              text-neutral-500 hover:text-[#00F0FF] transition-colors"
+          >
+            Загрузить ещё
+          </button>
+        )}
       </div>
     </div>
   );
@@ -0,0 +1,140 @@
+import { useState } from "react";
+import axios from "axios";
+import { Search, Loader2 } from "lucide-react";
+
+function Highlighted({ text, spans }) {
+  if (!spans?.length) return text;
+  const parts = [];
+  let pos = 0;
+  spans.forEach(([start, end], i) => {
+    if (start > pos) parts.push(text.slice(pos, start));
+    parts.push(
+      <mark key={i} className="bg-[#00F0FF]/20 text-[#00F0FF]">
+        {text.slice(start, end)}
+      </mark>
+    );
+    pos = end;
+  });
+  parts.push(text.slice(pos));
+  return parts;
+}
+
+export default function MessageSearch({ apiUrl }) {
+  const [query, setQuery] = useState("");
+  const [results, setResults] = useState(null);
+  const [cursor, setCursor] = useState(null);
+  const [truncated, setTruncated] = useState(false);
+  const [loading, setLoading] = useState(false);
+
+  const runSearch = async (nextCursor = null) => {
+    const q = query.trim();
+    if (!q || loading) return;
+    setLoading(true);
+    try {
+      const res = await axios.get(`${apiUrl}/bot/search`, {
+        params: { q, limit: 20, ...(nextCursor ? { cursor: nextCursor } : {}) },
+      });
+      setResults((prev) => (nextCursor ? [...(prev || []), ...res.data] : res.data));
+      setCursor(res.headers["x-next-cursor"] || null);
+      // Короткая страница с курсором: просмотрены не все сообщения
+      setTruncated(res.headers["x-search-truncated"] === "1");
+    } catch {
+      if (!nextCursor) setResults([]);
+      setCursor(null);
+      setTruncated(false);
+    }
+    setLoading(false);
+  };
+
+  return (
+    <div
+      data-testid="message-search"
+      className="border border-white/[0.06]"
+      style={{ background: "#0A0A0A" }}
+    >
+      <div className="flex items-center gap-2 px-4 py-3 border-b border-white/[0.06]">
+        <Search className="h-4 w-4 text-[#00F0FF]" />
+        <span className="text-xs font-medium uppercase tracking-widest text-neutral-500">
+          Поиск
+        </span>
+      </div>
+
+      <div className="p-2">
+        <div className="flex gap-1">
+          <input
+            data-testid="message-search-input"
+            value={query}
+            onChange={(e) => setQuery(e.target.value)}
+            onKeyDown={(e) => e.key === "Enter" && runSearch()}
+            placeholder="Слова из переписки…"
+            className="flex-1 min-w-0 bg-transparent border border-white/[0.06] px-2 py-1.5
+              font-mono text-xs text-neutral-300 placeholder:text-neutral-700 outline-none
+              focus:border-[#00F0FF]/40"
+          />
+          <button
+            data-testid="message-search-button"
+            onClick={() => runSearch()}
+            disabled={loading}
+            className="px-2 text-neutral-500 hover:text-[#00F0FF] transition-colors disabled:opacity-50"
+          >
+            {loading ? <Loader2 className="h-3.5 w-3.5 animate-spin" /> : <Search className="h-3.5 w-3.5" />}
+          </button>
+        </div>
+
+        {results && (
+          <div className="mt-2 max-h-72 overflow-y-auto">
+            {results.length === 0 ? (
+              <p className="py-4 text-center font-mono text-xs text-neutral-600">
+                {truncated ? "Среди последних сообщений ничего не найдено" : "Ничего не найдено"}
+              </p>
+            ) : (
+              results.map((r) => (
+                <div
+                  key={r.id}
+                  data-testid={`search-hit-${r.id}`}
+                  className="px-2 py-1.5 hover:bg-white/[0.02] transition-colors"
+                >
+                  <div className="flex justify-between font-mono text-[10px] text-neutral-600">
+                    <span className="truncate">
+                      {r.username ? `@${r.username}` : `Чат ${r.chat_id.slice(-6)}`}
+                      {r.role !== "user" && " · бот"}
+                    </span>
+                    <span className="shrink-0 ml-2">
+                      {new Date(r.timestamp).toLocaleString("ru-RU", {
+                        day: "2-digit",
+                        month: "2-digit",
+                        hour: "2-digit",
+                        minute: "2-digit",
+                      })}
+                    </span>
+                  </div>
+                  <div className="font-mono text-[11px] text-neutral-400 break-words">
+                    <Highlighted text={r.snippet} spans={r.highlights} />
+                  </div>
+                </div>
+              ))
+            )}
+            {cursor && truncated && (
+              <p
+                data-testid="message-search-truncated"
+                className="px-2 pt-1 font-mono text-[10px] text-neutral-600"
+              >
+                Просмотрены не все сообщения — могут быть ещё совпадения
+              </p>
+            )}
+            {cursor && (
+              <button
+                data-testid="message-search-more"
+                onClick={() => runSearch(cursor)}
+                className="w-full mt-1 py-1.5 font-mono text-[10px] uppercase tracking-widest
+                  text-neutral-500 hover:text-[#00F0FF] transition-colors"
+              >
+                {truncated ? "Искать дальше" : "Загрузить ещё"}
+              </button>
+            )}
+          </div>
+        )}
+      </div>
+    </div>
+  );
+}
@@ -5,6 +5,7 @@ import {
   Send,
   VolumeX,
   Clock,
+  ScanSearch,
 } from "lucide-react";
 
 const cards = [
@@ -13,6 +14,13 @@ const cards = [
   { id: "images-analyzed", label: "Изображений", icon: Image, key: "total_images_analyzed", color: "#F59E0B" },
   { id: "media-sent", label: "Медиа отправлено", icon: Send, key: "total_media_sent", color: "#A78BFA" },
   { id: "silenced-chats", label: "Заглушено", icon: VolumeX, key: "silenced_chats", color: "#EF4444" },
+  {
+    id: "screenshot-cache",
+    label: "Скриншотов из кэша",
+    icon: ScanSearch,
+    get: (s) => s?.screenshot_cache?.vision_calls_saved,
+    color: "#38BDF8",
+  },
 ];
 
 export default function StatusCards({ status }) {
@@ -28,7 +36,7 @@ export default function StatusCards({ status }) {
       <div className="space-y-2">
         {cards.map((card, i) => {
           const Icon = card.icon;
-          const value = status?.[card.key] ?? 0;
+          const value = (card.get ? card.get(status) : status?.[card.key]) ?? 0;
           return (
             <div
               key={card.id}
@@ -54,7 +62,7 @@ export default function StatusCards({ status }) {
         {status?.started_at && (
           <div
             data-testid="stat-card-uptime"
-            className="border border-white/[0.06] p-4 flex items-center justify-between animate-fade-in stagger-6 opacity-0"
+            className="border border-white/[0.06] p-4 flex items-center justify-between animate-fade-in stagger-7 opacity-0"
             style={{ background: "#0A0A0A" }}
           >
             <div className="flex items-center gap-3">
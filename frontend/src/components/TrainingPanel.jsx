@@ -1,17 +1,29 @@
-import { useState, useEffect } from "react";
+import { useState, useEffect, useRef } from "react";
 import axios from "axios";
-import { GraduationCap, Scan, Loader2, Trash2, CheckCircle, AlertCircle, MessageSquare, Brain, ToggleLeft, ToggleRight, ChevronDown } from "lucide-react";
+import { GraduationCap, Scan, Loader2, Trash2, CheckCircle, AlertCircle, MessageSquare, Brain, ToggleLeft, ToggleRight, ChevronDown, Download, Upload, Square, RotateCcw } from "lucide-react";
 import { Slider } from "../components/ui/slider";
 
-export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false }) {
+const JOB_ACTIVE = ["queued", "running"];
+const JOB_RESUMABLE = ["cancelled", "interrupted", "failed"];
+const JOB_PHASES = {
+  dialogs: "Список диалогов",
+  fetch: "Загрузка истории",
+  analyze: "AI-анализ стиля",
+};
+
+export default function TrainingPanel({ apiUrl, botRunning, scanJob, defaultOpen = false }) {
   const [isOpen, setIsOpen] = useState(defaultOpen);
   const [status, setStatus] = useState(null);
-  const [scanning, setScanning] = useState(false);
+  const [job, setJob] = useState(null);
   const [maxChats, setMaxChats] = useState(50);
   const [msgsPerChat, setMsgsPerChat] = useState(100);
+  const [fullRescan, setFullRescan] = useState(false);
   const [scanResult, setScanResult] = useState(null);
   const [showExamples, setShowExamples] = useState(false);
   const [toggling, setToggling] = useState(false);
+  const [transferring, setTransferring] = useState(false);
+  const [transferResult, setTransferResult] = useState(null);
+  const importInput = useRef(null);
 
   const fetchStatus = () => {
     axios.get(`${apiUrl}/bot/training/status`)
@@ -21,22 +33,66 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
 
   useEffect(() => {
     fetchStatus();
+    // Скан идёт в фоне — после перезагрузки страницы подхватываем последнюю задачу
+    axios.get(`${apiUrl}/bot/jobs/latest`, { params: { kind: "training_scan" } })
+      .then((res) => res.data && setJob(res.data))
+      .catch(() => {});
   }, [apiUrl]);
 
-  const handleScan = async () => {
-    setScanning(true);
+  // Прогресс приходит событиями SSE (job) из App
+  useEffect(() => {
+    if (scanJob) setJob(scanJob);
+  }, [scanJob]);
+
+  const scanning = JOB_ACTIVE.includes(job?.status);
+
+  // Запасной опрос, если поток событий недоступен
+  useEffect(() => {
+    if (!scanning) return undefined;
+    const timer = setInterval(() => {
+      axios.get(`${apiUrl}/bot/jobs/${job.id}`)
+        .then((res) => setJob((prev) => (prev?.id === res.data.id ? res.data : prev)))
+        .catch(() => {});
+    }, 5000);
+    return () => clearInterval(timer);
+  }, [apiUrl, scanning, job?.id]);
+
+  // Результат показываем для задачи, запущенной из этой панели
+  const watchedJob = useRef(null);
+  useEffect(() => {
+    if (!job || job.id !== watchedJob.current || JOB_ACTIVE.includes(job.status)) return;
+    watchedJob.current = null;
+    if (job.status === "completed") setScanResult(job.result);
+    else if (job.status === "failed") setScanResult({ error: job.error || "Ошибка" });
+    fetchStatus();
+  }, [job]);
+
+  const submitJob = async (request) => {
     setScanResult(null);
     try {
-      const res = await axios.post(`${apiUrl}/bot/training/scan`, {
-        max_chats: maxChats,
-        messages_per_chat: msgsPerChat,
-      });
-      setScanResult(res.data);
-      fetchStatus();
+      const res = await request();
+      watchedJob.current = res.data.id;
+      setJob(res.data);
     } catch (e) {
       setScanResult({ error: e.response?.data?.detail || e.message || "Ошибка" });
     }
-    setScanning(false);
+  };
+
+  const handleScan = () => submitJob(() => axios.post(`${apiUrl}/bot/training/scan`, {
+    max_chats: maxChats,
+    messages_per_chat: msgsPerChat,
+    full: fullRescan,
+  }));
+
+  const handleResume = () => submitJob(() => axios.post(`${apiUrl}/bot/jobs/${job.id}/resume`));
+
+  const handleCancel = async () => {
+    try {
+      const res = await axios.post(`${apiUrl}/bot/jobs/${job.id}/cancel`);
+      setJob(res.data);
+    } catch (e) {
+      console.error("Cancel error:", e);
+    }
   };
 
   const handleReset = async () => {
@@ -57,6 +113,43 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
     setToggling(false);
   };
 
+  const handleExport = async () => {
+    setTransferring(true);
+    setTransferResult(null);
+    try {
+      const res = await axios.get(`${apiUrl}/bot/export`, { responseType: "blob" });
+      const name = /filename="([^"]+)"/.exec(res.headers["content-disposition"] || "")?.[1] || "export.ndjson.gz";
+      const url = URL.createObjectURL(res.data);
+      const link = document.createElement("a");
+      link.href = url;
+      link.download = name;
+      link.click();
+      URL.revokeObjectURL(url);
+    } catch (e) {
+      setTransferResult({ error: e.message || "Ошибка экспорта" });
+    }
+    setTransferring(false);
+  };
+
+  const handleImport = async (e) => {
+    const file = e.target.files?.[0];
+    e.target.value = "";
+    if (!file) return;
+    setTransferring(true);
+    setTransferResult(null);
+    try {
+      // Файл уходит телом запроса как есть — сервер читает его потоком
+      const res = await axios.post(`${apiUrl}/bot/import`, file, {
+        headers: { "Content-Type": "application/octet-stream" },
+      });
+      setTransferResult(res.data);
+      fetchStatus();
+    } catch (err) {
+      setTransferResult({ error: err.response?.data?.detail || err.message || "Ошибка импорта" });
+    }
+    setTransferring(false);
+  };
+
   return (
     <div
       data-testid="training-panel"
@@ -222,6 +315,19 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
           </div>
         </div>
 
+        {status?.has_training_data && (
+          <label className="flex items-center gap-2 text-[10px] font-mono text-neutral-500 cursor-pointer select-none">
+            <input
+              data-testid="training-full-rescan"
+              type="checkbox"
+              checked={fullRescan}
+              onChange={(e) => setFullRescan(e.target.checked)}
+              className="accent-emerald-500"
+            />
+            Полностью заново (иначе — только новые сообщения)
+          </label>
+        )}
+
         {/* Scan button */}
         <button
           data-testid="training-scan-btn"
@@ -234,7 +340,7 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
           {scanning ? (
             <>
               <Loader2 className="h-3.5 w-3.5 animate-spin" />
-              Сканирование + AI анализ...
+              {JOB_PHASES[job.phase] || "Сканирование"}...
             </>
           ) : (
             <>
@@ -251,6 +357,54 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
           </div>
         )}
 
+        {/* Background scan progress */}
+        {scanning && (
+          <div data-testid="scan-progress" className="space-y-1.5 px-3 py-2 border border-white/[0.06]">
+            <div className="flex items-center justify-between font-mono text-[10px] text-neutral-400">
+              <span>
+                {job.progress?.chats_total != null
+                  ? `Чатов: ${job.progress.chats_done || 0} / ${job.progress.chats_total}`
+                  : "Подготовка..."}
+                {job.progress?.new_pairs > 0 && ` · новых пар: ${job.progress.new_pairs}`}
+              </span>
+              <button
+                data-testid="scan-cancel-btn"
+                onClick={handleCancel}
+                className="flex items-center gap-1 text-neutral-500 hover:text-red-400 transition-colors"
+              >
+                <Square className="h-3 w-3" />
+                Отменить
+              </button>
+            </div>
+            {job.progress?.chats_total > 0 && (
+              <div className="h-1 bg-white/[0.06]">
+                <div
+                  className="h-1 bg-emerald-500 transition-all"
+                  style={{ width: `${Math.min(100, (100 * (job.progress.chats_done || 0)) / job.progress.chats_total)}%` }}
+                />
+              </div>
+            )}
+          </div>
+        )}
+
+        {!scanning && JOB_RESUMABLE.includes(job?.status) && (
+          <div className="flex items-center justify-between px-3 py-2 border border-amber-500/20 bg-amber-500/5">
+            <span className="font-mono text-[10px] text-amber-500">
+              {job.status === "failed" ? "Скан завершился с ошибкой" : "Скан прерван"}
+              {job.progress?.chats_total != null && ` на ${job.progress.chats_done || 0} / ${job.progress.chats_total} чатов`}
+            </span>
+            <button
+              data-testid="scan-resume-btn"
+              onClick={handleResume}
+              disabled={!botRunning}
+              className="flex items-center gap-1 font-mono text-[10px] text-amber-400 hover:text-amber-300 disabled:opacity-30"
+            >
+              <RotateCcw className="h-3 w-3" />
+              Продолжить
+            </button>
+          </div>
+        )}
+
         {/* Scan result */}
         {scanResult && !scanResult.error && (
           <div
@@ -263,7 +417,16 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
             </div>
             <div className="font-mono text-[10px] text-neutral-400 space-y-0.5">
               <p>Личных чатов: {scanResult.scanned_chats}</p>
-              <p>Пар сообщений: {scanResult.total_pairs}</p>
+              {scanResult.incremental ? (
+                <>
+                  <p>Новых пар: {scanResult.new_pairs} (всего {scanResult.total_pairs})</p>
+                  {scanResult.unchanged_chats > 0 && (
+                    <p className="text-neutral-600">Без новых сообщений: {scanResult.unchanged_chats}</p>
+                  )}
+                </>
+              ) : (
+                <p>Пар сообщений: {scanResult.total_pairs}</p>
+              )}
               <p>Всего сообщений: {scanResult.total_messages}</p>
               {scanResult.skipped_non_private > 0 && (
                 <p className="text-neutral-600">Пропущено (не личные): {scanResult.skipped_non_private}</p>
@@ -271,6 +434,12 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
               {scanResult.few_shot_count > 0 && (
                 <p className="text-emerald-500/70">Примеров в промпте: {scanResult.few_shot_count}</p>
               )}
+              {scanResult.elapsed_sec > 0 && (
+                <p className="text-neutral-600">
+                  {scanResult.elapsed_sec} с · {scanResult.chats_per_sec} чатов/с · {scanResult.messages_per_sec} сообщ./с
+                  {scanResult.flood_waits > 0 && ` · FloodWait: ${scanResult.flood_waits}`}
+                </p>
+              )}
             </div>
           </div>
         )}
@@ -301,6 +470,54 @@ export default function TrainingPanel({ apiUrl, botRunning, defaultOpen = false
             </div>
           </div>
         )}
+
+        {/* Export / import */}
+        <div className="flex gap-2">
+          <button
+            data-testid="training-export-btn"
+            onClick={handleExport}
+            disabled={transferring}
+            className="flex-1 py-2 text-[10px] uppercase tracking-widest border border-white/[0.06]
+              text-neutral-500 hover:text-[#00F0FF] transition-colors disabled:opacity-30
+              flex items-center justify-center gap-1.5"
+          >
+            <Download className="h-3 w-3" />
+            Экспорт
+          </button>
+          <button
+            data-testid="training-import-btn"
+            onClick={() => importInput.current?.click()}
+            disabled={transferring}
+            className="flex-1 py-2 text-[10px] uppercase tracking-widest border border-white/[0.06]
+              text-neutral-500 hover:text-[#00F0FF] transition-colors disabled:opacity-30
+              flex items-center justify-center gap-1.5"
+          >
+            {transferring ? <Loader2 className="h-3 w-3 animate-spin" /> : <Upload className="h-3 w-3" />}
+            Импорт
+          </button>
+          <input
+            ref={importInput}
+            type="file"
+            accept=".gz,.ndjson,.jsonl"
+            onChange={handleImport}
+            className="hidden"
+          />
+        </div>
+
+        {transferResult && !transferResult.error && (
+          <div data-testid="import-result" className="font-mono text-[10px] text-neutral-400 px-3">
+            Импортировано: {transferResult.messages} сообщений, {transferResult.training_pairs} пар
+            {transferResult.duplicates > 0 && `, пропущено дублей: ${transferResult.duplicates}`}
+            {transferResult.errors > 0 && `, ошибок: ${transferResult.errors}`}
+          </div>
+        )}
+
+        {transferResult?.error && (
+          <div className="flex items-center gap-2 px-3 py-2 border border-red-500/20 bg-red-500/5">
+            <AlertCircle className="h-3 w-3 text-red-400" />
+            <span className="font-mono text-[10px] text-red-400">{transferResult.error}</span>
+          </div>
+        )}
       </div>}
     </div>
   );
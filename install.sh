@@ -133,8 +133,9 @@ sed -i "s|CORS_ORIGINS=https://\$DOMAIN|CORS_ORIGINS=https://$DOMAIN|" backend/.
 
 print_ok "backend/.env created (API keys configured in web panel)"
 
-# Сохраняем домен
+# Сохраняем домен; профиль mongo поднимает контейнер MongoDB (STORAGE_BACKEND=mongo)
 echo "DOMAIN=$DOMAIN" > .env
+echo "COMPOSE_PROFILES=mongo" >> .env
 print_ok "Домен сохранён: $DOMAIN"
 
 # ── 3. SSL-сертификат ──────────────────────────────────
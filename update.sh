@@ -50,6 +50,13 @@ if [ -f "backend/.env" ]; then
     cp backend/.env backend/.env.backup
     print_ok "Бэкап backend/.env создан"
 fi
+# Корневой .env (DOMAIN, COMPOSE_PROFILES) тоже не в git — stash забрал бы его;
+# копию держим вне рабочего дерева, иначе stash заберёт и её
+ROOT_ENV_BACKUP=""
+if [ -f ".env" ]; then
+    ROOT_ENV_BACKUP=$(mktemp)
+    cp .env "$ROOT_ENV_BACKUP"
+fi
 
 # 1. Получаем обновления
 print_step "Получение обновлений из Git..."
@@ -62,6 +69,9 @@ if [ -f "backend/.env.backup" ]; then
     mv backend/.env.backup backend/.env
     print_ok "backend/.env восстановлен"
 fi
+if [ -n "$ROOT_ENV_BACKUP" ]; then
+    mv "$ROOT_ENV_BACKUP" .env
+fi
 
 # Обновляем CORS если домен известен
 if [ -n "$DOMAIN" ]; then
@@ -73,6 +83,13 @@ if [ -n "$DOMAIN" ]; then
     fi
 fi
 
+# MongoDB теперь за профилем compose — старым установкам с MongoDB включаем его
+if [ -f ".env" ] && ! grep -q "^COMPOSE_PROFILES=" .env \
+    && ! grep -q "^STORAGE_BACKEND=sqlite" backend/.env 2>/dev/null; then
+    echo "COMPOSE_PROFILES=mongo" >> .env
+    print_ok "Профиль mongo включён в .env"
+fi
+
 # 2. Останавливаем контейнеры
 print_step "Остановка контейнеров..."
 $COMPOSE -f docker-compose.prod.yml down